@@ -15,27 +15,66 @@
 """Simple Flask API server for the travel concierge agent"""
 
 from flask import Flask, request, jsonify, Response, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import ast
+import atexit
+import functools
+import hashlib
 import json
 import logging
+import math
+import queue
 import re
+import string
 import time
+import traceback
 import uuid
 import requests
 import os
-from datetime import datetime
-from typing import Any, Dict, List
+import sys
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pydantic import ValidationError
 
 try:
+    from google.api_core.exceptions import FailedPrecondition
     from google.cloud import firestore
+    from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+    from google.cloud.firestore_v1.field_path import FieldPath
     from google.oauth2 import service_account
 except Exception:  # pragma: no cover - Firestore optional
+    FailedPrecondition = None
     firestore = None
+    BulkWriterOptions = None
+    SendMode = None
+    FieldPath = None
     service_account = None
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson optional
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy optional
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:  # pragma: no cover - pandas optional
+    pd = None
+
 from travel_concierge.tools.cost_tracker import CostTrackerService
 from travel_concierge.tools.cost_manager import _to_float
-from travel_concierge.shared_libraries.types import CostItem
+from travel_concierge.tools.place_resolver import get_place_resolver
+from travel_concierge.shared_libraries.types import CostItem, TransportResearchUpdate
 from travel_concierge.tools.destination_id_validator import (
     validate_cost_items,
     is_valid_destination_id,
@@ -43,6 +82,100 @@ from travel_concierge.tools.destination_id_validator import (
 )
 
 
+def _json_loads(data):
+    """Decode JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj) -> str:
+    """Encode compact JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _utcnow_iso() -> str:
+    """Current UTC time as ISO-8601 with an explicit +00:00 offset."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes and decodes with orjson when installed.
+
+    Datetimes are passed through to Flask's ``default`` so ``jsonify`` keeps
+    emitting HTTP dates, and non-string keys are stringified as before.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def _extract_json_object(text: str, required_key: str):
+    """Return the first JSON object in ``text`` that mentions ``required_key``, or None.
+
+    Walks the text once per candidate, matching braces while honouring string
+    literals and escapes, so long LLM output cannot trigger regex backtracking.
+    """
+    marker = f'"{required_key}"'
+    length = len(text)
+    start = text.find('{')
+    while start != -1:
+        depth = 0
+        in_string = False
+        escaped = False
+        end = -1
+        for i in range(start, length):
+            char = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{' or char == '[':
+                depth += 1
+            elif char == '}' or char == ']':
+                depth -= 1
+                if depth == 0:
+                    end = i + 1
+                    break
+        if end == -1:
+            # Unbalanced from here; a later '{' may still open a complete object.
+            start = text.find('{', start + 1)
+            continue
+        candidate = text[start:end]
+        if marker not in candidate:
+            # Nothing nested inside can match either, so skip the whole span.
+            start = text.find('{', end)
+            continue
+        try:
+            obj = _json_loads(candidate)
+        except ValueError:
+            start = text.find('{', start + 1)
+            continue
+        if isinstance(obj, dict):
+            return obj
+        start = text.find('{', start + 1)
+    return None
+
+
 def get_transport_icon(transport_mode: str) -> str:
     """Return the emoji icon for a given transport mode."""
     icons = {
@@ -59,7 +192,6 @@ def get_transport_icon(transport_mode: str) -> str:
 
 def calculate_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculate distance between two coordinates using Haversine formula."""
-    import math
     R = 6371  # Earth's radius in km
 
     lat1_rad = math.radians(lat1)
@@ -73,6 +205,42 @@ def calculate_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) ->
     return R * c
 
 
+_VECTORIZED_DISTANCE_MIN_LEGS = 32
+
+
+def _leg_distances_km(locations) -> List[float | None]:
+    """Haversine distance between each pair of consecutive locations.
+
+    A leg is None when either end has no coordinates dict or a non-numeric
+    lat/lng. Long itineraries are computed in one NumPy pass when it is installed.
+    """
+    points = []
+    for loc in locations:
+        coords = loc.get('coordinates', {})
+        lat = coords.get('lat', 0) if coords else None
+        lng = coords.get('lng', 0) if coords else None
+        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+            points.append((lat, lng))
+        else:
+            points.append(None)
+
+    if len(points) - 1 >= _VECTORIZED_DISTANCE_MIN_LEGS and np is not None:
+        coords = np.array([p or (0.0, 0.0) for p in points], dtype=np.float64)
+        lat = np.radians(coords[:, 0])
+        delta = np.diff(np.radians(coords), axis=0)
+        a = np.sin(delta[:, 0] / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(delta[:, 1] / 2) ** 2
+        distances = (2 * 6371 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))).tolist()
+        return [
+            distance if points[i] is not None and points[i + 1] is not None else None
+            for i, distance in enumerate(distances)
+        ]
+
+    return [
+        calculate_distance_km(start[0], start[1], end[0], end[1]) if start is not None and end is not None else None
+        for start, end in zip(points, points[1:])
+    ]
+
+
 def get_transport_mode_for_distance(distance_km: float, same_country: bool = True) -> str:
     """Determine appropriate transport mode based on distance."""
     if distance_km > 1000:
@@ -132,30 +300,21 @@ class SessionStore:
         self._cost_cache: Dict[str, CostTrackerService] = {}
         self._metadata: Dict[str, Dict[str, float]] = {}
         self._metadata_loaded = False
+        # One lock per session so concurrent handlers for different sessions never wait on each other
+        self._session_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
 
         # In-memory fallback structures
         self._fallback_sessions: Dict[str, Dict[str, Any]] = {}
         self._fallback_costs: Dict[str, CostTrackerService] = {}
 
         if self._use_firestore:
-            try:
-                # Try to get credentials from environment variable
-                credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-                if credentials_json:
-                    import json
-                    credentials_info = json.loads(credentials_json)
-                    credentials = service_account.Credentials.from_service_account_info(credentials_info)
-                    project_id = credentials_info.get('project_id') or os.getenv('GOOGLE_CLOUD_PROJECT')
-                    self._client = firestore.Client(credentials=credentials, project=project_id)
-                    self._logger.info('SessionStore using Firestore backend with JSON credentials')
-                else:
-                    # Fall back to default credentials (ADC)
-                    self._client = firestore.Client()
-                    self._logger.info('SessionStore using Firestore backend with default credentials')
-
+            # Share the process-wide client (and its gRPC channel) with the route handlers
+            self._client = get_firestore_client()
+            if self._client is not None:
                 self._collection = self._client.collection(self._collection_name)
-            except Exception as exc:  # pragma: no cover
-                self._logger.warning('Firestore client unavailable (%s); using in-memory store', exc)
+                self._logger.info('SessionStore using Firestore backend')
+            else:  # pragma: no cover
+                self._logger.warning('Firestore client unavailable; using in-memory store')
                 self._use_firestore = False
 
     @staticmethod
@@ -251,13 +410,30 @@ class SessionStore:
     def pop_changes(self, session_id: str) -> List[Dict[str, Any]]:
         data = self._ensure_session_cache(session_id)
         changes = list(data.get('changes', []))
+        if not changes:
+            # Idle poll: nothing to clear, so skip the Firestore write
+            return changes
         data['changes'] = []
         self._session_cache[session_id] = data
         self._persist_session(session_id)
         return changes
 
+    def get_cached_session(self, session_id: str) -> Dict[str, Any] | None:
+        """Return the session cached in this process, or None; never loads from Firestore."""
+        return self._session_cache.get(session_id)
+
+    def append_pending_change(self, session_id: str, change: Dict[str, Any], max_pending: int) -> bool:
+        """Queue a change notification on a cached session; False if it is not cached."""
+        data = self._session_cache.get(session_id)
+        if data is None:
+            return False
+        with self._session_locks[session_id]:
+            data.setdefault('pending_changes', deque(maxlen=max_pending)).append(change)
+        return True
+
     def delete_session(self, session_id: str) -> None:
         self._session_cache.pop(session_id, None)
+        self._session_locks.pop(session_id, None)
         self._cost_cache.pop(session_id, None)
         self._metadata.pop(session_id, None)
         if self._use_firestore and self._collection:
@@ -345,30 +521,373 @@ class SessionStore:
         return sessions
 
 
+_firestore_client = None
+_firestore_client_lock = threading.Lock()
+
+
 def get_firestore_client():
-    """Get a configured Firestore client with proper credentials."""
+    """Get the process-wide Firestore client, creating it with proper credentials on first use.
+
+    The client is thread-safe and holds the gRPC channel, so it is reused across
+    requests. A failed creation is not cached; the next call tries again.
+    """
+    global _firestore_client
     if not firestore:
         return None
+    if _firestore_client is not None:
+        return _firestore_client
 
-    try:
-        # Try to get credentials from environment variable
-        credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-        if credentials_json:
-            import json
-            credentials_info = json.loads(credentials_json)
-            credentials = service_account.Credentials.from_service_account_info(credentials_info)
-            project_id = credentials_info.get('project_id') or os.getenv('GOOGLE_CLOUD_PROJECT')
-            return firestore.Client(credentials=credentials, project=project_id)
-        else:
-            # Fall back to default credentials (ADC)
-            return firestore.Client()
-    except Exception as exc:
-        logger = logging.getLogger(__name__)
-        logger.warning('Failed to create Firestore client: %s', exc)
-        return None
+    with _firestore_client_lock:
+        if _firestore_client is not None:
+            return _firestore_client
+        try:
+            # Try to get credentials from environment variable
+            credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+            if credentials_json:
+                credentials_info = json.loads(credentials_json)
+                credentials = service_account.Credentials.from_service_account_info(credentials_info)
+                project_id = credentials_info.get('project_id') or os.getenv('GOOGLE_CLOUD_PROJECT')
+                _firestore_client = firestore.Client(credentials=credentials, project=project_id)
+            else:
+                # Fall back to default credentials (ADC)
+                _firestore_client = firestore.Client()
+        except Exception as exc:
+            logger = logging.getLogger(__name__)
+            logger.warning('Failed to create Firestore client: %s', exc)
+            return None
+        return _firestore_client
+
+
+class BackgroundVersionWriter:
+    """Commit scenario version writes through a Firestore BulkWriter off the request thread.
+
+    Handlers enqueue the new version document plus the scenario ``currentVersion``
+    update and return immediately. A single worker thread drains the queue into a
+    BulkWriter (serial send mode so updates to the same scenario land in order)
+    and closes it, which flushes with the BulkWriter's retry/backoff.
+
+    Until a version is flushed it is kept in ``_pending`` so reads in this process
+    see their own writes via :meth:`pending_version`.
+
+    ``BulkWriter.close()`` does not raise for a write that ran out of retries, so
+    those are caught in an ``on_write_error`` hook. A version that did not land is
+    dropped from the latest-version cache, reported on the scenario session's
+    ``pending_changes`` as ``version_write_failed``, and kept for
+    :meth:`take_failures` (which ``/api/costs/flush`` reports).
+    """
+
+    max_attempts = 5
+
+    def __init__(self) -> None:
+        self._logger = logging.getLogger(__name__)
+        self._queue: queue.Queue = queue.Queue()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._failures: deque = deque(maxlen=100)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='firestore-version-writer', daemon=True
+                )
+                self._thread.start()
+
+    def submit_version(
+        self,
+        db,
+        scenario_id: str,
+        scenario_ref,
+        new_version_ref,
+        version_payload: Dict[str, Any],
+        scenario_update: Dict[str, Any],
+    ) -> None:
+        """Queue a new version document and the matching scenario update."""
+        with self._lock:
+            self._pending[scenario_id] = version_payload
+        self._queue.put((db, scenario_id, scenario_ref, new_version_ref, version_payload, scenario_update))
+        self._ensure_worker()
+
+    def pending_version(self, scenario_id: str) -> Dict[str, Any] | None:
+        """Return the newest not-yet-flushed version payload for a scenario."""
+        with self._lock:
+            return self._pending.get(scenario_id)
+
+    def take_failures(self) -> List[Dict[str, Any]]:
+        """Return and clear the versions whose writes failed since the last call."""
+        with self._lock:
+            failures = list(self._failures)
+            self._failures.clear()
+        return failures
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Block until everything queued so far is committed. Returns False on timeout."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        self._ensure_worker()
+        return done.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [item for item in items if not isinstance(item, threading.Event)]
+            if writes:
+                self._commit(writes)
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _record_failure(self, scenario_id: str, version_payload: Dict[str, Any], reason: str) -> None:
+        version_number = version_payload.get('versionNumber')
+        self._logger.error('Version v%s of scenario %s was not saved: %s', version_number, scenario_id, reason)
+        latest_version_cache.invalidate(scenario_id)
+        failure = {
+            'type': 'version_write_failed',
+            'scenario_id': scenario_id,
+            'version_number': version_number,
+            'error': reason,
+            'ts_ns': time.time_ns(),
+        }
+        with self._lock:
+            self._failures.append(failure)
+        # Cost routes use the scenario id as their session id
+        session_store.append_pending_change(scenario_id, failure, MAX_PENDING_SEGMENT_CHANGES)
 
+    def _commit(self, writes) -> None:
+        writer = None
+        failed_paths: Dict[str, str] = {}
+
+        def _on_write_error(failure, _bulk_writer) -> bool:
+            if failure.attempts < self.max_attempts:
+                return True
+            failed_paths[failure.operation.reference.path] = failure.message
+            return False
+
+        try:
+            writer = writes[0][0].bulk_writer(
+                options=BulkWriterOptions(initial_ops_per_second=500, mode=SendMode.serial)
+            )
+            scenario_by_version_path = {
+                new_version_ref.path: scenario_id
+                for _db, scenario_id, _scenario_ref, new_version_ref, *_rest in writes
+            }
+
+            def _on_write_result(reference, result, _bulk_writer):
+                scenario_id = scenario_by_version_path.get(reference.path)
+                if scenario_id is not None:
+                    latest_version_cache.confirm(scenario_id, reference, result.update_time)
+
+            writer.on_write_result(_on_write_result)
+            writer.on_write_error(_on_write_error)
+            for _db, _scenario_id, scenario_ref, new_version_ref, version_payload, scenario_update in writes:
+                writer.set(new_version_ref, version_payload)
+                writer.update(scenario_ref, scenario_update)
+            writer.close()
+            for _db, scenario_id, scenario_ref, new_version_ref, version_payload, _update in writes:
+                reason = failed_paths.get(new_version_ref.path) or failed_paths.get(scenario_ref.path)
+                if reason is not None:
+                    self._record_failure(scenario_id, version_payload, reason)
+        except Exception as exc:  # pragma: no cover - network failure
+            self._logger.error('Background Firestore version write failed: %s', exc, exc_info=True)
+            for _db, scenario_id, _scenario_ref, _new_version_ref, version_payload, _update in writes:
+                self._record_failure(scenario_id, version_payload, str(exc))
+        finally:
+            with self._lock:
+                for _db, scenario_id, _scenario_ref, _new_version_ref, version_payload, _update in writes:
+                    if self._pending.get(scenario_id) is version_payload:
+                        del self._pending[scenario_id]
+
+
+class _CachedVersionSnapshot:
+    """Stand-in for a version DocumentSnapshot served from :class:`LatestVersionCache`."""
+
+    exists = True
+
+    def __init__(self, reference, data: Dict[str, Any]) -> None:
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Handlers may merge into cost dicts in place, so hand out copies of those.
+        data = dict(self._data)
+        itinerary_data = dict(data.get('itineraryData') or {})
+        itinerary_data['costs'] = [dict(cost) for cost in itinerary_data.get('costs') or []]
+        data['itineraryData'] = itinerary_data
+        return data
+
+
+class LatestVersionCache:
+    """Short-lived cache of the latest version each scenario had written by this process.
+
+    The web client edits the current version in place (``updateDoc`` on
+    ``itineraryData.costs`` and friends) without bumping ``currentVersion``, so an
+    entry is only served after the caller re-checks it: the scenario's
+    ``currentVersion`` must still match, and the version document's ``update_time``
+    must equal the one recorded when this process's write landed. Entries whose
+    write has not been acknowledged yet are never served.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self._ttl = ttl_seconds
+        self._entries: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, scenario_id: str, version_ref, version_data: Dict[str, Any]) -> None:
+        if self._ttl <= 0:
+            return
+        version_number = int(version_data.get('versionNumber', 0) or 0)
+        with self._lock:
+            self._entries[scenario_id] = (version_number, version_ref, version_data, time.monotonic() + self._ttl, None)
+
+    def confirm(self, scenario_id: str, version_ref, update_time) -> None:
+        """Record the server ``update_time`` of a remembered version once its write lands."""
+        with self._lock:
+            entry = self._entries.get(scenario_id)
+            if entry is None or entry[1].path != version_ref.path:
+                return
+            self._entries[scenario_id] = (*entry[:4], update_time)
+
+    def candidate(self, scenario_id: str):
+        """Return the reference of a fresh, acknowledged entry to validate, else None."""
+        with self._lock:
+            entry = self._entries.get(scenario_id)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[3]:
+                del self._entries[scenario_id]
+                return None
+            return entry[1] if entry[4] is not None else None
+
+    def lookup(self, scenario_id: str, current_version: int, update_time):
+        """Return the cached snapshot if it is still ``current_version`` as of ``update_time``."""
+        with self._lock:
+            entry = self._entries.get(scenario_id)
+        if entry is None:
+            return None
+        version_number, version_ref, version_data, _expires_at, cached_update_time = entry
+        if version_number != current_version or cached_update_time is None or cached_update_time != update_time:
+            return None
+        return _CachedVersionSnapshot(version_ref, version_data)
+
+    def invalidate(self, scenario_id: str) -> None:
+        with self._lock:
+            self._entries.pop(scenario_id, None)
+
+
+class _PendingVersionEdit:
+    """One caller's edit waiting in :class:`LatestVersionEditBatcher`."""
+
+    __slots__ = ('fields', 'mutate', 'read_fields', 'now_iso', 'done', 'outcome', 'error')
+
+    def __init__(self, fields, mutate, read_fields, now_iso) -> None:
+        self.fields = fields
+        self.mutate = mutate
+        self.read_fields = read_fields
+        self.now_iso = now_iso
+        self.done = False
+        self.outcome = None
+        self.error = None
+
+
+class LatestVersionEditBatcher:
+    """Group concurrent in-place edits of a scenario's latest version into one transaction.
+
+    An edit for an idle scenario commits straight away. Edits that arrive while a
+    transaction for the same scenario is in flight queue up, and the next of their
+    callers commits all of them together, so a burst of segment research updates
+    costs a couple of Firestore round trips instead of one per update. Each caller
+    still blocks until its own edit is committed and gets its own result.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._queued: Dict[str, List[_PendingVersionEdit]] = {}
+        self._busy: set = set()
+
+    def submit(self, db, scenario_ref, fields, mutate, read_fields=(), now_iso=None):
+        """Same contract as :func:`_mutate_latest_version`."""
+        scenario_id = scenario_ref.id
+        edit = _PendingVersionEdit(fields, mutate, read_fields, now_iso)
+        with self._cond:
+            self._queued.setdefault(scenario_id, []).append(edit)
+            while not edit.done and scenario_id in self._busy:
+                self._cond.wait()
+            if edit.done:
+                return self._result(edit)
+            self._busy.add(scenario_id)
+            batch = self._queued.pop(scenario_id)
+
+        try:
+            self._commit(db, scenario_ref, batch)
+        except Exception as exc:
+            for queued in batch:
+                queued.error = exc
+        finally:
+            with self._cond:
+                self._busy.discard(scenario_id)
+                for queued in batch:
+                    queued.done = True
+                self._cond.notify_all()
+        return self._result(edit)
+
+    @staticmethod
+    def _result(edit: _PendingVersionEdit):
+        if edit.error is not None:
+            raise edit.error
+        return edit.outcome
+
+    @staticmethod
+    def _commit(db, scenario_ref, batch: List[_PendingVersionEdit]) -> None:
+        fields = tuple(dict.fromkeys(field for edit in batch for field in edit.fields))
+        read_fields = tuple(dict.fromkeys(field for edit in batch for field in edit.read_fields))
+        now_iso = max((edit.now_iso for edit in batch if edit.now_iso), default=None)
+
+        def _mutate_all(itinerary_data):
+            # A failing edit is reported to its own caller without sinking the rest
+            results = []
+            for edit in batch:
+                try:
+                    results.append(edit.mutate(itinerary_data))
+                    edit.error = None
+                except Exception as exc:
+                    results.append(None)
+                    edit.error = exc
+            return results if any(result is not None for result in results) else None
+
+        version_found, results = _mutate_latest_version(
+            db, scenario_ref, fields, _mutate_all, read_fields=read_fields, now_iso=now_iso
+        )
+        for i, edit in enumerate(batch):
+            edit.outcome = (version_found, results[i] if results else None)
+
+
+# LOG_LEVEL=DEBUG turns on the per-request trace lines; they are skipped before formatting otherwise.
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 session_store = SessionStore()
+version_writer = BackgroundVersionWriter()
+latest_version_cache = LatestVersionCache(float(os.environ.get('LATEST_VERSION_CACHE_TTL_SECONDS', '30')))
+version_edit_batcher = LatestVersionEditBatcher()
+# Lets a handler overlap independent Firestore reads instead of awaiting them back to back.
+firestore_read_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='firestore-read')
+# Runs ADK summary requests alongside the Firestore save that they do not depend on.
+summary_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='adk-summary')
+# Carries Firestore edits a handler may stop waiting for; see TRANSPORT_RESEARCH_WRITE_WAIT_SECONDS.
+# Its size also caps concurrent Firestore writes from it, which keeps bursts under deadline limits.
+firestore_write_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('FIRESTORE_WRITE_WORKERS', '20')), thread_name_prefix='firestore-write'
+)
+atexit.register(version_writer.flush, 30)
 logger = logging.getLogger('travel_concierge.api')
 
 # Determine web directory path
@@ -384,17 +903,64 @@ else:
     dev_web = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../web'))
     WEB_DIR = dev_dist if os.path.exists(dev_dist) else dev_web
 
-app = Flask(__name__, static_folder=WEB_DIR, static_url_path='')
+# Vite emits content-hashed bundles under assets/, so browsers may keep them for a
+# year; HTML entry points keep Flask's default caching so new deploys are picked up.
+HASHED_ASSET_PREFIX = 'assets/'
+HASHED_ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class WebAppFlask(Flask):
+    """Flask app that lets browsers cache fingerprinted web assets."""
+
+    def get_send_file_max_age(self, filename):
+        if filename and filename.replace('\\', '/').startswith(HASHED_ASSET_PREFIX):
+            return HASHED_ASSET_MAX_AGE
+        return super().get_send_file_max_age(filename)
+
+
+app = WebAppFlask(__name__, static_folder=WEB_DIR, static_url_path='')
+app.json = OrjsonJSONProvider(app)
 CORS(app)  # Enable CORS for frontend requests
+# Hand static file bodies to the fronting web server; only valid behind nginx/Apache,
+# gunicorn on its own would send empty responses.
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # ADK API Server endpoint (you need to run: adk api_server travel_concierge)
 ADK_API_PORT = os.environ.get('ADK_API_PORT', '8000')
 ADK_API_URL = f"http://127.0.0.1:{ADK_API_PORT}"
+# Read size for ADK event streams. Every handler drains the whole stream before
+# responding, so larger reads cut loop iterations without delaying anything.
+SSE_CHUNK_SIZE = 8192
 APP_NAME = "travel_concierge"
 USER_ID = "web_user"
 
+# Shared keep-alive pool for calls to the ADK server. Retry's default
+# allowed_methods leaves POST out of status/read retries, so an agent run is
+# never replayed; only failed connects are retried.
+http_session = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+)
+http_session.mount('http://', _http_adapter)
+http_session.mount('https://', _http_adapter)
+
+# Firestore is authoritative for scenario costs; mirroring edits into the
+# session cost tracker is only needed by deployments that read from it directly.
+MIRROR_TO_LOCAL_TRACKER = os.environ.get('MIRROR_TO_LOCAL_TRACKER', '').lower() in ('1', 'true', 'yes')
+
 def normalize_destination_id(raw_id, name):
     """Return destination identifiers as stable strings."""
+    try:
+        return _normalize_destination_id_cached(raw_id, name)
+    except TypeError:
+        # Unhashable inputs (e.g. a dict from a malformed payload) skip the cache
+        return _normalize_destination_id_cached.__wrapped__(raw_id, name)
+
+
+@functools.lru_cache(maxsize=4096, typed=True)
+def _normalize_destination_id_cached(raw_id, name):
     if isinstance(raw_id, str):
         ident = raw_id.strip()
         if ident:
@@ -432,6 +998,56 @@ def resolve_session_id(requested_session_id: str) -> str:
     return requested_session_id
 
 
+def _with_pending_version(scenario_id: str, latest_version_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Prefer a queued-but-unflushed version over the latest one read from Firestore."""
+    pending = version_writer.pending_version(scenario_id)
+    if pending and int(pending.get('versionNumber', 0) or 0) > int(latest_version_data.get('versionNumber', 0) or 0):
+        return pending
+    return latest_version_data
+
+
+def _read_scenario_and_latest_version(scenario_ref, field_paths=None):
+    """Fetch the scenario document and its latest version.
+
+    When this process recently wrote the scenario's latest version, the scenario's
+    ``currentVersion`` still points at it and the version document is unchanged since
+    (checked via a projected read of its ``update_time``), the versions query is skipped.
+    Otherwise both reads run concurrently. Returns ``(scenario_doc, versions)`` where
+    ``versions`` holds at most one snapshot. ``field_paths`` projects the versions
+    query onto just those fields; a cached snapshot is returned whole.
+    """
+    def _query_latest():
+        query = (
+            scenario_ref
+                .collection('versions')
+                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
+                .limit(1)
+        )
+        if field_paths:
+            query = query.select(field_paths)
+        return list(query.stream())
+
+    scenario_id = scenario_ref.id
+    cached_ref = latest_version_cache.candidate(scenario_id)
+    if cached_ref is not None:
+        # A one-field read of the cached version: its update_time reveals in-place edits
+        stamp_future = firestore_read_pool.submit(cached_ref.get, field_paths=['versionNumber'])
+        scenario_doc = scenario_ref.get()
+        stamp = stamp_future.result()
+        if scenario_doc.exists and stamp.exists:
+            current_version = int((scenario_doc.to_dict() or {}).get('currentVersion', 0) or 0)
+            cached = latest_version_cache.lookup(scenario_id, current_version, stamp.update_time)
+            if cached is not None:
+                return scenario_doc, [cached]
+        versions = _query_latest()
+    else:
+        versions_future = firestore_read_pool.submit(_query_latest)
+        scenario_doc = scenario_ref.get()
+        versions = versions_future.result()
+
+    return scenario_doc, versions
+
+
 def record_itinerary_change(session_id: str, change: Dict[str, Any]) -> tuple[str, int]:
     """Store an itinerary change and return the resolved session ID and pending count."""
     resolved_session = resolve_session_id(session_id or 'default_session')
@@ -543,7 +1159,7 @@ CRITICAL REMINDERS:
         session_endpoint = f"{ADK_API_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
         try:
             # Create/verify session exists
-            session_resp = requests.post(session_endpoint)
+            session_resp = http_session.post(session_endpoint)
             print(f"Session creation response: {session_resp.status_code}")
 
             if session_resp.status_code == 200:
@@ -629,20 +1245,20 @@ CRITICAL REMINDERS:
             "Accept": "text/event-stream",
         }
 
-        response_text = ""
-        with requests.post(
+        response_parts = []
+        with http_session.post(
             run_endpoint,
-            data=json.dumps(adk_payload),
+            data=_json_dumps(adk_payload),
             headers=headers,
             stream=True,
             timeout=300  # 5 minutes for large itineraries with many destinations
         ) as r:
-            for chunk in r.iter_lines():
+            for chunk in r.iter_lines(chunk_size=SSE_CHUNK_SIZE):
                 if not chunk:
                     continue
-                json_string = chunk.decode("utf-8").removeprefix("data: ").strip()
+                json_string = chunk.removeprefix(b"data: ").strip()
                 try:
-                    event = json.loads(json_string)
+                    event = _json_loads(json_string)
 
                     # Log the full event for debugging
                     print(f"\n{'='*80}")
@@ -656,7 +1272,7 @@ CRITICAL REMINDERS:
                         for part in event["content"]["parts"]:
                             if "text" in part:
                                 text_content = part["text"]
-                                response_text += text_content
+                                response_parts.append(text_content)
                                 print(f"💬 AGENT TEXT: {text_content}")
 
                                 # DETECT HALLUCINATED ITINERARY CHANGES
@@ -671,14 +1287,13 @@ CRITICAL REMINDERS:
                                     r'updated your itinerary'
                                 ]
 
-                                import re
                                 for pattern in hallucinated_patterns:
                                     if re.search(pattern, text_content, re.IGNORECASE):
                                         print(f"\n🚨 DETECTED HALLUCINATED ITINERARY CHANGE: '{text_content}'")
                                         print(f"⚠️ AGENT CLAIMED TO MAKE CHANGES WITHOUT CALLING TOOLS!")
                                         print(f"🔧 FORCING CORRECT BEHAVIOR: Agent must use tools for itinerary changes\n")
                                         # Override the hallucinated response
-                                        response_text = "I need to use the proper tools to modify your itinerary. Let me call the appropriate tool to make this change."
+                                        response_parts = ["I need to use the proper tools to modify your itinerary. Let me call the appropriate tool to make this change."]
                                         break
 
                             # Log function/tool calls
@@ -704,12 +1319,13 @@ CRITICAL REMINDERS:
                 except json.JSONDecodeError:
                     continue
 
+        response_text = ''.join(response_parts)
+
         # Check if response contains structured cost research data and extract summary
         final_response_text = response_text
         research_data = None
         saved_costs = False
 
-        import sys
         print(f"\n{'='*80}", flush=True)
         print(f"🔍 CHECKING RESPONSE FOR STRUCTURED DATA", flush=True)
         print(f"{'='*80}", flush=True)
@@ -896,30 +1512,24 @@ CRITICAL REMINDERS:
                         print(f"⚠️ No cost items generated for {destination_name}", flush=True)
                         continue
 
-                    # Call bulk save API (using the same Flask server on port 5001)
-                    save_url = "http://127.0.0.1:5001/api/costs/bulk-save"
-                    save_resp = requests.post(
-                        save_url,
-                        json={
-                            'session_id': session_id,
-                            'scenario_id': scenario_id or 'current',  # Use scenario_id from context
-                            'destination_id': actual_destination_id,  # Use matched destination ID
-                            'destination_name': destination_name,
-                            'cost_items': cost_items,
-                        },
-                        timeout=30,
-                    )
-                    if save_resp.status_code == 200:
+                    # Save in-process (same logic as the bulk-save route)
+                    save_payload, save_status = save_destination_costs({
+                        'session_id': session_id,
+                        'scenario_id': scenario_id or 'current',  # Use scenario_id from context
+                        'destination_id': actual_destination_id,  # Use matched destination ID
+                        'destination_name': destination_name,
+                        'cost_items': cost_items,
+                    })
+                    if save_status == 200:
                         print(f"✅ Saved cost research data to Firestore:", flush=True)
                         print(f"   Destination: {destination_name}", flush=True)
                         print(f"   Destination ID: {actual_destination_id}", flush=True)
                         print(f"   Cost items: {len(cost_items)}", flush=True)
                         saved_costs = True
                     else:
-                        print(f"⚠️ Failed to save cost data: {save_resp.status_code}", flush=True)
-                        print(f"   Response: {save_resp.text[:200]}", flush=True)
+                        print(f"⚠️ Failed to save cost data: {save_status}", flush=True)
+                        print(f"   Response: {str(save_payload)[:200]}", flush=True)
                 except Exception as save_error:
-                    import traceback
                     print(f"⚠️ Error saving cost research to Firestore: {save_error}")
                     print(f"   Traceback: {traceback.format_exc()}")
 
@@ -927,7 +1537,6 @@ CRITICAL REMINDERS:
                 final_response_text = "\n\n".join(summaries)
 
         except Exception as e:
-            import traceback
             print(f"⚠️ Could not extract research_summary from response: {e}")
             print(f"   Traceback: {traceback.format_exc()}")
             final_response_text = response_text
@@ -940,7 +1549,6 @@ CRITICAL REMINDERS:
         })
 
     except requests.exceptions.ConnectionError:
-        import traceback
         error_details = traceback.format_exc()
         logger.error("ADK API connection error", exc_info=True)
         print(f"Connection error: {error_details}")
@@ -949,7 +1557,6 @@ CRITICAL REMINDERS:
             'status': 'error'
         }), 500
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         logger.exception("Chat endpoint failure: %s", e)
         print(f"Error in chat endpoint: {error_details}")
@@ -1152,7 +1759,7 @@ Please generate an appropriate title:"""
 
         try:
             # Create session
-            session_resp = requests.post(session_endpoint)
+            session_resp = http_session.post(session_endpoint)
             if session_resp.status_code != 200:
                 print(f"Failed to create session for title generation: {session_resp.text}")
                 # Fallback: return a simple generated title
@@ -1170,7 +1777,7 @@ Please generate an appropriate title:"""
                 },
             }
 
-            adk_response = requests.post(
+            adk_response = http_session.post(
                 f"{ADK_API_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{temp_session_id}/run",
                 json=adk_payload,
                 headers={"Content-Type": "application/json"}
@@ -1260,27 +1867,79 @@ def get_cost_tracker(session_id: str) -> tuple[CostTrackerService, str]:
     return tracker, resolved_session
 
 
+@functools.lru_cache(maxsize=1024)
 def _build_destination_aliases(raw_destination_id, normalized_destination_id, destination_name):
-    """Create a set of lowercase aliases used to match destination-specific costs."""
-    aliases = set()
-    for value in (raw_destination_id, normalized_destination_id):
-        if value is None:
-            continue
-        alias = str(value).strip().lower()
-        if alias:
-            aliases.add(alias)
+    """Create a frozenset of lowercase aliases used to match destination-specific costs."""
+    candidates = (
+        str(value).strip().lower()
+        for value in (
+            raw_destination_id,
+            normalized_destination_id,
+            normalize_destination_id(None, destination_name) if destination_name else None,
+        )
+        if value is not None
+    )
+    return frozenset(sys.intern(alias) for alias in candidates if alias)
+
+
+# Slug rules for deterministic research cost ids (matches save_researched_costs).
+_STABLE_DEST_TRANSLATION = str.maketrans({' ': '_', ',': '', '/': '-', ':': '-'})
+
+# Research JSON keys -> itinerary categories for research_costs.
+# NOTE: 'flights' removed - inter-destination flights tracked via TransportSegment
+_RESEARCH_COST_CATEGORIES = (
+    ('accommodation', 'accommodation'),
+    ('activities', 'activity'),
+    ('food_daily', 'food'),
+    ('transport_daily', 'transport'),  # Local transport only
+)
+
+_COST_FIELDS = (
+    'id', 'category', 'description', 'amount', 'currency', 'amount_usd',
+    'date', 'destination_id', 'booking_status', 'source', 'notes',
+)
 
-    if destination_name:
-        slug_alias = normalize_destination_id(None, destination_name)
-        if slug_alias:
-            aliases.add(str(slug_alias).strip().lower())
 
-    aliases.discard("")
-    return aliases
+def _is_clean_str(value) -> bool:
+    return isinstance(value, str) and bool(value) and value == value.strip()
+
+
+def _is_already_sanitized(cost_dict: dict) -> bool:
+    """Return True when cost_dict already has the exact shape the slow path would produce."""
+    amount = cost_dict.get('amount')
+    amount_usd = cost_dict.get('amount_usd')
+    currency = cost_dict.get('currency')
+    destination_id = cost_dict.get('destination_id')
+    notes = cost_dict.get('notes')
+    return (
+        _is_clean_str(cost_dict.get('id'))
+        and _is_clean_str(cost_dict.get('category'))
+        and _is_clean_str(cost_dict.get('description'))
+        and type(amount) is float
+        and type(amount_usd) is float
+        and bool(amount) == bool(amount_usd)
+        and _is_clean_str(currency) and currency.isupper()
+        and _is_clean_str(cost_dict.get('date'))
+        and (destination_id is None or _is_clean_str(destination_id))
+        and _is_clean_str(cost_dict.get('booking_status'))
+        and _is_clean_str(cost_dict.get('source'))
+        and (notes is None or _is_clean_str(notes))
+        # Research metadata gets folded into notes, so those items need the slow path
+        and not (cost_dict.get('confidence') or cost_dict.get('sources') or cost_dict.get('researched_at'))
+    )
 
 
-def _sanitize_cost_for_tracker(cost_dict: dict) -> CostItem:
+def _sanitize_cost_for_tracker(cost_dict: dict, default_date: str | None = None) -> CostItem:
     """Convert a raw cost dict into a CostItem for the in-memory tracker."""
+    if _is_already_sanitized(cost_dict):
+        # Shape verified above, so skip pydantic validation
+        fields = {key: cost_dict[key] for key in _COST_FIELDS if key in cost_dict}
+        fields['currency'] = sys.intern(fields['currency'])
+        fields['category'] = sys.intern(fields['category'])
+        if fields.get('destination_id') is not None:
+            fields['destination_id'] = sys.intern(fields['destination_id'])
+        return CostItem.model_construct(**fields)
+
     amount = _to_float(cost_dict.get('amount', 0))
     amount_usd = _to_float(cost_dict.get('amount_usd', amount))
 
@@ -1289,53 +1948,48 @@ def _sanitize_cost_for_tracker(cost_dict: dict) -> CostItem:
 
     currency = cost_dict.get('currency') or 'USD'
     if isinstance(currency, str):
-        currency = currency.strip().upper() or 'USD'
+        currency = sys.intern(currency.strip().upper() or 'USD')
     else:
         currency = 'USD'
 
+    # Destination IDs, currencies and categories repeat across thousands of
+    # cost items; interning keeps a single string object per distinct value.
     dest_val = cost_dict.get('destination_id')
     if dest_val is not None:
         dest_str = str(dest_val).strip()
-        destination_id = dest_str or None
+        destination_id = sys.intern(dest_str) if dest_str else None
     else:
         destination_id = None
 
-    notes_parts = []
     base_note = cost_dict.get('notes')
-    if base_note:
-        notes_parts.append(str(base_note).strip())
-
-    extras = []
     confidence = cost_dict.get('confidence')
-    if confidence:
-        extras.append(f"confidence={confidence}")
     sources = cost_dict.get('sources')
-    if sources:
-        extras.append("sources: " + ", ".join(sources))
     researched_at = cost_dict.get('researched_at')
-    if researched_at:
-        extras.append(f"researched_at={researched_at}")
-    if extras:
-        notes_parts.append(" | ".join(extras))
+    extras = " | ".join(filter(None, (
+        f"confidence={confidence}" if confidence else None,
+        "sources: " + ", ".join(sources) if sources else None,
+        f"researched_at={researched_at}" if researched_at else None,
+    )))
+    notes = "\n".join(filter(None, (str(base_note).strip() if base_note else None, extras))).strip()
 
     sanitized = {
         'id': str(cost_dict.get('id') or uuid.uuid4()),
-        'category': (cost_dict.get('category') or 'other').strip(),
+        'category': sys.intern((cost_dict.get('category') or 'other').strip()),
         'description': cost_dict.get('description') or f"{(cost_dict.get('category') or 'Cost').title()} estimate",
         'amount': amount,
         'currency': currency,
         'amount_usd': amount_usd if amount_usd else amount,
-        'date': cost_dict.get('date') or datetime.now().strftime("%Y-%m-%d"),
+        'date': cost_dict.get('date') or default_date or datetime.now().strftime("%Y-%m-%d"),
         'destination_id': destination_id,
         'booking_status': cost_dict.get('booking_status') or 'researched',
         'source': cost_dict.get('source') or 'web_research',
-        'notes': "\n".join(part for part in notes_parts if part).strip() or None,
+        'notes': notes or None,
     }
 
     return CostItem(**sanitized)
 
 
-def _replace_destination_costs_in_tracker(identifier: str, destination_aliases: set[str], cost_items: list[dict]):
+def _replace_destination_costs_in_tracker(identifier: str, destination_aliases: frozenset[str], cost_items: list[dict]):
     """Replace researched costs for a destination in the session tracker."""
     tracker, resolved_identifier = get_cost_tracker(identifier)
     aliases = {alias for alias in destination_aliases if alias}
@@ -1360,9 +2014,10 @@ def _replace_destination_costs_in_tracker(identifier: str, destination_aliases:
     tracker.costs = preserved_costs
 
     new_costs = []
+    today_iso = datetime.now().strftime("%Y-%m-%d")
     for item in cost_items:
         try:
-            cost_model = _sanitize_cost_for_tracker(item)
+            cost_model = _sanitize_cost_for_tracker(item, default_date=today_iso)
         except Exception as err:
             print(f"⚠️ Skipping cost item due to validation error: {err}")
             continue
@@ -1397,6 +2052,189 @@ def _apply_costs_to_local_store(destination_aliases, cost_items, primary_identif
         }
     return results
 
+def _commit_new_version(db, scenario_ref, scenario_data, latest_version_data, mutate_itinerary,
+                        scenario_fields=None) -> int:
+    """Create the next autosave version of a scenario and bump its currentVersion.
+
+    ``mutate_itinerary`` receives a shallow copy of the latest itineraryData and
+    returns the itineraryData to store. ``scenario_fields`` (e.g. the cost summary)
+    ride along in the same scenario update. Both writes are queued on the
+    background version writer. Returns the new version number.
+    """
+    new_version_number = max(
+        int(scenario_data.get('currentVersion', 0) or 0),
+        int(latest_version_data.get('versionNumber', 0) or 0),
+    ) + 1
+    itinerary_data = latest_version_data.get('itineraryData', {}) or {}
+    # Shallow copy only: it duplicates the handful of top-level keys, while the large
+    # locations/legs lists are shared by reference. Swapping ``costs`` in place and
+    # restoring it afterwards is not safe here, because the payload is committed later
+    # by the background writer and ``itinerary_data`` may itself be a pending payload.
+    new_itinerary_data = mutate_itinerary(dict(itinerary_data))
+
+    new_version_ref = scenario_ref.collection('versions').document()
+    version_payload = {
+        'versionNumber': new_version_number,
+        'versionName': '',
+        'isNamed': False,
+        'itineraryData': new_itinerary_data,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'itineraryDataHash': None,
+        'isAutosave': True,
+    }
+    latest_version_cache.remember(scenario_ref.id, new_version_ref, version_payload)
+    version_writer.submit_version(
+        db,
+        scenario_ref.id,
+        scenario_ref,
+        new_version_ref,
+        version_payload,
+        {
+            **(scenario_fields or {}),
+            'currentVersion': new_version_number,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        },
+    )
+    return new_version_number
+
+
+def _mutate_latest_version(db, scenario_ref, fields, mutate, read_fields=(), now_iso=None):
+    """Edit the scenario's latest version in place inside one Firestore transaction.
+
+    ``mutate`` receives the latest itineraryData, edits it in place and returns a
+    result for the caller, or None to leave the version untouched. Only the
+    itineraryData keys named in ``fields`` are read and written back (as dotted
+    field paths), plus any extra keys in ``read_fields`` that ``mutate`` needs to
+    see, so the rest of the itinerary is neither fetched nor re-sent. The read and
+    the write share a transaction, so concurrent edits retry instead of overwriting
+    each other; ``mutate`` may therefore run more than once. ``now_iso`` lets the
+    caller stamp ``lastModified`` with the same time it wrote into the itinerary.
+    Returns ``(version_found, result)``.
+
+    Raises RuntimeError if a version queued for the scenario cannot be flushed
+    first: that snapshot was built without this edit and would bury it on landing.
+    """
+    scenario_id = scenario_ref.id
+    if version_writer.pending_version(scenario_id) is not None:
+        # Land the queued version first so the edit applies to the newest one.
+        if not version_writer.flush(30) or version_writer.pending_version(scenario_id) is not None:
+            raise RuntimeError(f'A new version of scenario {scenario_id} is still being saved; retry the edit')
+
+    latest_query = (
+        scenario_ref
+            .collection('versions')
+            .order_by('versionNumber', direction=firestore.Query.DESCENDING)
+            .limit(1)
+            .select(['versionNumber', *(f'itineraryData.{field}' for field in (*fields, *read_fields))])
+    )
+
+    @firestore.transactional
+    def _run(transaction):
+        versions = list(transaction.get(latest_query))
+        if not versions:
+            return False, None
+        version_data = versions[0].to_dict() or {}
+        itinerary_data = version_data.get('itineraryData', {}) or {}
+        result = mutate(itinerary_data)
+        if result is not None:
+            last_modified = now_iso or datetime.utcnow().isoformat()
+            itinerary_updates = {field: itinerary_data.get(field) for field in fields}
+            version_update = {f'itineraryData.{field}': value for field, value in itinerary_updates.items()}
+            version_update['lastModified'] = last_modified
+            transaction.update(versions[0].reference, version_update)
+        return True, result
+
+    version_found, result = _run(db.transaction())
+    if result is not None:
+        # The edit moved the version's update_time, so a cached copy would fail validation anyway
+        latest_version_cache.invalidate(scenario_id)
+    return version_found, result
+
+
+def submit_latest_version_edit(db, scenario_ref, fields, mutate, read_fields=(), now_iso=None):
+    """Run a batched :func:`_mutate_latest_version` edit on ``firestore_write_pool``.
+
+    Returns a ``concurrent.futures.Future`` of ``(version_found, result)``. Sync
+    handlers wait on ``result(timeout)``; async code can ``await
+    asyncio.wrap_future(future)`` without blocking its event loop.
+    """
+    return firestore_write_pool.submit(
+        version_edit_batcher.submit,
+        db, scenario_ref, fields, mutate, read_fields=read_fields, now_iso=now_iso,
+    )
+
+
+def _index_costs_by_id(costs) -> Dict[str, int]:
+    """Map cost id -> position in ``costs`` (last occurrence wins)."""
+    return {cost.get('id'): i for i, cost in enumerate(costs) if cost.get('id')}
+
+
+def _normalize_cost_amounts(costs) -> None:
+    """Coerce ``amount``/``amount_usd`` to plain floats in place, in one pass.
+
+    Firestore then gets pre-typed doubles, and the totals pass never hits the
+    string/dict branches of ``_to_float``.
+    """
+    for item in costs:
+        for key in ('amount', 'amount_usd'):
+            if key in item and type(item[key]) is not float:
+                item[key] = _to_float(item[key])
+
+
+def _cost_summary_fields(costs, totals_by_category=None) -> Dict[str, Any]:
+    """Scenario-document summary fields for a cost list (totals computed unless given)."""
+    return {
+        'costsCount': len(costs),
+        'totalsByCategory': _totals_by_category(costs) if totals_by_category is None else totals_by_category,
+    }
+
+
+def _replace_costs(costs):
+    """Return a mutate_itinerary callback that swaps in a new costs list."""
+    def _mutate(itinerary_data):
+        itinerary_data['costs'] = costs
+        return itinerary_data
+    return _mutate
+
+
+def _costs_fingerprint(costs) -> str:
+    """Order-sensitive hex digest of a cost list, hashed item by item."""
+    digest = hashlib.blake2b(digest_size=16)
+    for item in costs:
+        digest.update(json.dumps(item, sort_keys=True, separators=(",", ":"), default=str).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+# Below this size the plain dict loop beats building a DataFrame or numpy arrays.
+_VECTORIZED_TOTALS_MIN_ITEMS = 2000
+
+
+def _totals_by_category(costs) -> Dict[str, float]:
+    """Sum amount_usd per category for the scenario summary document."""
+    if len(costs) >= _VECTORIZED_TOTALS_MIN_ITEMS:
+        categories = [item.get('category') or 'other' for item in costs]
+        if pd is not None:
+            amounts = pd.Series([_to_float(item.get('amount_usd', 0)) for item in costs], dtype='float64')
+            return amounts.groupby(categories, sort=False).sum().to_dict()
+        if np is not None:
+            # Dictionary-encode the (few) categories, then sum amounts per code in C.
+            amounts = np.fromiter(
+                (_to_float(item.get('amount_usd', 0)) for item in costs),
+                dtype=np.float64,
+                count=len(costs),
+            )
+            uniq, codes = np.unique(np.array(categories, dtype=object), return_inverse=True)
+            sums = np.bincount(codes, weights=amounts, minlength=len(uniq))
+            return dict(zip(uniq.tolist(), sums.tolist()))
+
+    totals_by_category = {}
+    for item in costs:
+        cat = item.get('category') or 'other'
+        totals_by_category[cat] = totals_by_category.get(cat, 0.0) + _to_float(item.get('amount_usd', 0))
+    return totals_by_category
+
+
 @app.route('/api/costs', methods=['POST'])
 def add_cost():
     """Add a new cost item."""
@@ -1432,8 +2270,6 @@ def add_cost():
 def update_cost(cost_id):
     """Update an existing cost item in Firestore."""
     try:
-        from google.cloud import firestore
-
         data = request.json
         session_id = data.get('session_id', 'default')
         scenario_id = session_id  # Using session_id as scenario_id
@@ -1474,7 +2310,7 @@ def update_cost(cost_id):
         if not versions:
             return jsonify({'status': 'error', 'error': f'No versions found for scenario {scenario_id}'}), 404
 
-        latest_version_data = versions[0].to_dict() or {}
+        latest_version_data = _with_pending_version(scenario_id, versions[0].to_dict() or {})
         itinerary_data = latest_version_data.get('itineraryData', {}) or {}
         version_costs = itinerary_data.get('costs', []) or []
 
@@ -1485,88 +2321,69 @@ def update_cost(cost_id):
             print(f"      [{i}] id={c.get('id')}, dest={c.get('destination_id')}, cat={c.get('category')}")
 
         updated_cost = None
-        updated_costs = []
-        for cost in version_costs:
-            if cost.get('id') == cost_id:
-                # Record change history (Recommendation F)
-                from datetime import datetime
-
-                # Find fields that changed
-                fields_changed = []
-                previous_value = {}
-                new_value = {}
-
-                for key, new_val in updates.items():
-                    old_val = cost.get(key)
-                    if old_val != new_val:
-                        fields_changed.append(key)
-                        previous_value[key] = old_val
-                        new_value[key] = new_val
-
-                # Create change event
-                if fields_changed:
-                    change_event = {
-                        'timestamp': datetime.utcnow().isoformat() + 'Z',
-                        'changed_by': data.get('user_id', 'system'),
-                        'previous_value': previous_value,
-                        'new_value': new_value,
-                        'change_reason': data.get('change_reason', 'user_edit'),
-                        'fields_changed': fields_changed
-                    }
+        now_iso = datetime.utcnow().isoformat() + 'Z'
+        cost_position = next((i for i, c in enumerate(version_costs) if c.get('id') == cost_id), None)
+        if cost_position is not None:
+            cost = version_costs[cost_position]
+            # Record change history (Recommendation F)
+            # Find fields that changed
+            fields_changed = []
+            previous_value = {}
+            new_value = {}
+
+            for key, new_val in updates.items():
+                old_val = cost.get(key)
+                if old_val != new_val:
+                    fields_changed.append(key)
+                    previous_value[key] = old_val
+                    new_value[key] = new_val
+
+            # Create change event
+            if fields_changed:
+                change_event = {
+                    'timestamp': now_iso,
+                    'changed_by': data.get('user_id', 'system'),
+                    'previous_value': previous_value,
+                    'new_value': new_value,
+                    'change_reason': data.get('change_reason', 'user_edit'),
+                    'fields_changed': fields_changed
+                }
 
-                    # Add to history
-                    history = cost.get('history', [])
-                    if not isinstance(history, list):
-                        history = []
-                    history.append(change_event)
-
-                    # Merge updates with history tracking
-                    updated_cost = {**cost, **updates}
-                    updated_cost['history'] = history
-                    updated_cost['updated_at'] = change_event['timestamp']
-                    updated_cost['last_modified_by'] = change_event['changed_by']
-                else:
-                    # No changes, just return existing cost
-                    updated_cost = cost
+                # Add to history (copied: the stored list may belong to a queued version)
+                history = cost.get('history', [])
+                history = list(history) if isinstance(history, list) else []
+                history.append(change_event)
 
-                updated_costs.append(updated_cost)
-                print(f"✓ Updated cost: {cost_id} - {updated_cost.get('category')} ${updated_cost.get('amount_usd', 0)}")
-                if fields_changed:
-                    print(f"  Changed fields: {', '.join(fields_changed)}")
+                # Merge updates with history tracking
+                updated_cost = {**cost, **updates}
+                updated_cost['history'] = history
+                updated_cost['updated_at'] = change_event['timestamp']
+                updated_cost['last_modified_by'] = change_event['changed_by']
             else:
-                updated_costs.append(cost)
+                # No changes, just return existing cost
+                updated_cost = cost
+
+            updated_costs = list(version_costs)
+            updated_costs[cost_position] = updated_cost
+            print(f"✓ Updated cost: {cost_id} - {updated_cost.get('category')} ${updated_cost.get('amount_usd', 0)}")
+            if fields_changed:
+                print(f"  Changed fields: {', '.join(fields_changed)}")
 
         if not updated_cost:
             print(f"❌ Cost not found with id={cost_id}")
             return jsonify({'status': 'error', 'error': 'Cost not found'}), 404
 
         # Create a new version with updated cost
-        new_version_number = max(int(scenario_data.get('currentVersion', 0) or 0), int(latest_version_data.get('versionNumber', 0) or 0)) + 1
-        new_version_ref = scenario_ref.collection('versions').document()
-        new_itinerary_data = dict(itinerary_data)
-        new_itinerary_data['costs'] = updated_costs
-
-        new_version_ref.set({
-            'versionNumber': new_version_number,
-            'versionName': '',
-            'isNamed': False,
-            'itineraryData': new_itinerary_data,
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'itineraryDataHash': None,
-            'isAutosave': True,
-        })
-
-        # Update scenario's currentVersion
-        scenario_ref.update({
-            'currentVersion': new_version_number,
-            'updatedAt': firestore.SERVER_TIMESTAMP,
-        })
+        new_version_number = _commit_new_version(
+            db, scenario_ref, scenario_data, latest_version_data, _replace_costs(updated_costs)
+        )
 
-        print(f"✅ Created new version v{new_version_number} with updated cost")
+        print(f"✅ Queued new version v{new_version_number} with updated cost")
 
-        tracker, resolved_session = get_cost_tracker(session_id)
-        tracker.update_cost(cost_id, **updates)
-        session_store.save_cost_tracker(resolved_session, tracker)
+        if MIRROR_TO_LOCAL_TRACKER:
+            tracker, resolved_session = get_cost_tracker(session_id)
+            tracker.update_cost(cost_id, **updates)
+            session_store.save_cost_tracker(resolved_session, tracker)
 
         return jsonify({
             'status': 'success',
@@ -1574,7 +2391,6 @@ def update_cost(cost_id):
         })
 
     except Exception as e:
-        import traceback
         print(f"Error updating cost: {e}")
         print(traceback.format_exc())
         return jsonify({'status': 'error', 'error': str(e)}), 500
@@ -1583,8 +2399,6 @@ def update_cost(cost_id):
 def delete_cost(cost_id):
     """Delete a cost item from Firestore or in-memory tracker."""
     try:
-        from google.cloud import firestore
-
         data = request.json or {}
         # Accept session_id from query params or JSON body
         session_id = request.args.get('session_id') or data.get('session_id', 'default')
@@ -1615,7 +2429,7 @@ def delete_cost(cost_id):
                     print(f"⚠️ No versions found for scenario: {scenario_id}")
                     raise Exception("No versions found")
 
-                latest_version_data = versions[0].to_dict() or {}
+                latest_version_data = _with_pending_version(scenario_id, versions[0].to_dict() or {})
                 itinerary_data = latest_version_data.get('itineraryData', {}) or {}
                 version_costs = itinerary_data.get('costs', []) or []
 
@@ -1636,33 +2450,17 @@ def delete_cost(cost_id):
                     return jsonify({'status': 'error', 'error': 'Cost not found'}), 404
 
                 # Create a new version with the cost removed
-                new_version_number = max(int(scenario_data.get('currentVersion', 0) or 0), int(latest_version_data.get('versionNumber', 0) or 0)) + 1
-                new_version_ref = scenario_ref.collection('versions').document()
-                new_itinerary_data = dict(itinerary_data)
-                new_itinerary_data['costs'] = updated_costs
-
-                new_version_ref.set({
-                    'versionNumber': new_version_number,
-                    'versionName': '',
-                    'isNamed': False,
-                    'itineraryData': new_itinerary_data,
-                    'createdAt': firestore.SERVER_TIMESTAMP,
-                    'itineraryDataHash': None,
-                    'isAutosave': True,
-                })
-
-                # Update scenario's currentVersion
-                scenario_ref.update({
-                    'currentVersion': new_version_number,
-                    'updatedAt': firestore.SERVER_TIMESTAMP,
-                })
+                new_version_number = _commit_new_version(
+                    db, scenario_ref, scenario_data, latest_version_data, _replace_costs(updated_costs)
+                )
 
-                print(f"✅ Created new version v{new_version_number} with cost deleted")
+                print(f"✅ Queued new version v{new_version_number} with cost deleted")
                 print(f"   Costs before: {len(version_costs)}, after: {len(updated_costs)}")
 
-                tracker, resolved_session = get_cost_tracker(session_id)
-                tracker.delete_cost(cost_id)
-                session_store.save_cost_tracker(resolved_session, tracker)
+                if MIRROR_TO_LOCAL_TRACKER:
+                    tracker, resolved_session = get_cost_tracker(session_id)
+                    tracker.delete_cost(cost_id)
+                    session_store.save_cost_tracker(resolved_session, tracker)
 
                 return jsonify({'status': 'success'})
 
@@ -1683,10 +2481,25 @@ def delete_cost(cost_id):
 
     except Exception as e:
         print(f"❌ Error deleting cost: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'status': 'error', 'error': str(e)}), 500
 
+@app.route('/api/costs/flush', methods=['POST'])
+def flush_costs():
+    """Block until queued cost version writes are committed to Firestore."""
+    try:
+        timeout = float((request.get_json(silent=True) or {}).get('timeout', 30))
+        if not math.isfinite(timeout) or timeout < 0:
+            raise ValueError(timeout)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'error': 'timeout must be a number of seconds'}), 400
+    if not version_writer.flush(timeout=timeout):
+        return jsonify({'status': 'error', 'error': 'Timed out waiting for Firestore writes'}), 504
+    failures = version_writer.take_failures()
+    if failures:
+        return jsonify({'status': 'error', 'error': 'Some version writes failed', 'failures': failures}), 500
+    return jsonify({'status': 'success'})
+
 @app.route('/api/costs', methods=['GET'])
 def get_costs():
     """Get all costs or filtered costs from Firestore."""
@@ -1701,8 +2514,6 @@ def get_costs():
         fetched_from_firestore = False
 
         try:
-            from google.cloud import firestore
-
             # Try to fetch from Firestore first (session_id is actually scenario_id)
             db = get_firestore_client()
             scenario_ref = db.collection('scenarios').document(session_id)
@@ -1711,16 +2522,18 @@ def get_costs():
             if scenario_doc.exists:
                 print(f"✅ Found scenario in Firestore: {session_id}")
 
+                # Only costs are needed here, so skip downloading locations/legs/etc.
                 versions = list(
                     scenario_ref
                         .collection('versions')
                         .order_by('versionNumber', direction=firestore.Query.DESCENDING)
+                        .select(['versionNumber', 'itineraryData.costs'])
                         .limit(1)
                         .stream()
                 )
 
                 if versions:
-                    latest_version_data = versions[0].to_dict() or {}
+                    latest_version_data = _with_pending_version(session_id, versions[0].to_dict() or {})
                     itinerary_data = latest_version_data.get('itineraryData', {}) or {}
                     costs_data = itinerary_data.get('costs', [])
 
@@ -1764,7 +2577,6 @@ def get_costs():
             'costs': costs
         })
     except Exception as e:
-        import traceback
         print(f"❌ Error getting costs: {e}")
         print(traceback.format_exc())
         return jsonify({'status': 'error', 'error': str(e)}), 500
@@ -1774,7 +2586,7 @@ def get_cost_summary():
     """Get comprehensive cost summary."""
     try:
         data = request.json or {}
-        print(f"[DEBUG] Received cost summary request with data: {data}")
+        logger.debug("Received cost summary request with data: %s", data)
         session_id = data.get('session_id', 'default')
         destinations = data.get('destinations')
         traveler_count = data.get('traveler_count')
@@ -1792,7 +2604,6 @@ def get_cost_summary():
             'summary': summary.model_dump()
         })
     except Exception as e:
-        import traceback
         print(f"Error getting cost summary: {e}")
         print(f"Traceback: {traceback.format_exc()}")
         return jsonify({'status': 'error', 'error': str(e)}), 500
@@ -1865,7 +2676,16 @@ def bulk_save_costs():
     print("💾 BULK-SAVE ENDPOINT CALLED")
     print("="*100)
 
-    data = request.json
+    payload, status = save_destination_costs(request.json or {})
+    return jsonify(payload), status
+
+
+def save_destination_costs(data: Dict[str, Any]) -> tuple[Dict[str, Any], int]:
+    """Replace a destination's researched costs in the scenario's latest version.
+
+    Shared by the bulk-save route and the in-process research flows. ``data`` has
+    the same shape as the route's request body. Returns ``(payload, status_code)``.
+    """
     session_id = data.get('session_id')
     scenario_id = data.get('scenario_id')
     destination_name = data.get('destination_name')
@@ -1885,10 +2705,10 @@ def bulk_save_costs():
 
     # Validate required fields
     if not all([scenario_id, destination_id, cost_items]):
-        return jsonify({
+        return {
             'status': 'error',
             'error': 'Missing required fields: scenario_id, destination_id, cost_items'
-        }), 400
+        }, 400
 
     print(f"💾 Bulk saving {len(cost_items)} costs for {destination_name} (ID: {destination_id})")
 
@@ -1901,35 +2721,37 @@ def bulk_save_costs():
 
     print(f"🔍 Looking for costs to remove with aliases: {sorted(destination_aliases)}")
 
-    try:
-        from google.cloud import firestore
+    local_sync = {}
+
+    def _sync_local_store():
+        """Mirror the saved costs into the in-memory store, at most once per request."""
+        if 'results' not in local_sync:
+            local_sync['results'] = _apply_costs_to_local_store(
+                destination_aliases,
+                cost_items,
+                scenario_id,
+                secondary_identifiers=[session_id],
+            )
+        return local_sync['results']
 
+    try:
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        scenario_doc = scenario_ref.get()
+        scenario_doc, versions = _read_scenario_and_latest_version(scenario_ref)
         if not scenario_doc.exists:
-            return jsonify({
+            return {
                 'status': 'error',
                 'error': f'Scenario {scenario_id} not found'
-            }), 404
+            }, 404
 
         scenario_data = scenario_doc.to_dict()
-        current_version = scenario_data.get('currentVersion', 0)
-
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
 
         version_filtered_costs = cost_items[:]
 
         if versions:
             latest_version_ref = versions[0].reference
-            latest_version_data = versions[0].to_dict() or {}
+            latest_version_data = _with_pending_version(scenario_id, versions[0].to_dict() or {})
 
             itinerary_data = latest_version_data.get('itineraryData', {}) or {}
             version_costs = itinerary_data.get('costs', []) or []
@@ -1942,7 +2764,7 @@ def bulk_save_costs():
             for item in cost_items:
                 if not item.get('destination_id') and destination_id:
                     item['destination_id'] = destination_id
-                    print(f"  📝 Set destination_id to {destination_id} for {item.get('category')}")
+                    logger.debug("Set destination_id to %s for %s", destination_id, item.get('category'))
 
             # Validate and auto-resolve destination IDs
             try:
@@ -1969,7 +2791,6 @@ def bulk_save_costs():
                 # Continue anyway, but log the error
 
             print(f"📊 Total costs in database before removal: {len(version_costs)}")
-            print(f"📊 Costs with descriptions containing '{destination_name.split(',')[0] if destination_name else ''}': {len([c for c in version_costs if destination_name and destination_name.split(',')[0].lower() in (c.get('description') or '').lower()])}")
 
             def _belongs_to_destination(cost_item):
                 cost_source = cost_item.get('source')
@@ -1980,9 +2801,9 @@ def bulk_save_costs():
 
                 dest_val = cost_item.get('destination_id')
                 if dest_val:
-                    dest_val_norm = str(dest_val).strip().lower()
+                    dest_val_norm = sys.intern(str(dest_val).strip().lower())
                     if dest_val_norm in destination_aliases:
-                        print(f"  ✓ Match by UUID: {dest_val} -> {cost_item.get('category')} ${cost_item.get('amount_usd', 0)}")
+                        logger.debug("Match by UUID: %s -> %s $%s", dest_val, cost_item.get('category'), cost_item.get('amount_usd', 0))
                         return True
 
                 item_id = cost_item.get('id')
@@ -1990,7 +2811,7 @@ def bulk_save_costs():
                     lowered = str(item_id).strip().lower()
                     for alias in destination_aliases:
                         if alias and lowered.startswith(alias + "_"):
-                            print(f"  ✓ Match by ID prefix: {item_id} starts with {alias}_")
+                            logger.debug("Match by ID prefix: %s starts with %s_", item_id, alias)
                             return True
 
                 return False
@@ -2012,121 +2833,79 @@ def bulk_save_costs():
             version_filtered_costs = normalized_existing_costs
 
             version_filtered_costs.extend(cost_items)
+            _normalize_cost_amounts(version_filtered_costs)
 
+            # Different lengths always mean a change; otherwise compare digests of the
+            # costs actually stored. A digest saved alongside the version would go stale,
+            # since the web client and cleanup_ai_estimates edit costs in place.
+            unchanged = False
             try:
-                import json as _json
-
-                def _stable(obj):
-                    return _json.dumps(obj, sort_keys=True, separators=(",", ":"))
-
-                if _stable(version_costs) == _stable(version_filtered_costs):
-                    scenario_ref.update({
-                        'updatedAt': firestore.SERVER_TIMESTAMP,
-                    })
-                    print(f"ℹ️ No cost changes detected; skipped new version creation")
-                    # Sync local cache even when no change detected
-                    _apply_costs_to_local_store(destination_aliases, cost_items, scenario_id, secondary_identifiers=[session_id])
-                    return jsonify({
-                        'status': 'success',
-                        'message': 'No changes in costs; latest version left unchanged',
-                        'costs_saved': 0,
-                        'total_costs': len(version_filtered_costs),
-                        'storage': 'firestore'
-                    })
+                if len(version_costs) == len(version_filtered_costs):
+                    unchanged = _costs_fingerprint(version_costs) == _costs_fingerprint(version_filtered_costs)
             except Exception as _:
                 pass
 
-            new_version_number = max(int(current_version or 0), int(latest_version_data.get('versionNumber', 0) or 0)) + 1
-            new_version_ref = scenario_ref.collection('versions').document()
-            new_itinerary_data = dict(itinerary_data)
-            new_itinerary_data['costs'] = version_filtered_costs
-
-            new_version_ref.set({
-                'versionNumber': new_version_number,
-                'versionName': '',
-                'isNamed': False,
-                'itineraryData': new_itinerary_data,
-                'createdAt': firestore.SERVER_TIMESTAMP,
-                'itineraryDataHash': None,
-                'isAutosave': True,
-            })
-
-            scenario_ref.update({
-                'currentVersion': new_version_number,
-                'updatedAt': firestore.SERVER_TIMESTAMP,
-            })
+            if unchanged:
+                scenario_ref.update({
+                    'updatedAt': firestore.SERVER_TIMESTAMP,
+                })
+                print(f"ℹ️ No cost changes detected; skipped new version creation")
+                # Sync local cache even when no change detected
+                _sync_local_store()
+                return {
+                    'status': 'success',
+                    'message': 'No changes in costs; latest version left unchanged',
+                    'costs_saved': 0,
+                    'total_costs': len(version_filtered_costs),
+                    'storage': 'firestore'
+                }, 200
+
+            new_version_number = _commit_new_version(
+                db, scenario_ref, scenario_data, latest_version_data, _replace_costs(version_filtered_costs),
+                scenario_fields=_cost_summary_fields(version_filtered_costs),
+            )
 
-            print(f"✅ Created new version v{new_version_number} with updated itineraryData")
+            print(f"✅ Queued new version v{new_version_number} with updated itineraryData")
             print(f"   Total costs in new version: {len(version_filtered_costs)}")
         else:
             print(f"⚠️ Warning: No versions found for scenario {scenario_id}; storing costs locally only.")
-            local_results = _apply_costs_to_local_store(
-                destination_aliases,
-                cost_items,
-                scenario_id,
-                secondary_identifiers=[session_id],
-            )
+            local_results = _sync_local_store()
             primary_stats = local_results.get(
                 scenario_id,
                 {'total_costs': len(cost_items), 'new_costs': len(cost_items)}
             )
             print(f"💽 Saved costs locally for scenario {scenario_id} (no Firestore version available)")
-            return jsonify({
+            return {
                 'status': 'success',
                 'message': f'Saved {primary_stats["new_costs"]} costs locally for {destination_name}',
                 'costs_saved': primary_stats['new_costs'],
                 'total_costs': primary_stats['total_costs'],
                 'storage': 'local'
-            })
-
-        try:
-            totals_by_category = {}
-            for item in version_filtered_costs:
-                cat = item.get('category', 'other')
-                totals_by_category[cat] = totals_by_category.get(cat, 0.0) + _to_float(item.get('amount_usd', 0))
-            scenario_ref.update({
-                'updatedAt': firestore.SERVER_TIMESTAMP,
-                'costsCount': len(version_filtered_costs),
-                'totalsByCategory': totals_by_category,
-            })
-            print(f"🧮 Updated scenario summary: {len(version_filtered_costs)} items")
-        except Exception as summary_error:
-            print(f"Warning: failed to update scenario summary: {summary_error}")
+            }, 200
 
         # Keep in-memory cache aligned with Firestore (best effort)
         try:
-            local_results = _apply_costs_to_local_store(
-                destination_aliases,
-                cost_items,
-                scenario_id,
-                secondary_identifiers=[session_id],
-            )
+            local_results = _sync_local_store()
             primary_stats = local_results.get(scenario_id, {'total_costs': len(version_filtered_costs), 'new_costs': len(cost_items)})
             print(f"💾 Synced in-memory tracker for scenario {scenario_id}: {primary_stats}")
         except Exception as sync_error:
             print(f"⚠️ Failed to sync in-memory tracker after Firestore save: {sync_error}")
 
-        return jsonify({
+        return {
             'status': 'success',
             'message': f'Saved {len(cost_items)} costs for {destination_name}',
             'costs_saved': len(cost_items),
             'total_costs': len(version_filtered_costs),
             'storage': 'firestore'
-        })
+        }, 200
 
     except Exception as firestore_error:
-        import traceback
         error_details = traceback.format_exc()
         print(f"⚠️ Firestore save failed, switching to local storage: {firestore_error}")
         print(error_details)
 
         try:
-            local_results = _apply_costs_to_local_store(
-                destination_aliases,
-                cost_items,
-                scenario_id,
-                secondary_identifiers=[session_id],
-            )
+            local_results = _sync_local_store()
             primary_stats = local_results.get(
                 scenario_id,
                 {'total_costs': len(cost_items), 'new_costs': len(cost_items)}
@@ -2135,21 +2914,21 @@ def bulk_save_costs():
             message = f"Saved {primary_stats['new_costs']} costs locally for {destination_name} (offline mode)"
             print(f"💽 {message}")
 
-            return jsonify({
+            return {
                 'status': 'success',
                 'message': message,
                 'costs_saved': primary_stats['new_costs'],
                 'total_costs': primary_stats['total_costs'],
                 'storage': 'local'
-            })
+            }, 200
         except Exception as local_error:
             error_details = traceback.format_exc()
             print(f"Error in bulk-save endpoint (local fallback failed): {error_details}")
-            return jsonify({
+            return {
                 'status': 'error',
                 'error': str(local_error),
                 'error_details': error_details
-            }), 500
+            }, 500
 
 @app.route('/api/costs/bulk-update', methods=['PUT'])
 def bulk_update_costs():
@@ -2180,12 +2959,8 @@ def bulk_update_costs():
     print("\n" + "="*100)
     print("📝 BULK-UPDATE ENDPOINT CALLED")
     print("="*100)
-    import sys
-    sys.stdout.flush()
 
     try:
-        from google.cloud import firestore
-
         data = request.json
         session_id = data.get('session_id')
         scenario_id = session_id  # Using session_id as scenario_id for consistency
@@ -2195,7 +2970,6 @@ def bulk_update_costs():
         print(f"   Session ID: {session_id}")
         print(f"   Costs to update: {len(costs_to_update)}")
         print(f"   Cost being updated: {costs_to_update[0] if costs_to_update else 'none'}")
-        sys.stdout.flush()
 
         # Validate required fields
         if not session_id or not costs_to_update:
@@ -2208,8 +2982,8 @@ def bulk_update_costs():
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get current scenario
-        scenario_doc = scenario_ref.get()
+        # Get current scenario and its latest version
+        scenario_doc, versions = _read_scenario_and_latest_version(scenario_ref)
         if not scenario_doc.exists:
             return jsonify({
                 'status': 'error',
@@ -2218,15 +2992,6 @@ def bulk_update_costs():
 
         scenario_data = scenario_doc.to_dict()
 
-        # Get the latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
-
         if not versions:
             return jsonify({
                 'status': 'error',
@@ -2234,52 +2999,61 @@ def bulk_update_costs():
             }), 404
 
         latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
+        stored_version_data = versions[0].to_dict() or {}
+        latest_version_data = _with_pending_version(scenario_id, stored_version_data)
 
         # Get itineraryData from the version
         itinerary_data = latest_version_data.get('itineraryData', {}) or {}
         version_costs = itinerary_data.get('costs', []) or []
+        if latest_version_data is not stored_version_data:
+            # The queued payload still belongs to the background writer; merge into copies.
+            version_costs = [dict(cost) for cost in version_costs]
 
         print(f"📊 Total costs in database: {len(version_costs)}")
-        print(f"   First 3 costs from Firestore:")
-        for i, c in enumerate(version_costs[:3]):
-            print(f"      [{i}] id={c.get('id')}, dest={c.get('destination_id')}, cat={c.get('category')}")
 
         # Create a map of updated costs by ID for quick lookup
-        updates_by_id = {cost['id']: cost for cost in costs_to_update}
-        print(f"🔧 Updates to apply (by ID):")
-        for cost_id in list(updates_by_id.keys())[:3]:
-            print(f"      {cost_id}")
-
-        # Also create a fallback map by destination_id + category for costs without IDs
-        updates_by_dest_cat = {}
-        for cost in costs_to_update:
-            key = f"{cost.get('destination_id')}_{cost.get('category')}"
-            updates_by_dest_cat[key] = cost
-
-        # Update costs in place
+        updates_by_id = {cost['id']: cost for cost in costs_to_update if cost.get('id')}
+
+        # Fallback map by destination_id + category, only needed for updates without IDs
+        need_fallback = len(updates_by_id) < len(costs_to_update)
+        updates_by_dest_cat = {
+            (cost.get('destination_id'), cost.get('category')): cost
+            for cost in costs_to_update if not cost.get('id')
+        } if need_fallback else {}
+
+        # Merge updates into the stored cost dicts in place. ID matches go through an
+        # index so the common case is O(updates) rather than a scan of every cost.
+        debug_merge = logger.isEnabledFor(logging.DEBUG)
         updated_count = 0
-        updated_costs = []
-        for cost in version_costs:
-            cost_id = cost.get('id')
-
-            # Try to find update by ID first
-            if cost_id and cost_id in updates_by_id:
-                # Merge updates into existing cost, preserving the ID
-                updated_cost = {**cost, **updates_by_id[cost_id]}
-                updated_costs.append(updated_cost)
-                updated_count += 1
-                print(f"  ✓ Updated cost by ID: {cost_id} - {updated_cost.get('category')} ${updated_cost.get('amount_usd', 0)}")
-            else:
-                # Fallback: try to match by destination_id + category
-                fallback_key = f"{cost.get('destination_id')}_{cost.get('category')}"
-                if fallback_key in updates_by_dest_cat:
-                    updated_cost = {**cost, **updates_by_dest_cat[fallback_key]}
-                    updated_costs.append(updated_cost)
+        id_index = _index_costs_by_id(version_costs)
+        matched_indexes = set()
+        for cost_id, update in updates_by_id.items():
+            i = id_index.get(cost_id)
+            if i is None:
+                continue
+            version_costs[i].update(update)
+            matched_indexes.add(i)
+            updated_count += 1
+            if debug_merge:
+                logger.debug("Updated cost by ID: %s - %s $%s", cost_id, update.get('category'), update.get('amount_usd', 0))
+
+        # Single pass over every cost: apply the dest+category fallback for updates
+        # without IDs, coerce amounts to floats and accumulate the category totals.
+        totals_by_category = {}
+        for i, cost in enumerate(version_costs):
+            if need_fallback and i not in matched_indexes:
+                update = updates_by_dest_cat.get((cost.get('destination_id'), cost.get('category')))
+                if update is not None:
+                    cost.update(update)
                     updated_count += 1
-                    print(f"  ✓ Updated cost by dest+cat: {fallback_key} - {updated_cost.get('category')} ${updated_cost.get('amount_usd', 0)}")
-                else:
-                    updated_costs.append(cost)
+                    if debug_merge:
+                        logger.debug("Updated cost by dest+cat: %s - %s $%s", cost.get('id'), cost.get('category'), cost.get('amount_usd', 0))
+            for key in ('amount', 'amount_usd'):
+                if key in cost and type(cost[key]) is not float:
+                    cost[key] = _to_float(cost[key])
+            cat = cost.get('category') or 'other'
+            totals_by_category[cat] = totals_by_category.get(cat, 0.0) + cost.get('amount_usd', 0.0)
+        updated_costs = version_costs
 
         if updated_count == 0:
             print(f"⚠️ Warning: No costs were updated")
@@ -2289,46 +3063,15 @@ def bulk_update_costs():
                 'updated_count': 0
             })
 
-        # Create a new version with updated costs
-        new_version_number = max(int(scenario_data.get('currentVersion', 0) or 0), int(latest_version_data.get('versionNumber', 0) or 0)) + 1
-        new_version_ref = scenario_ref.collection('versions').document()
-        new_itinerary_data = dict(itinerary_data)
-        new_itinerary_data['costs'] = updated_costs
-
-        new_version_ref.set({
-            'versionNumber': new_version_number,
-            'versionName': '',
-            'isNamed': False,
-            'itineraryData': new_itinerary_data,
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'itineraryDataHash': None,
-            'isAutosave': True,
-        })
-
-        # Update scenario's currentVersion
-        scenario_ref.update({
-            'currentVersion': new_version_number,
-            'updatedAt': firestore.SERVER_TIMESTAMP,
-        })
+        # Queue the new version together with currentVersion and the cost summary
+        new_version_number = _commit_new_version(
+            db, scenario_ref, scenario_data, latest_version_data, _replace_costs(updated_costs),
+            scenario_fields=_cost_summary_fields(updated_costs, totals_by_category),
+        )
 
-        print(f"✅ Created new version v{new_version_number} with {updated_count} updated costs")
+        print(f"✅ Queued new version v{new_version_number} with {updated_count} updated costs")
         print(f"   Total costs in new version: {len(updated_costs)}")
 
-        # Update lightweight snapshot summary on the scenario document
-        try:
-            totals_by_category = {}
-            for item in updated_costs:
-                cat = item.get('category', 'other')
-                totals_by_category[cat] = totals_by_category.get(cat, 0.0) + _to_float(item.get('amount_usd', 0))
-            scenario_ref.update({
-                'updatedAt': firestore.SERVER_TIMESTAMP,
-                'costsCount': len(updated_costs),
-                'totalsByCategory': totals_by_category,
-            })
-            print(f"🧮 Updated scenario summary: {len(updated_costs)} items")
-        except Exception as e:
-            print(f"Warning: failed to update scenario summary: {e}")
-
         return jsonify({
             'status': 'success',
             'message': f'Updated {updated_count} cost(s)',
@@ -2337,7 +3080,6 @@ def bulk_update_costs():
         })
 
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"Error in bulk-update endpoint: {error_details}")
         return jsonify({
@@ -2354,8 +3096,6 @@ def get_working_data():
     Returns: {'locations': [...], 'itineraryData': {...}}
     """
     try:
-        from google.cloud import firestore
-
         session_id = request.args.get('session_id') or request.args.get('scenario_id')
 
         if not session_id:
@@ -2389,7 +3129,6 @@ def get_working_data():
 
     except Exception as e:
         print(f"Error fetching working data: {str(e)}")
-        import traceback
         traceback.print_exc()
         # Return empty data instead of error to allow graceful degradation
         return jsonify({'locations': [], 'itineraryData': {}}), 200
@@ -2427,7 +3166,7 @@ def generate_summary():
 
         # Call the summary generator tool directly
         result = gen_summary_tool(
-            itinerary_json=json.dumps(itinerary_data),
+            itinerary_json=_json_dumps(itinerary_data),
             tool_context=None  # We're passing data directly as JSON
         )
 
@@ -2468,7 +3207,6 @@ def generate_summary():
             return jsonify(response), status_code
 
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"Error in summary generation endpoint: {error_details}")
         return jsonify({
@@ -2552,7 +3290,7 @@ For each category, provide low/mid/high estimates with sources.
         # Create or get session
         session_endpoint = f"{ADK_API_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
         try:
-            session_resp = requests.post(session_endpoint)
+            session_resp = http_session.post(session_endpoint)
             if session_resp.status_code != 200:
                 print(f"Warning: Session creation response: {session_resp.status_code}")
         except Exception as e:
@@ -2588,26 +3326,34 @@ For each category, provide low/mid/high estimates with sources.
         }
 
         research_result = None
-        response_text = ""
+        response_parts = []
         save_tool_called = False
         cost_items_created = []  # Track cost items for response
 
+        # The same payload string often shows up in both the tool call and its response.
+        coerced_payloads = {}
+
         def _coerce_json(value):
             """Convert ADK tool payloads that may arrive as JSON strings into dicts."""
             if isinstance(value, dict):
                 return value
             if isinstance(value, str):
+                if value in coerced_payloads:
+                    return coerced_payloads[value]
                 candidate = value.strip()
                 if not candidate:
                     return {}
                 try:
-                    return json.loads(candidate)
+                    result = _json_loads(candidate)
                 except json.JSONDecodeError:
-                    # Some tool payloads arrive double-encoded (e.g. {"json": "{...}"})
+                    # Some tool payloads arrive as Python reprs ({'a': "don't"}); parse
+                    # them as literals rather than rewriting quotes, which breaks apostrophes.
                     try:
-                        return json.loads(candidate.replace("'", '"'))
+                        result = ast.literal_eval(candidate)
                     except Exception:
-                        return {"__raw__": value}
+                        result = {"__raw__": value}
+                coerced_payloads[value] = result
+                return result
             return value or {}
 
         def _extract_research_from_args(raw_args):
@@ -2633,20 +3379,20 @@ For each category, provide low/mid/high estimates with sources.
                 or tool_call.get("arguments")
                 or tool_call.get("input")
             )
-            print(f"[DEBUG] _handle_tool_call: tool_name={tool_name}, raw_args type={type(raw_args)}")
+            logger.debug("_handle_tool_call: tool_name=%s, raw_args type=%s", tool_name, type(raw_args))
             if tool_name == "save_researched_costs":
                 save_tool_called = True
                 candidate = _extract_research_from_args(raw_args)
                 if isinstance(candidate, dict):
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from save_researched_costs, keys: {research_result.keys()}")
+                    logger.debug("Set research_result from save_researched_costs, keys: %s", research_result.keys())
             elif tool_name == "DestinationCostResearch":
                 candidate = _extract_research_from_args(raw_args)
-                print(f"[DEBUG] DestinationCostResearch candidate type: {type(candidate)}, is_dict: {isinstance(candidate, dict)}")
+                logger.debug("DestinationCostResearch candidate type: %s", type(candidate))
                 if isinstance(candidate, dict):
-                    print(f"[DEBUG] Candidate keys: {candidate.keys()}")
+                    logger.debug("Candidate keys: %s", candidate.keys())
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from DestinationCostResearch tool call")
+                    logger.debug("Set research_result from DestinationCostResearch tool call")
 
         def _handle_tool_response(tool_resp):
             nonlocal research_result, save_tool_called
@@ -2659,14 +3405,13 @@ For each category, provide low/mid/high estimates with sources.
                 or tool_resp.get("result")
                 or tool_resp.get("data")
             )
-            print(f"[DEBUG] _handle_tool_response: tool_name={tool_name}, payload type before coerce={type(payload)}")
+            logger.debug("_handle_tool_response: tool_name=%s, payload type before coerce=%s", tool_name, type(payload))
             payload = _coerce_json(payload)
-            print(f"[DEBUG] _handle_tool_response: payload type after coerce={type(payload)}, is_dict={isinstance(payload, dict)}")
-            if isinstance(payload, dict):
-                print(f"[DEBUG] Payload keys: {payload.keys()}")
+            logger.debug("_handle_tool_response: payload type after coerce=%s", type(payload))
             if not isinstance(payload, dict):
-                print(f"[DEBUG] Payload is not a dict, returning")
+                logger.debug("Payload is not a dict, returning")
                 return
+            logger.debug("Payload keys: %s", payload.keys())
 
             if tool_name == "save_researched_costs":
                 save_tool_called = True
@@ -2677,89 +3422,81 @@ For each category, provide low/mid/high estimates with sources.
                 )
                 if isinstance(candidate, dict):
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from save_researched_costs response")
+                    logger.debug("Set research_result from save_researched_costs response")
             elif tool_name == "DestinationCostResearch":
                 candidate = (
                     payload.get("research_data")
                     or payload.get("researchData")
                     or payload
                 )
-                print(f"[DEBUG] DestinationCostResearch response candidate type: {type(candidate)}, is_dict: {isinstance(candidate, dict)}")
+                logger.debug("DestinationCostResearch response candidate type: %s", type(candidate))
                 if isinstance(candidate, dict):
-                    print(f"[DEBUG] Candidate keys: {candidate.keys()}")
+                    logger.debug("Candidate keys: %s", candidate.keys())
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from DestinationCostResearch tool response")
+                    logger.debug("Set research_result from DestinationCostResearch tool response")
 
-        with requests.post(
+        with http_session.post(
             run_endpoint,
-            data=json.dumps(adk_payload),
+            data=_json_dumps(adk_payload),
             headers=headers,
             stream=True,
             timeout=180  # Cost research may take longer due to multiple searches
         ) as r:
-            for chunk in r.iter_lines():
+            for chunk in r.iter_lines(chunk_size=SSE_CHUNK_SIZE):
                 if not chunk:
                     continue
-                json_string = chunk.decode("utf-8").removeprefix("data: ").strip()
+                json_string = chunk.removeprefix(b"data: ").strip()
                 try:
-                    event = json.loads(json_string)
-
-                    # DEBUG: Print all events to understand structure
-                    print(f"[DEBUG] Received event keys: {event.keys()}")
+                    event = _json_loads(json_string)
+                    logger.debug("Received event keys: %s", list(event.keys()))
 
                     # Extract text responses
                     if "content" in event and "parts" in event["content"]:
                         for part in event["content"]["parts"]:
                             if "text" in part:
-                                response_text += part["text"]
+                                response_parts.append(part["text"])
 
                             # Check if save_researched_costs tool was called
                             func_call = part.get("function_call") or part.get("functionCall")
                             if func_call:
-                                print(f"[DEBUG] Found function_call in part: {func_call.get('name')}")
+                                logger.debug("Found function_call in part: %s", func_call.get('name'))
                                 _handle_tool_call(func_call)
 
                             # Also check function responses for save confirmation
                             func_resp = part.get("function_response") or part.get("functionResponse")
                             if func_resp:
-                                print(f"[DEBUG] Found function_response in part: {func_resp.get('name')}")
-                                print(f"[DEBUG] Response payload keys: {func_resp.get('response', {}).keys() if isinstance(func_resp.get('response'), dict) else 'not a dict'}")
+                                logger.debug("Found function_response in part: %s", func_resp.get('name'))
                                 _handle_tool_response(func_resp)
 
                     # Some ADK responses surface tool calls at the top level rather than within content.
                     top_level_call = event.get("function_call") or event.get("functionCall")
                     if top_level_call:
-                        print(f"[DEBUG] Found top_level function_call: {top_level_call.get('name')}")
+                        logger.debug("Found top_level function_call: %s", top_level_call.get('name'))
                         _handle_tool_call(top_level_call)
 
                     top_level_response = event.get("function_response") or event.get("functionResponse")
                     if top_level_response:
-                        print(f"[DEBUG] Found top_level function_response: {top_level_response.get('name')}")
+                        logger.debug("Found top_level function_response: %s", top_level_response.get('name'))
                         _handle_tool_response(top_level_response)
 
                 except json.JSONDecodeError:
                     continue
 
+        response_text = ''.join(response_parts)
+
         # Try to extract JSON from response_text if we don't have structured data
-        print(f"[DEBUG] After streaming: research_result is {'SET' if research_result else 'NOT SET'}")
-        print(f"[DEBUG] After streaming: save_tool_called={save_tool_called}")
+        logger.debug("After streaming: research_result is %s, save_tool_called=%s", 'SET' if research_result else 'NOT SET', save_tool_called)
         if not research_result and response_text:
-            print(f"[DEBUG] Attempting to extract JSON from response_text (length={len(response_text)})")
+            logger.debug("Attempting to extract JSON from response_text (length=%d)", len(response_text))
             # Look for JSON in the response text
-            import re
-            json_match = re.search(r'\{[\s\S]*"destination_name"[\s\S]*\}', response_text)
-            if json_match:
-                try:
-                    research_result = json.loads(json_match.group())
-                    print(f"✅ Extracted JSON from response text")
-                except:
-                    print(f"[DEBUG] Failed to parse JSON from response_text")
-                    pass
+            research_result = _extract_json_object(response_text, 'destination_name')
+            if research_result:
+                print(f"✅ Extracted JSON from response text")
             else:
-                print(f"[DEBUG] No JSON pattern found in response_text")
+                logger.debug("No parseable JSON object found in response_text")
 
         # Alternative C: If we have structured research JSON but no save tool call,
-        # save the data server-side via /api/costs/bulk-save and also generate a
+        # save the data server-side via save_destination_costs and also generate a
         # concise human summary using the root agent.
         saved_via_server = False
         summary_text = None
@@ -2767,22 +3504,26 @@ For each category, provide low/mid/high estimates with sources.
         if research_result and not save_tool_called:
             try:
                 # Build cost_items similar to save_researched_costs tool
-                # NOTE: 'flights' removed - inter-destination flights tracked via TransportSegment
-                categories_map = {
-                    'accommodation': 'accommodation',
-                    'activities': 'activity',
-                    'food_daily': 'food',
-                    'transport_daily': 'transport'  # Local transport only
-                }
-
+                stable_dest = destination_name.lower().translate(_STABLE_DEST_TRANSLATION)
+                # One timestamp for the whole batch
+                now = datetime.now()
+                today_str = now.strftime("%Y-%m-%d")
+                now_iso = now.isoformat()
+                # Per-destination pieces shared by every item
+                id_prefix = f"{destination_id}_{stable_dest}_"
+                desc_suffix = f" in {destination_name}"
+                per_day_multiplier = max(1, int(duration_days)) * max(1, int(num_travelers))
                 cost_items = []
-                for research_cat, itinerary_cat in categories_map.items():
+                for research_cat, itinerary_cat in _RESEARCH_COST_CATEGORIES:
                     if research_cat not in research_result:
                         continue
                     cat_data = research_result.get(research_cat) or {}
 
-                    base_usd = _to_float(cat_data.get('amount_mid', 0))
-                    base_local = _to_float(cat_data.get('amount_local', 0))
+                    # Parsed JSON decimals are already floats; only other shapes need coercion
+                    amount_mid = cat_data.get('amount_mid', 0)
+                    base_usd = amount_mid if type(amount_mid) is float else _to_float(amount_mid)
+                    amount_local_raw = cat_data.get('amount_local', 0)
+                    base_local = amount_local_raw if type(amount_local_raw) is float else _to_float(amount_local_raw)
                     currency_local = cat_data.get('currency_local', 'USD')
 
                     # Scale per category semantics:
@@ -2790,100 +3531,95 @@ For each category, provide low/mid/high estimates with sources.
                     # - accommodation, activities: totals for stay → no scaling
                     multiplier = 1
                     if research_cat in ('food_daily', 'transport_daily'):
-                        multiplier = max(1, int(duration_days)) * max(1, int(num_travelers))
+                        multiplier = per_day_multiplier
 
                     amount_usd = base_usd * multiplier
                     amount_local = base_local * multiplier if base_local else amount_usd
 
-                    stable_dest = (
-                        destination_name.lower()
-                        .replace(' ', '_')
-                        .replace(',', '')
-                        .replace('/', '-')
-                        .replace(':', '-')
-                    )
-
                     cost_items.append({
-                        'id': f"{destination_id}_{stable_dest}_{itinerary_cat}",
+                        'id': id_prefix + itinerary_cat,
                         'category': itinerary_cat,
-                        'description': f"{cat_data.get('category', research_cat).title()} in {destination_name}",
+                        'description': cat_data.get('category', research_cat).title() + desc_suffix,
                         'amount': amount_local,
                         'currency': currency_local,
                         'amount_usd': amount_usd,
-                        'date': datetime.now().strftime("%Y-%m-%d"),
+                        'date': today_str,
                         'destination_id': destination_id,
                         'booking_status': 'researched',
                         'source': 'web_research',
                         'notes': cat_data.get('notes', ''),
                         'confidence': cat_data.get('confidence', 'medium'),
                         'sources': cat_data.get('sources', []),
-                        'researched_at': cat_data.get('researched_at', datetime.now().isoformat()),
+                        'researched_at': cat_data.get('researched_at', now_iso),
                     })
 
                 # Store cost_items for response
                 cost_items_created = cost_items
 
-                # Save to Firestore via our own endpoint (Flask runs on port 5001)
-                try:
-                    save_resp = requests.post(
-                        "http://127.0.0.1:5001/api/costs/bulk-save",
-                        json={
+                # Ask root agent to summarize for the chat response. The summary only
+                # reads research_result, so it streams while the save below runs.
+                def _summarize_research():
+                    try:
+                        summary_prompt = (
+                            f"Summarize these researched costs for {destination_name} in 3-5 sentences "
+                            f"for a family of {num_travelers} traveling {duration_days} days. "
+                            f"Focus on total, per-day, and major categories.\n\n" 
+                            f"JSON:\n{_json_dumps(research_result)}"
+                        )
+                        run_payload = {
                             'session_id': session_id,
-                            'scenario_id': scenario_id,
-                            'destination_id': destination_id,
-                            'destination_name': destination_name,
-                            'cost_items': cost_items,
-                        },
-                        timeout=30,
-                    )
-                    saved_via_server = save_resp.status_code == 200
+                            'app_name': APP_NAME,
+                            'user_id': USER_ID,
+                            'agent_name': 'root_agent',
+                            'new_message': {
+                                'role': 'user',
+                                'parts': [{'text': summary_prompt}],
+                            },
+                        }
+                        with http_session.post(
+                            run_endpoint,
+                            data=_json_dumps(run_payload),
+                            headers=headers,
+                            stream=True,
+                            timeout=60,
+                        ) as r2:
+                            summary_parts = []
+                            for chunk in r2.iter_lines(chunk_size=SSE_CHUNK_SIZE):
+                                if not chunk:
+                                    continue
+                                s = chunk.removeprefix(b'data: ').strip()
+                                try:
+                                    ev = _json_loads(s)
+                                except json.JSONDecodeError:
+                                    continue
+                                content = ev.get('content') if isinstance(ev, dict) else None
+                                if content and 'parts' in content:
+                                    summary_parts.extend(p['text'] for p in content['parts'] if 'text' in p)
+                            return ''.join(summary_parts) or None
+                    except Exception:
+                        return None
+
+                summary_future = summary_pool.submit(_summarize_research)
+
+                # Save to Firestore in-process (same logic as the bulk-save route)
+                try:
+                    save_payload, save_status = save_destination_costs({
+                        'session_id': session_id,
+                        'scenario_id': scenario_id,
+                        'destination_id': destination_id,
+                        'destination_name': destination_name,
+                        'cost_items': cost_items,
+                    })
+                    saved_via_server = save_status == 200
                     if saved_via_server:
-                        print(f"✅ Server-side save successful via bulk-save API")
+                        print(f"✅ Server-side save successful")
                     else:
-                        print(f"⚠️ Server-side save failed: {save_resp.status_code} {save_resp.text[:200]}")
+                        print(f"⚠️ Server-side save failed: {save_status} {str(save_payload)[:200]}")
                 except Exception as e:
                     print(f"⚠️ Exception during server-side save: {e}")
                     saved_via_server = False
 
-                # Ask root agent to summarize for the chat response
-                try:
-                    summary_prompt = (
-                        f"Summarize these researched costs for {destination_name} in 3-5 sentences "
-                        f"for a family of {num_travelers} traveling {duration_days} days. "
-                        f"Focus on total, per-day, and major categories.\n\n" 
-                        f"JSON:\n{json.dumps(research_result)}"
-                    )
-                    run_payload = {
-                        'session_id': session_id,
-                        'app_name': APP_NAME,
-                        'user_id': USER_ID,
-                        'agent_name': 'root_agent',
-                        'new_message': {
-                            'role': 'user',
-                            'parts': [{'text': summary_prompt}],
-                        },
-                    }
-                    with requests.post(
-                        run_endpoint,
-                        data=json.dumps(run_payload),
-                        headers=headers,
-                        stream=True,
-                        timeout=60,
-                    ) as r2:
-                        for chunk in r2.iter_lines():
-                            if not chunk:
-                                continue
-                            s = chunk.decode('utf-8').removeprefix('data: ').strip()
-                            try:
-                                ev = json.loads(s)
-                                if 'content' in ev and 'parts' in ev['content']:
-                                    for p in ev['content']['parts']:
-                                        if 'text' in p:
-                                            summary_text = (summary_text or '') + p['text']
-                            except json.JSONDecodeError:
-                                continue
-                except Exception:
-                    summary_text = None
+                summary_text = summary_future.result()
 
             except Exception as e:
                 print(f"Error during server-side save of research JSON: {e}")
@@ -2912,7 +3648,6 @@ For each category, provide low/mid/high estimates with sources.
             'error': 'Cost research timed out. This process can take 2-3 minutes due to extensive web searches.'
         }), 504
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"Error in cost research endpoint: {error_details}")
         return jsonify({
@@ -2940,14 +3675,15 @@ def index():
 @app.route('/<path:path>')
 def serve_static(path):
     """Serve static files from web directory"""
+    # Unmatched API paths never map to web files, so skip the filesystem check
+    if path.startswith('api/'):
+        return jsonify({'error': 'Not found', 'path': path}), 404
     try:
         # Only serve files that actually exist
         file_path = os.path.join(WEB_DIR, path)
         if os.path.isfile(file_path):
             return send_from_directory(WEB_DIR, path)
-        # If path doesn't exist and doesn't start with /api, return 404
-        if not path.startswith('api/'):
-            return jsonify({'error': 'File not found', 'path': path}), 404
+        return jsonify({'error': 'File not found', 'path': path}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
@@ -2972,8 +3708,6 @@ def resolve_place():
     }
     """
     try:
-        from travel_concierge.tools.place_resolver import get_place_resolver
-
         data = request.get_json() or {}
         query = data.get('query')
         location_type = data.get('location_type')
@@ -2997,7 +3731,6 @@ def resolve_place():
 
     except Exception as e:
         print(f"❌ Place resolution error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -3022,8 +3755,6 @@ def batch_resolve_places():
     }
     """
     try:
-        from travel_concierge.tools.place_resolver import get_place_resolver
-
         data = request.get_json() or {}
         queries = data.get('queries', [])
 
@@ -3040,7 +3771,6 @@ def batch_resolve_places():
 
     except Exception as e:
         print(f"❌ Batch resolution error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -3052,8 +3782,6 @@ def get_place_details(place_id):
     Usage: GET /api/places/details/ChIJ...
     """
     try:
-        from travel_concierge.tools.place_resolver import get_place_resolver
-
         resolver = get_place_resolver()
         details = resolver.get_place_details(place_id)
 
@@ -3079,8 +3807,6 @@ def cleanup_ai_estimates():
     This helps clean up legacy costs that weren't properly removed.
     """
     try:
-        from google.cloud import firestore
-
         data = request.get_json() or {}
         scenario_id = data.get('scenario_id')
 
@@ -3096,63 +3822,42 @@ def cleanup_ai_estimates():
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
+        cleanup_counts = {}
 
-        if not versions:
+        def _remove_ai_estimates(itinerary_data):
+            version_costs = itinerary_data.get('costs', []) or []
+            # Filter out ai_estimate costs
+            cleaned_costs = [cost for cost in version_costs if cost.get('source') != 'ai_estimate']
+            cleanup_counts.update(
+                before=len(version_costs),
+                removed=len(version_costs) - len(cleaned_costs),
+                remaining=len(cleaned_costs),
+            )
+            if not cleanup_counts['removed']:
+                return None
+            itinerary_data['costs'] = cleaned_costs
+            return True
+
+        # Read and write in one transaction so a concurrent cost edit is not overwritten
+        version_found, _ = _mutate_latest_version(db, scenario_ref, ('costs',), _remove_ai_estimates)
+        if not version_found:
             return jsonify({'error': 'No versions found'}), 404
+        removed_count = cleanup_counts['removed']
 
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-
-        # Get costs
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
-        version_costs = itinerary_data.get('costs', []) or []
-
-        print(f"📊 Total costs before cleanup: {len(version_costs)}")
-
-        # Filter out ai_estimate costs
-        cleaned_costs = []
-        removed_costs = []
-
-        for cost in version_costs:
-            source = cost.get('source')
-            booking_status = cost.get('booking_status', 'estimated')
-
-            # Remove if ai_estimate source
-            if source == 'ai_estimate':
-                removed_costs.append(cost)
-                print(f"  🗑️  Removing ai_estimate: {cost.get('category')} - {cost.get('description', 'N/A')[:50]} (${cost.get('amount_usd', 0)})")
-            else:
-                cleaned_costs.append(cost)
-
-        print(f"🧹 Removed {len(removed_costs)} ai_estimate costs")
-        print(f"✅ Kept {len(cleaned_costs)} costs")
-
-        # Update Firestore
-        itinerary_data['costs'] = cleaned_costs
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
+        print(f"📊 Total costs before cleanup: {cleanup_counts['before']}")
+        print(f"🧹 Removed {removed_count} ai_estimate costs")
+        print(f"✅ Kept {cleanup_counts['remaining']} costs")
 
         print(f"✅ Cleanup complete!")
 
         return jsonify({
             'status': 'success',
-            'removed': len(removed_costs),
-            'remaining': len(cleaned_costs)
+            'removed': removed_count,
+            'remaining': cleanup_counts['remaining']
         })
 
     except Exception as e:
         print(f"❌ Cleanup error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -3161,6 +3866,76 @@ def cleanup_ai_estimates():
 # Transport Segment API Endpoints
 # ============================================================================
 
+# Segments stay embedded in itineraryData (the web client and version copies read
+# them from there); writes touch only this key of the itinerary. This is as narrow
+# as an edit can get: Firestore field paths cannot address array elements, and a
+# numeric path such as transport_segments.3.researched_cost_mid would rewrite the
+# array as a map.
+_TRANSPORT_SEGMENT_FIELDS = ('transport_segments',)
+
+# How long update-research holds its worker for the Firestore write before
+# answering 202 and finishing the write in the background.
+TRANSPORT_RESEARCH_WRITE_WAIT_SECONDS = float(os.environ.get('TRANSPORT_RESEARCH_WRITE_WAIT_SECONDS', '5'))
+
+# Segment change notifications kept per session; the oldest are dropped beyond this.
+MAX_PENDING_SEGMENT_CHANGES = 500
+
+# Segment fields a PUT may change
+_SEGMENT_UPDATABLE_FIELDS = (
+    'transport_mode',
+    'transport_mode_icon',
+    'estimated_cost_usd',
+    'researched_cost_low',
+    'researched_cost_mid',
+    'researched_cost_high',
+    'manual_cost_usd',
+    'actual_cost_usd',
+    'currency_local',
+    'amount_local',
+    'booking_status',
+    'confidence_level',
+    'research_sources',
+    'research_notes',
+    'researched_at',
+    'alternatives',
+    'booking_link',
+    'booking_reference',
+    'notes',
+    'duration_hours',
+)
+
+
+def _compact_research_list(items):
+    """Drop blank and repeated entries from an AI research list, keeping first-seen order."""
+    if not isinstance(items, list):
+        return []
+    compacted = []
+    seen = set()
+    for item in items:
+        if isinstance(item, str):
+            item = item.strip()
+            if not item:
+                continue
+            key = item
+        elif item is None:
+            continue
+        else:
+            key = _json_dumps(item)
+        if key in seen:
+            continue
+        seen.add(key)
+        compacted.append(item)
+    return compacted
+
+
+def _segment_index(transport_segments, segment_id):
+    """Return the list index of the segment with ``segment_id``, or None."""
+    return next(
+        (i for i, segment in enumerate(transport_segments) if segment.get('id') == segment_id),
+        None,
+    )
+
+
 @app.route('/api/transport-segments', methods=['GET'])
 def get_transport_segments():
     """
@@ -3168,44 +3943,38 @@ def get_transport_segments():
     Query params: scenario_id
     """
     try:
-        from google.cloud import firestore
-
         scenario_id = request.args.get('scenario_id')
-        print(f"🚗 GET /api/transport-segments - scenario_id: {scenario_id}")
+        logger.debug("GET /api/transport-segments - scenario_id: %s", scenario_id)
 
         if not scenario_id:
             return jsonify({'error': 'scenario_id required'}), 400
 
-        print("🔧 Creating Firestore client...")
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        print(f"📡 Querying Firestore for scenario: {scenario_id}")
-        # Get latest version
+        # Get latest version, projected onto the segments; one query, no scenario read
         versions = list(
             scenario_ref
                 .collection('versions')
                 .order_by('versionNumber', direction=firestore.Query.DESCENDING)
                 .limit(1)
+                .select(['versionNumber', 'itineraryData.transport_segments'])
                 .stream()
         )
-        print(f"✅ Query completed, found {len(versions)} versions")
 
         if not versions:
-            print("⚠️ No versions found, returning empty array")
+            logger.debug("No versions found for scenario %s, returning empty array", scenario_id)
             return jsonify({'transport_segments': []})
 
-        latest_version_data = versions[0].to_dict() or {}
+        latest_version_data = _with_pending_version(scenario_id, versions[0].to_dict() or {})
         itinerary_data = latest_version_data.get('itineraryData', {}) or {}
         transport_segments = itinerary_data.get('transport_segments', [])
 
-        print(f"✅ Returning {len(transport_segments)} transport segments")
+        logger.debug("Returning %d transport segments", len(transport_segments))
         return jsonify({'transport_segments': transport_segments})
 
     except Exception as e:
-        print(f"❌ Error fetching transport segments: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error fetching transport segments: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3216,14 +3985,14 @@ def create_transport_segment():
     Body: segment data + scenario_id
     """
     try:
-        from google.cloud import firestore
-
         data = request.get_json() or {}
         scenario_id = data.get('scenario_id')
 
         if not scenario_id:
             return jsonify({'error': 'scenario_id required'}), 400
 
+        now_iso = datetime.utcnow().isoformat()
+
         # Extract segment data
         segment = {
             'id': data.get('id') or str(uuid.uuid4()),
@@ -3253,47 +4022,29 @@ def create_transport_segment():
             'booking_reference': data.get('booking_reference'),
             'notes': data.get('notes'),
             'num_travelers': data.get('num_travelers', 3),
-            'created_at': datetime.utcnow().isoformat(),
-            'updated_at': datetime.utcnow().isoformat()
+            'created_at': now_iso,
+            'updated_at': now_iso
         }
 
         # Save to Firestore
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
+        def _add_segment(itinerary_data):
+            # Add segment to transport_segments array (created if the itinerary has none yet)
+            itinerary_data.setdefault('transport_segments', []).append(segment)
+            return segment
 
-        if not versions:
+        version_found, _ = _mutate_latest_version(
+            db, scenario_ref, _TRANSPORT_SEGMENT_FIELDS, _add_segment, now_iso=now_iso
+        )
+        if not version_found:
             return jsonify({'error': 'No versions found'}), 404
 
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
-
-        # Add segment to transport_segments array
-        transport_segments = itinerary_data.get('transport_segments', [])
-        transport_segments.append(segment)
-        itinerary_data['transport_segments'] = transport_segments
-
-        # Update Firestore
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
-
         return jsonify({'status': 'success', 'segment': segment})
 
     except Exception as e:
-        print(f"Error creating transport segment: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error creating transport segment: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3304,8 +4055,6 @@ def update_transport_segment(segment_id):
     Body: updated segment data + scenario_id
     """
     try:
-        from google.cloud import firestore
-
         data = request.get_json() or {}
         scenario_id = data.get('scenario_id')
 
@@ -3315,71 +4064,34 @@ def update_transport_segment(segment_id):
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
+        segment_patch = {field: data[field] for field in _SEGMENT_UPDATABLE_FIELDS if field in data}
+        now_iso = datetime.utcnow().isoformat()
 
-        if not versions:
-            return jsonify({'error': 'No versions found'}), 404
+        def _update_segment(itinerary_data):
+            transport_segments = itinerary_data.get('transport_segments', [])
 
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
-        transport_segments = itinerary_data.get('transport_segments', [])
+            index = _segment_index(transport_segments, segment_id)
+            if index is None:
+                return None
 
-        # Find and update the segment
-        segment_found = False
-        for i, segment in enumerate(transport_segments):
-            if segment.get('id') == segment_id:
-                # Update segment fields
-                segment.update({
-                    'transport_mode': data.get('transport_mode', segment.get('transport_mode')),
-                    'transport_mode_icon': data.get('transport_mode_icon', segment.get('transport_mode_icon')),
-                    'estimated_cost_usd': data.get('estimated_cost_usd', segment.get('estimated_cost_usd')),
-                    'researched_cost_low': data.get('researched_cost_low', segment.get('researched_cost_low')),
-                    'researched_cost_mid': data.get('researched_cost_mid', segment.get('researched_cost_mid')),
-                    'researched_cost_high': data.get('researched_cost_high', segment.get('researched_cost_high')),
-                    'manual_cost_usd': data.get('manual_cost_usd', segment.get('manual_cost_usd')),
-                    'actual_cost_usd': data.get('actual_cost_usd', segment.get('actual_cost_usd')),
-                    'currency_local': data.get('currency_local', segment.get('currency_local')),
-                    'amount_local': data.get('amount_local', segment.get('amount_local')),
-                    'booking_status': data.get('booking_status', segment.get('booking_status')),
-                    'confidence_level': data.get('confidence_level', segment.get('confidence_level')),
-                    'research_sources': data.get('research_sources', segment.get('research_sources', [])),
-                    'research_notes': data.get('research_notes', segment.get('research_notes')),
-                    'researched_at': data.get('researched_at', segment.get('researched_at')),
-                    'alternatives': data.get('alternatives', segment.get('alternatives', [])),
-                    'booking_link': data.get('booking_link', segment.get('booking_link')),
-                    'booking_reference': data.get('booking_reference', segment.get('booking_reference')),
-                    'notes': data.get('notes', segment.get('notes')),
-                    'duration_hours': data.get('duration_hours', segment.get('duration_hours')),
-                    'updated_at': datetime.utcnow().isoformat()
-                })
-                transport_segments[i] = segment
-                segment_found = True
-                break
+            # Update only the fields the client sent
+            segment = transport_segments[index]
+            segment.update(segment_patch)
+            segment['updated_at'] = now_iso
+            return segment
 
-        if not segment_found:
+        version_found, segment = _mutate_latest_version(
+            db, scenario_ref, _TRANSPORT_SEGMENT_FIELDS, _update_segment, now_iso=now_iso
+        )
+        if not version_found:
+            return jsonify({'error': 'No versions found'}), 404
+        if segment is None:
             return jsonify({'error': 'Segment not found'}), 404
 
-        # Update Firestore
-        itinerary_data['transport_segments'] = transport_segments
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
-
         return jsonify({'status': 'success', 'segment': segment})
 
     except Exception as e:
-        print(f"Error updating transport segment: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error updating transport segment: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3390,8 +4102,6 @@ def delete_transport_segment(segment_id):
     Query params: scenario_id
     """
     try:
-        from google.cloud import firestore
-
         scenario_id = request.args.get('scenario_id')
         if not scenario_id:
             return jsonify({'error': 'scenario_id required'}), 400
@@ -3399,42 +4109,27 @@ def delete_transport_segment(segment_id):
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
-
-        if not versions:
-            return jsonify({'error': 'No versions found'}), 404
+        def _remove_segment(itinerary_data):
+            transport_segments = itinerary_data.get('transport_segments', [])
 
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
-        transport_segments = itinerary_data.get('transport_segments', [])
+            index = _segment_index(transport_segments, segment_id)
+            if index is None:
+                return None
 
-        # Filter out the segment to delete
-        updated_segments = [s for s in transport_segments if s.get('id') != segment_id]
+            # The list is itinerary_data's own, so deleting in place is the edit
+            del transport_segments[index]
+            return True
 
-        if len(updated_segments) == len(transport_segments):
+        version_found, removed = _mutate_latest_version(db, scenario_ref, _TRANSPORT_SEGMENT_FIELDS, _remove_segment)
+        if not version_found:
+            return jsonify({'error': 'No versions found'}), 404
+        if removed is None:
             return jsonify({'error': 'Segment not found'}), 404
 
-        # Update Firestore
-        itinerary_data['transport_segments'] = updated_segments
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
-
         return jsonify({'status': 'success'})
 
     except Exception as e:
-        print(f"Error deleting transport segment: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error deleting transport segment: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3446,8 +4141,6 @@ def sync_transport_segments():
     Body: scenario_id
     """
     try:
-        from google.cloud import firestore
-
         data = request.get_json() or {}
         scenario_id = data.get('scenario_id')
 
@@ -3457,127 +4150,141 @@ def sync_transport_segments():
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
-
-        if not versions:
-            return jsonify({'error': 'No versions found'}), 404
-
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
-
-        locations = itinerary_data.get('locations', [])
-        existing_segments = itinerary_data.get('transport_segments', [])
-
-        # Build segment map for quick lookup
-        segment_map = {}
-        for segment in existing_segments:
-            key = f"{segment.get('from_destination_id')}_{segment.get('to_destination_id')}"
-            segment_map[key] = segment
-
-        # Create new segments list based on current location order
-        new_segments = []
-        for i in range(len(locations) - 1):
-            from_loc = locations[i]
-            to_loc = locations[i + 1]
-
-            key = f"{from_loc.get('id')}_{to_loc.get('id')}"
-
-            # Use existing segment if found, otherwise create new
-            if key in segment_map:
-                existing_seg = segment_map[key]
-                # Update estimates if segment has no researched cost and (no estimate or force_recalculate)
-                force_recalculate = data.get('force_recalculate', False)
-                needs_estimate = (
-                    not existing_seg.get('researched_cost_mid') and
-                    (force_recalculate or not existing_seg.get('estimated_cost_usd') or existing_seg.get('estimated_cost_usd') == 0)
-                )
-                if needs_estimate:
+        sync_summary = {}
+        force_recalculate = data.get('force_recalculate', False)
+        now_iso = datetime.utcnow().isoformat()
+
+        def _sync_segments(itinerary_data):
+            locations = itinerary_data.get('locations', [])
+            existing_segments = itinerary_data.get('transport_segments', [])
+            changed = False
+            kept = 0
+
+            # Build segment map for quick lookup
+            segment_map = {}
+            for segment in existing_segments:
+                key = f"{segment.get('from_destination_id')}_{segment.get('to_destination_id')}"
+                segment_map[key] = segment
+
+            # Create new segments list based on current location order
+            leg_distances = _leg_distances_km(locations)
+            new_segments = []
+            for i in range(len(locations) - 1):
+                from_loc = locations[i]
+                to_loc = locations[i + 1]
+
+                key = f"{from_loc.get('id')}_{to_loc.get('id')}"
+
+                # Use existing segment if found, otherwise create new
+                if key in segment_map:
+                    existing_seg = segment_map[key]
+                    kept += 1
+                    # Update estimates if segment has no researched cost and (no estimate or force_recalculate)
+                    needs_estimate = (
+                        not existing_seg.get('researched_cost_mid') and
+                        (force_recalculate or not existing_seg.get('estimated_cost_usd') or existing_seg.get('estimated_cost_usd') == 0)
+                    )
+                    if needs_estimate:
+                        distance = leg_distances[i]
+                        if distance is not None:
+                            same_country = from_loc.get('country') == to_loc.get('country')
+                            mode = get_transport_mode_for_distance(distance, same_country)
+                            estimate = {
+                                'distance_km': round(distance, 1),
+                                'transport_mode': mode,
+                                'transport_mode_icon': get_transport_icon(mode),
+                                'estimated_cost_usd': estimate_transport_cost(distance, mode, 3),
+                            }
+                            if any(existing_seg.get(k) != v for k, v in estimate.items()):
+                                existing_seg.update(estimate)
+                                changed = True
+                    new_segments.append(existing_seg)
+                else:
+                    # Calculate distance and estimate cost for new segment
                     from_coords = from_loc.get('coordinates', {})
                     to_coords = to_loc.get('coordinates', {})
-                    if from_coords and to_coords:
-                        distance = calculate_distance_km(
-                            from_coords.get('lat', 0), from_coords.get('lng', 0),
-                            to_coords.get('lat', 0), to_coords.get('lng', 0)
-                        )
-                        same_country = from_loc.get('country') == to_loc.get('country')
-                        mode = get_transport_mode_for_distance(distance, same_country)
-                        existing_seg['distance_km'] = round(distance, 1)
-                        existing_seg['transport_mode'] = mode
-                        existing_seg['transport_mode_icon'] = get_transport_icon(mode)
-                        existing_seg['estimated_cost_usd'] = estimate_transport_cost(distance, mode, 3)
-                new_segments.append(existing_seg)
-            else:
-                # Calculate distance and estimate cost for new segment
-                from_coords = from_loc.get('coordinates', {})
-                to_coords = to_loc.get('coordinates', {})
-                distance_km = 0
-                transport_mode = 'plane'
-                estimated_cost = 0
-
-                if from_coords and to_coords:
-                    from_lat = from_coords.get('lat', 0)
-                    from_lng = from_coords.get('lng', 0)
-                    to_lat = to_coords.get('lat', 0)
-                    to_lng = to_coords.get('lng', 0)
-
-                    if from_lat and from_lng and to_lat and to_lng:
-                        distance_km = round(calculate_distance_km(from_lat, from_lng, to_lat, to_lng), 1)
-                        same_country = from_loc.get('country') == to_loc.get('country')
-                        transport_mode = get_transport_mode_for_distance(distance_km, same_country)
-                        estimated_cost = estimate_transport_cost(distance_km, transport_mode, 3)
-
-                # Create new segment with calculated estimates
-                new_segment = {
-                    'id': str(uuid.uuid4()),
-                    'from_destination_id': from_loc.get('id'),
-                    'from_destination_name': from_loc.get('name', ''),
-                    'to_destination_id': to_loc.get('id'),
-                    'to_destination_name': to_loc.get('name', ''),
-                    'transport_mode': transport_mode,
-                    'transport_mode_icon': get_transport_icon(transport_mode),
-                    'distance_km': distance_km,
-                    'duration_hours': None,
-                    'estimated_cost_usd': estimated_cost,
-                    'booking_status': 'estimated',
-                    'confidence_level': 'low',
-                    'research_sources': [],
-                    'alternatives': [],
-                    'num_travelers': 3,
-                    'created_at': datetime.utcnow().isoformat(),
-                    'updated_at': datetime.utcnow().isoformat()
-                }
-                new_segments.append(new_segment)
+                    distance_km = 0
+                    transport_mode = 'plane'
+                    estimated_cost = 0
 
-        # Update Firestore
-        itinerary_data['transport_segments'] = new_segments
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
+                    if from_coords and to_coords:
+                        from_lat = from_coords.get('lat', 0)
+                        from_lng = from_coords.get('lng', 0)
+                        to_lat = to_coords.get('lat', 0)
+                        to_lng = to_coords.get('lng', 0)
+
+                        if from_lat and from_lng and to_lat and to_lng and leg_distances[i] is not None:
+                            distance_km = round(leg_distances[i], 1)
+                            same_country = from_loc.get('country') == to_loc.get('country')
+                            transport_mode = get_transport_mode_for_distance(distance_km, same_country)
+                            estimated_cost = estimate_transport_cost(distance_km, transport_mode, 3)
+
+                    # Create new segment with calculated estimates
+                    new_segment = {
+                        'id': str(uuid.uuid4()),
+                        'from_destination_id': from_loc.get('id'),
+                        'from_destination_name': from_loc.get('name', ''),
+                        'to_destination_id': to_loc.get('id'),
+                        'to_destination_name': to_loc.get('name', ''),
+                        'transport_mode': transport_mode,
+                        'transport_mode_icon': get_transport_icon(transport_mode),
+                        'distance_km': distance_km,
+                        'duration_hours': None,
+                        'estimated_cost_usd': estimated_cost,
+                        'booking_status': 'estimated',
+                        'confidence_level': 'low',
+                        'research_sources': [],
+                        'alternatives': [],
+                        'num_travelers': 3,
+                        'created_at': now_iso,
+                        'updated_at': now_iso
+                    }
+                    new_segments.append(new_segment)
+                    changed = True
+
+            sync_summary.update({
+                'transport_segments': new_segments,
+                'created': len(new_segments) - kept,
+                'kept': kept,
+                'removed': len(existing_segments) - kept
+            })
+            # Dropped or reordered segments also count as a change
+            if not changed and [id(s) for s in new_segments] == [id(s) for s in existing_segments]:
+                return None  # Already in sync; leave the version untouched
+            itinerary_data['transport_segments'] = new_segments
+            return sync_summary
+
+        version_found, _ = _mutate_latest_version(
+            db, scenario_ref, _TRANSPORT_SEGMENT_FIELDS, _sync_segments,
+            read_fields=('locations',), now_iso=now_iso,
+        )
+        if not version_found:
+            return jsonify({'error': 'No versions found'}), 404
 
-        return jsonify({
-            'status': 'success',
-            'transport_segments': new_segments,
-            'created': len([s for s in new_segments if s.get('id') not in [es.get('id') for es in existing_segments]]),
-            'kept': len([s for s in new_segments if s.get('id') in [es.get('id') for es in existing_segments]]),
-            'removed': len(existing_segments) - len([s for s in new_segments if s.get('id') in [es.get('id') for es in existing_segments]])
-        })
+        return jsonify({'status': 'success', **sync_summary})
 
     except Exception as e:
-        print(f"Error syncing transport segments: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error syncing transport segments: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
+# ADK events spell tool payload keys in both snake_case and camelCase, and the
+# argument/result payload itself may sit under any of several keys.
+_FUNCTION_CALL_KEYS = ('function_call', 'functionCall')
+_FUNCTION_RESPONSE_KEYS = ('function_response', 'functionResponse')
+_TOOL_ARG_KEYS = ('args', 'arguments', 'input')
+_TOOL_PAYLOAD_KEYS = ('response', 'result', 'data')
+
+
+def _first_value(mapping, keys):
+    """Return the first truthy ``mapping[key]`` for ``key`` in ``keys``, else None."""
+    for key in keys:
+        value = mapping.get(key)
+        if value:
+            return value
+    return None
+
+
 @app.route('/api/transport/research', methods=['POST'])
 def research_transport():
     """
@@ -3636,11 +4343,11 @@ Check ±3 days around the departure date for better pricing.
         # Create or get session
         session_endpoint = f"{ADK_API_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
         try:
-            session_resp = requests.post(session_endpoint)
+            session_resp = http_session.post(session_endpoint)
             if session_resp.status_code != 200:
-                print(f"Warning: Session creation response: {session_resp.status_code}")
+                logger.warning("Session creation response: %s", session_resp.status_code)
         except Exception as e:
-            print(f"Session creation warning: {e}")
+            logger.warning("Session creation warning: %s", e)
 
         # Prepare ADK payload to invoke transport_research_agent
         adk_payload = {
@@ -3658,7 +4365,7 @@ Check ±3 days around the departure date for better pricing.
             }
         }
 
-        print(f"🔍 Triggering transport research for: {from_destination_name} → {to_destination_name}")
+        logger.info("Triggering transport research for: %s → %s", from_destination_name, to_destination_name)
 
         # Call ADK API
         run_endpoint = f"{ADK_API_URL}/run_sse"
@@ -3668,7 +4375,7 @@ Check ±3 days around the departure date for better pricing.
         }
 
         research_result = None
-        response_text = ""
+        response_parts = []
 
         def _coerce_json(value):
             """Convert ADK tool payloads that may arrive as JSON strings into dicts."""
@@ -3679,10 +4386,11 @@ Check ±3 days around the departure date for better pricing.
                 if not candidate:
                     return {}
                 try:
-                    return json.loads(candidate)
+                    return _json_loads(candidate)
                 except json.JSONDecodeError:
+                    # Python-repr payloads: parse as literals instead of rewriting quotes.
                     try:
-                        return json.loads(candidate.replace("'", '"'))
+                        return ast.literal_eval(candidate)
                     except Exception:
                         return {"__raw__": value}
             return value or {}
@@ -3701,20 +4409,20 @@ Check ±3 days around the departure date for better pricing.
             if not tool_call:
                 return
             tool_name = tool_call.get("name")
-            raw_args = tool_call.get("args") or tool_call.get("arguments") or tool_call.get("input")
+            raw_args = _first_value(tool_call, _TOOL_ARG_KEYS)
 
             if tool_name == "TransportResearchResult":
                 candidate = _extract_research_from_args(raw_args)
                 if isinstance(candidate, dict):
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from TransportResearchResult tool call")
+                    logger.debug("Set research_result from TransportResearchResult tool call")
 
         def _handle_tool_response(tool_resp):
             nonlocal research_result
             if not tool_resp:
                 return
             tool_name = tool_resp.get("name")
-            payload = tool_resp.get("response") or tool_resp.get("result") or tool_resp.get("data")
+            payload = _first_value(tool_resp, _TOOL_PAYLOAD_KEYS)
             payload = _coerce_json(payload)
 
             if not isinstance(payload, dict):
@@ -3724,54 +4432,62 @@ Check ±3 days around the departure date for better pricing.
                 candidate = payload.get("research_data") or payload
                 if isinstance(candidate, dict):
                     research_result = candidate or research_result
-                    print(f"[DEBUG] Set research_result from TransportResearchResult tool response")
+                    logger.debug("Set research_result from TransportResearchResult tool response")
 
-        with requests.post(
+        with http_session.post(
             run_endpoint,
-            data=json.dumps(adk_payload),
+            data=_json_dumps(adk_payload),
             headers=headers,
             stream=True,
             timeout=180  # Transport research may take time due to multiple searches
         ) as r:
             event_count = 0
-            for chunk in r.iter_lines():
+            for chunk in r.iter_lines(chunk_size=SSE_CHUNK_SIZE):
                 if not chunk:
                     continue
-                json_string = chunk.decode("utf-8").removeprefix("data: ").strip()
+                json_string = chunk.removeprefix(b"data: ").strip()
                 try:
-                    event = json.loads(json_string)
+                    event = _json_loads(json_string)
                     event_count += 1
 
-                    # Log every 10th event and any that contain function calls/responses
-                    if event_count % 10 == 0 or any(key in str(event) for key in ['function_call', 'functionCall', 'function_response', 'functionResponse', 'TransportResearchResult']):
-                        print(f"[SSE Event {event_count}] Keys: {list(event.keys())}")
+                    saw_tool_payload = False
 
                     # Extract text responses
                     if "content" in event and "parts" in event["content"]:
                         for part in event["content"]["parts"]:
                             if "text" in part:
-                                response_text += part["text"]
+                                response_parts.append(part["text"])
 
-                            func_call = part.get("function_call") or part.get("functionCall")
+                            func_call = _first_value(part, _FUNCTION_CALL_KEYS)
                             if func_call:
+                                saw_tool_payload = True
                                 _handle_tool_call(func_call)
 
-                            func_resp = part.get("function_response") or part.get("functionResponse")
+                            func_resp = _first_value(part, _FUNCTION_RESPONSE_KEYS)
                             if func_resp:
+                                saw_tool_payload = True
                                 _handle_tool_response(func_resp)
 
                     # Check top level
-                    top_level_call = event.get("function_call") or event.get("functionCall")
+                    top_level_call = _first_value(event, _FUNCTION_CALL_KEYS)
                     if top_level_call:
+                        saw_tool_payload = True
                         _handle_tool_call(top_level_call)
 
-                    top_level_response = event.get("function_response") or event.get("functionResponse")
+                    top_level_response = _first_value(event, _FUNCTION_RESPONSE_KEYS)
                     if top_level_response:
+                        saw_tool_payload = True
                         _handle_tool_response(top_level_response)
 
+                    # Log every 10th event and any that carry function calls/responses
+                    if saw_tool_payload or event_count % 10 == 0:
+                        logger.debug("[SSE Event %d] Keys: %s", event_count, list(event.keys()))
+
                 except json.JSONDecodeError:
                     continue
 
+        response_text = ''.join(response_parts)
+
         if research_result:
             return jsonify({
                 'status': 'success',
@@ -3786,9 +4502,7 @@ Check ±3 days around the departure date for better pricing.
             }), 200
 
     except Exception as e:
-        print(f"Error researching transport: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error researching transport: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3804,110 +4518,153 @@ def update_transport_research():
         "research_data": { TransportResearchResult object }
     }
     """
+    segment_id = None
     try:
-        from google.cloud import firestore
-
         data = request.get_json() or {}
         session_id = data.get('session_id')
         segment_id = data.get('segment_id')
         research_data = data.get('research_data', {})
         scenario_id = data.get('scenario_id')  # Allow direct scenario_id in request
 
-        print(f"\n[UPDATE-RESEARCH] Received request:")
-        print(f"  session_id: {session_id}")
-        print(f"  segment_id: {segment_id}")
-        print(f"  scenario_id: {scenario_id}")
-        print(f"  research_data keys: {list(research_data.keys()) if research_data else 'None'}")
+        logger.debug(
+            "[UPDATE-RESEARCH] session_id=%s segment_id=%s scenario_id=%s research_data keys=%s",
+            session_id, segment_id, scenario_id, list(research_data) if research_data else None,
+        )
 
         if not segment_id or not research_data:
             return jsonify({'error': 'segment_id and research_data required'}), 400
+        if not isinstance(research_data, dict):
+            return jsonify({'error': 'research_data must be an object'}), 400
+        # Reject malformed research before any Firestore work
+        try:
+            research_data = TransportResearchUpdate.model_validate(research_data).model_dump(exclude_unset=True)
+        except ValidationError as e:
+            return jsonify({'error': 'Invalid research_data', 'details': e.errors(include_url=False, include_context=False)}), 400
+
+        # Sessions are optional: without a cached one the research is still saved,
+        # only the change notification for polling is skipped.
+        session_data = session_store.get_cached_session(session_id) if session_id else None
 
         # Get scenario_id from session cache if not provided directly
-        if not scenario_id and session_id:
-            session_data = session_store._session_cache.get(session_id, {})
+        if not scenario_id and session_data is not None:
             scenario_id = session_data.get('scenario_id')
-            print(f"  Retrieved scenario_id from session cache: {scenario_id}")
+            logger.debug("Retrieved scenario_id from session cache: %s", scenario_id)
 
         if not scenario_id:
             return jsonify({'error': 'No active scenario found. Please provide scenario_id or valid session_id.'}), 400
 
+        now_iso = _utcnow_iso()
+
         db = get_firestore_client()
         scenario_ref = db.collection('scenarios').document(scenario_id)
 
-        # Get latest version
-        versions = list(
-            scenario_ref
-                .collection('versions')
-                .order_by('versionNumber', direction=firestore.Query.DESCENDING)
-                .limit(1)
-                .stream()
-        )
+        transport_mode = research_data.get('transport_mode', 'plane')
+        research_fields = {
+            'transport_mode': transport_mode,
+            'transport_mode_icon': get_transport_icon(transport_mode),
+            'researched_cost_low': research_data.get('cost_low'),
+            'researched_cost_mid': research_data.get('cost_mid'),
+            'researched_cost_high': research_data.get('cost_high'),
+            'researched_duration_hours': research_data.get('typical_duration_hours'),
+            'researched_stops': research_data.get('typical_stops', 0),
+            'researched_airlines': _compact_research_list(research_data.get('airlines', [])),
+            'researched_alternatives': _compact_research_list(research_data.get('alternatives', [])),
+            'research_sources': _compact_research_list(research_data.get('sources', [])),
+            'research_notes': research_data.get('booking_tips', ''),
+            'booking_status': 'researched',
+            'confidence_level': research_data.get('confidence', 'medium'),
+            'auto_updated': True,
+        }
+        research_state = {'unchanged': False}
+
+        def _apply_research(itinerary_data):
+            transport_segments = itinerary_data.get('transport_segments', [])
+            research_state['unchanged'] = False
+
+            index = _segment_index(transport_segments, segment_id)
+            if index is None:
+                logger.warning("Segment %s not found in %d transport segments", segment_id, len(transport_segments))
+                return None
+
+            segment = transport_segments[index]
+            if all(segment.get(field) == value for field, value in research_fields.items()):
+                # Same research as already stored (e.g. a retried save); leave the version alone
+                research_state['unchanged'] = True
+                return None
+
+            # Update with research data
+            segment.update(research_fields)
+            segment['researched_at'] = now_iso  # Always use current time, not AI's date
+            segment['updated_at'] = now_iso
+            logger.debug(
+                "Updated segment %s from %s to %s: cost_mid=%s, %d airlines, %d alternatives",
+                segment_id, segment.get('from_name'), segment.get('to_name'),
+                segment['researched_cost_mid'], len(segment['researched_airlines']),
+                len(segment['researched_alternatives']),
+            )
+            return segment
 
-        if not versions:
-            return jsonify({'error': 'No versions found'}), 404
+        def _queue_change_notification(change_type='transport_segment_updated', **details):
+            if session_data is None:
+                logger.debug("No cached session %s; skipping change notification", session_id)
+                return
+            # Queue change for frontend polling
+            # Ephemeral notification: an integer epoch is enough to order it
+            change = {
+                'type': change_type,
+                'segment_id': segment_id,
+                **details,
+                'ts_ns': time.time_ns()
+            }
+            if session_store.append_pending_change(session_id, change, MAX_PENDING_SEGMENT_CHANGES):
+                logger.debug("Queued change notification for session %s", session_id)
+            else:
+                logger.warning("Session %s not found in cache - polling may not detect change", session_id)
 
-        latest_version_ref = versions[0].reference
-        latest_version_data = versions[0].to_dict() or {}
-        itinerary_data = latest_version_data.get('itineraryData', {}) or {}
+        # Research for several segments often lands at once; share one transaction
+        write_future = submit_latest_version_edit(
+            db, scenario_ref, _TRANSPORT_SEGMENT_FIELDS, _apply_research, now_iso=now_iso
+        )
+        try:
+            version_found, segment = write_future.result(timeout=TRANSPORT_RESEARCH_WRITE_WAIT_SECONDS)
+        except FutureTimeoutError:
+            # Firestore is slow; free this worker and let the edit land in the background.
+            # The caller already got a 202, so a failure is reported on pending_changes.
+            def _finish_late_write(future):
+                try:
+                    late_version_found, late_segment = future.result()
+                except Exception as exc:
+                    logger.exception("Background transport research write failed for segment %s", segment_id)
+                    _queue_change_notification('transport_segment_update_failed', error=str(exc))
+                    return
+                if late_version_found and late_segment is not None:
+                    _queue_change_notification()
+                elif not research_state['unchanged']:
+                    logger.warning("Background transport research write found no segment %s", segment_id)
+                    _queue_change_notification(
+                        'transport_segment_update_failed',
+                        error='No versions found' if not late_version_found else f'Segment {segment_id} not found',
+                    )
 
-        transport_segments = itinerary_data.get('transport_segments', [])
+            write_future.add_done_callback(_finish_late_write)
+            return jsonify({
+                'status': 'accepted',
+                'message': 'Transport segment update queued',
+                'segment_id': segment_id
+            }), 202
 
-        # Find and update the segment
-        segment_found = False
-        for segment in transport_segments:
-            if segment.get('id') == segment_id:
-                segment_found = True
-                print(f"  Found segment: {segment.get('type')} from {segment.get('from_name')} to {segment.get('to_name')}")
-                # Update with research data
-                transport_mode = research_data.get('transport_mode', 'plane')
-                segment['transport_mode'] = transport_mode
-                segment['transport_mode_icon'] = get_transport_icon(transport_mode)
-                segment['researched_cost_low'] = research_data.get('cost_low')
-                segment['researched_cost_mid'] = research_data.get('cost_mid')
-                segment['researched_cost_high'] = research_data.get('cost_high')
-                segment['researched_duration_hours'] = research_data.get('typical_duration_hours')
-                segment['researched_stops'] = research_data.get('typical_stops', 0)
-                segment['researched_airlines'] = research_data.get('airlines', [])
-                segment['researched_alternatives'] = research_data.get('alternatives', [])
-                segment['research_sources'] = research_data.get('sources', [])
-                segment['research_notes'] = research_data.get('booking_tips', '')
-                segment['researched_at'] = datetime.utcnow().isoformat()  # Always use current time, not AI's date
-                segment['booking_status'] = 'researched'
-                segment['confidence_level'] = research_data.get('confidence', 'medium')
-                segment['auto_updated'] = True
-                segment['updated_at'] = datetime.utcnow().isoformat()
-                print(f"  Updated segment with:")
-                print(f"    cost_mid: {segment['researched_cost_mid']}")
-                print(f"    airlines: {len(segment['researched_airlines'])} airlines")
-                print(f"    alternatives: {len(segment['researched_alternatives'])} alternatives")
-                print(f"    booking_status: {segment['booking_status']}")
-                break
-
-        if not segment_found:
-            print(f"  ERROR: Segment {segment_id} not found in {len(transport_segments)} transport segments")
+        if not version_found:
+            return jsonify({'error': 'No versions found'}), 404
+        if segment is None and research_state['unchanged']:
+            return jsonify({
+                'status': 'unchanged',
+                'message': 'Transport segment already has this research data',
+                'segment_id': segment_id
+            })
+        if segment is None:
             return jsonify({'error': f'Segment {segment_id} not found'}), 404
 
-        # Update Firestore
-        itinerary_data['transport_segments'] = transport_segments
-        latest_version_ref.update({
-            'itineraryData': itinerary_data,
-            'lastModified': datetime.utcnow().isoformat()
-        })
-        print(f"  ✅ Firestore updated successfully")
-
-        # Queue change for frontend polling
-        if session_id in session_store._session_cache:
-            if 'pending_changes' not in session_store._session_cache[session_id]:
-                session_store._session_cache[session_id]['pending_changes'] = []
-
-            session_store._session_cache[session_id]['pending_changes'].append({
-                'type': 'transport_segment_updated',
-                'segment_id': segment_id,
-                'timestamp': datetime.utcnow().isoformat()
-            })
-            print(f"  ✅ Queued change notification for session {session_id}")
-        else:
-            print(f"  ⚠️ Session {session_id} not found in cache - polling may not detect change")
+        _queue_change_notification()
 
         return jsonify({
             'status': 'success',
@@ -3916,9 +4673,7 @@ def update_transport_research():
         })
 
     except Exception as e:
-        print(f"Error updating transport research: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error updating transport research for segment %s", segment_id)
         return jsonify({'error': str(e)}), 500
 
 
@@ -3927,6 +4682,80 @@ def update_transport_research():
 # EDUCATION SYSTEM - TEST ENDPOINTS
 # ============================================
 
+CURRICULUM_WRITE_MAX_ATTEMPTS = 5
+
+
+def _commit_write_ops(db, write_ops: List[Tuple[str, Any, Dict[str, Any]]]) -> None:
+    """Send ``(op, ref, data)`` writes through a BulkWriter and block until all are acknowledged.
+
+    The BulkWriter batches and pipelines the RPCs in parallel with its own flow
+    control. A failed write is logged and retried up to CURRICULUM_WRITE_MAX_ATTEMPTS
+    times; since ``close()`` does not raise for writes that still fail, those are
+    collected and raised afterwards so callers never report unsaved documents.
+    """
+    failures: List[str] = []
+
+    def _on_write_error(failure, _bulk_writer) -> bool:
+        path = failure.operation.reference.path
+        logger.warning(
+            'Curriculum write to %s failed (attempt %d, code %s): %s',
+            path, failure.attempts, failure.code, failure.message,
+        )
+        if failure.attempts < CURRICULUM_WRITE_MAX_ATTEMPTS:
+            return True
+        failures.append(f'{path}: {failure.message}')
+        return False
+
+    writer = db.bulk_writer(options=BulkWriterOptions(initial_ops_per_second=500))
+    writer.on_write_error(_on_write_error)
+    for op, ref, data in write_ops:
+        getattr(writer, op)(ref, data)
+    writer.close()
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(write_ops)} curriculum writes failed: {'; '.join(failures)}")
+
+
+def _attach_curriculum_to_version(db, scenario_id: str, version_id: str, location_id: str, plan_id: str, now) -> None:
+    """Add ``plan_id`` to the location's ``curriculum_plan_ids`` on a scenario version.
+
+    The read-modify-write runs in a transaction so concurrent curriculum saves for
+    the same version cannot drop each other's references. Array elements have no
+    field path, so ArrayUnion cannot target one location's list; instead only
+    ``itineraryData.locations`` is read (via a projected query) and written back.
+    """
+    versions_ref = db.collection('scenarios').document(scenario_id).collection('versions')
+    version_ref = versions_ref.document(version_id)
+    version_query = (
+        versions_ref
+            .where(FieldPath.document_id(), '==', version_ref)
+            .limit(1)
+            .select(['itineraryData.locations'])
+    )
+
+    @firestore.transactional
+    def _run(transaction):
+        version_doc = next(iter(transaction.get(version_query)), None)
+        if version_doc is None:
+            return False
+        locations = (version_doc.to_dict().get('itineraryData') or {}).get('locations', [])
+        for loc in locations:
+            if str(loc.get('id')) == location_id:
+                plan_ids = loc.setdefault('curriculum_plan_ids', [])
+                if plan_id in plan_ids:
+                    return False
+                plan_ids.append(plan_id)
+                transaction.update(version_ref, {'itineraryData.locations': locations, 'updatedAt': now})
+                return True
+        return False
+
+    try:
+        if _run(db.transaction()):
+            latest_version_cache.invalidate(scenario_id)
+            logger.debug('Added curriculum %s to location %s', plan_id, location_id)
+    except Exception:
+        logger.warning('Could not update location %s with curriculum reference %s', location_id, plan_id, exc_info=True)
+
+
 def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curriculum_data: Dict, metadata: Dict) -> Dict[str, str]:
     """
     Save generated curriculum to Firestore collections.
@@ -3949,6 +4778,8 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
         raise Exception("Firestore not available")
 
     now = datetime.now()
+    # (op, ref, data) tuples handed to the BulkWriter in _commit_write_ops once everything is built
+    write_ops = []
 
     # 1. Save or retrieve student profile
     student_id = student_profile.get('id') or f"student_{uuid.uuid4().hex[:12]}"
@@ -3976,12 +4807,12 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
             'created_at': now,
             'updated_at': now
         }
-        student_ref.set(student_data)
-        print(f"✓ Created student profile: {student_id}")
+        write_ops.append(('set', student_ref, student_data))
+        student_status = 'Created'
     else:
         # Update timestamp
-        student_ref.update({'updated_at': now})
-        print(f"✓ Using existing student profile: {student_id}")
+        write_ops.append(('update', student_ref, {'updated_at': now}))
+        student_status = 'Using existing'
 
     # 2. Save curriculum plan
     plan_id = f"plan_{uuid.uuid4().hex[:12]}"
@@ -4021,6 +4852,7 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
 
         # Top-level fields for querying and relationships
         'location_id': str(location_id),  # Primary location ID for easy querying
+        'location_ids': list(location_lessons),  # Every location covered, for array_contains queries
         'location_name': location.get('name', 'Unknown'),
         'country': location.get('country', ''),  # For country-level queries
         'region': location.get('region', ''),  # For region-level queries
@@ -4039,16 +4871,19 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
     }
 
     plan_ref = db.collection('curriculum_plans').document(plan_id)
-    plan_ref.set(curriculum_plan)
-    print(f"✓ Created curriculum plan: {plan_id}")
+    write_ops.append(('create', plan_ref, curriculum_plan))
 
     # 3. Save individual learning activities
-    activity_ids = []
+    on_location = curriculum_data.get('on_location', {})
+    exp_activities = on_location.get('experiential_activities', [])
+    structured_lessons = on_location.get('structured_lessons', [])
+    # IDs are minted client-side up front, so every activity write can go out in
+    # the same BulkWriter flush and the returned ids need no server round trip.
+    activity_ids = [f"activity_{uuid.uuid4().hex[:12]}" for _ in range(len(exp_activities) + len(structured_lessons))]
+    activities_ref = db.collection('learning_activities')
 
     # Extract experiential activities
-    exp_activities = curriculum_data.get('on_location', {}).get('experiential_activities', [])
-    for idx, activity in enumerate(exp_activities):
-        activity_id = f"activity_{uuid.uuid4().hex[:12]}"
+    for idx, (activity_id, activity) in enumerate(zip(activity_ids, exp_activities)):
         activity_data = {
             'id': activity_id,
             'curriculum_plan_id': plan_id,
@@ -4073,14 +4908,10 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
         if 'site_details' in activity:
             activity_data['site_details'] = activity['site_details']
 
-        activity_ref = db.collection('learning_activities').document(activity_id)
-        activity_ref.set(activity_data)
-        activity_ids.append(activity_id)
+        write_ops.append(('create', activities_ref.document(activity_id), activity_data))
 
     # Extract structured lessons
-    structured_lessons = curriculum_data.get('on_location', {}).get('structured_lessons', [])
-    for idx, lesson in enumerate(structured_lessons):
-        activity_id = f"activity_{uuid.uuid4().hex[:12]}"
+    for idx, (activity_id, lesson) in enumerate(zip(activity_ids[len(exp_activities):], structured_lessons)):
         activity_data = {
             'id': activity_id,
             'curriculum_plan_id': plan_id,
@@ -4101,51 +4932,21 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
             'source': 'curriculum_generator'
         }
 
-        activity_ref = db.collection('learning_activities').document(activity_id)
-        activity_ref.set(activity_data)
-        activity_ids.append(activity_id)
+        write_ops.append(('create', activities_ref.document(activity_id), activity_data))
 
+    _commit_write_ops(db, write_ops)
+    print(f"✓ {student_status} student profile: {student_id}")
+    print(f"✓ Created curriculum plan: {plan_id}")
     print(f"✓ Created {len(activity_ids)} learning activities")
 
     # 4. Optionally update trip location with curriculum reference
-    # This creates a two-way relationship between locations and curricula
+    # This creates a two-way relationship between locations and curricula. It runs
+    # off the request thread; the plan is already saved and the link is best effort.
     if location.get('trip_scenario_id') and location.get('trip_version_id'):
-        try:
-            scenario_id = location['trip_scenario_id']
-            version_id = location['trip_version_id']
-
-            # Get the version document
-            version_ref = db.collection('scenarios').document(scenario_id).collection('versions').document(version_id)
-            version_doc = version_ref.get()
-
-            if version_doc.exists:
-                version_data = version_doc.to_dict()
-                itinerary_data = version_data.get('itineraryData', {})
-                locations = itinerary_data.get('locations', [])
-
-                # Find the location and add curriculum reference
-                updated = False
-                for loc in locations:
-                    if str(loc.get('id')) == str(location_id):
-                        # Add curriculum_plan_ids array if doesn't exist
-                        if 'curriculum_plan_ids' not in loc:
-                            loc['curriculum_plan_ids'] = []
-                        # Add this plan if not already there
-                        if plan_id not in loc['curriculum_plan_ids']:
-                            loc['curriculum_plan_ids'].append(plan_id)
-                        updated = True
-                        break
-
-                if updated:
-                    # Save updated itinerary back
-                    version_ref.update({
-                        'itineraryData': itinerary_data,
-                        'updatedAt': now
-                    })
-                    print(f"✓ Added curriculum reference to location {location_id}")
-        except Exception as e:
-            print(f"⚠ Could not update location with curriculum reference: {e}")
-            # Don't fail the whole operation if this step fails
+        firestore_write_pool.submit(
+            _attach_curriculum_to_version, db,
+            location['trip_scenario_id'], location['trip_version_id'], str(location_id), plan_id, now,
+        )
 
     return {
         'student_profile_id': student_id,
@@ -4156,45 +4957,29 @@ def _save_curriculum_to_firestore(student_profile: Dict, location: Dict, curricu
     }
 
 
-@app.route('/api/education/test/generate-curriculum', methods=['POST'])
-def test_generate_curriculum():
-    """
-    Test endpoint for curriculum generation using Vertex AI.
-    Uses existing Google Cloud credentials (ADC).
-    """
-    try:
-        from google import genai
-
-        data = request.json
-        location = data.get('location', {})
-        student = data.get('student', {})
-        subjects = data.get('subjects', [])
-
-        if not location or not student or not subjects:
-            return jsonify({'error': 'Missing required fields: location, student, subjects'}), 400
-
-        # Build the curriculum generation prompt
-        prompt = f"""You are an expert curriculum designer specializing in location-based, experiential learning for middle school students.
+# Curriculum generation prompt, parsed once at import. The output-format section
+# is literal JSON, so it uses string.Template ($name) rather than str.format.
+CURRICULUM_PROMPT_TEMPLATE = string.Template("""You are an expert curriculum designer specializing in location-based, experiential learning for middle school students.
 
 # Student Context
-- Name: {student.get('name', 'Student')}
-- Age: {student.get('age', 14)}
-- Grade: {student.get('grade', 8)}
-- Learning Style: {student.get('learning_style', 'experiential')}
-- Time Budget: {student.get('time_budget_minutes_per_day', 60)} minutes per day
-- Reading Level: Grade {student.get('reading_level', 10)}
-- Interests: {', '.join(student.get('interests', []))}
-- State Standards: {student.get('state', 'California')} Grade {student.get('grade', 8)}
+- Name: $student_name
+- Age: $student_age
+- Grade: $student_grade
+- Learning Style: $learning_style
+- Time Budget: $time_budget_minutes minutes per day
+- Reading Level: Grade $reading_level
+- Interests: $interests
+- State Standards: $state Grade $student_grade
 
 # Location Details
-- Name: {location.get('name')}, {location.get('country')}
-- Duration: {location.get('duration_days')} days
-- Dates: {location.get('arrival_date', 'TBD')} to {location.get('departure_date', 'TBD')}
-- Activity Type: {location.get('activity_type', 'exploration')}
-- Highlights: {', '.join(location.get('highlights', []))}
+- Name: $location_name, $location_country
+- Duration: $duration_days days
+- Dates: $arrival_date to $departure_date
+- Activity Type: $activity_type
+- Highlights: $highlights
 
 # Subjects to Cover
-{', '.join(subjects)}
+$subjects
 
 # Task
 Generate comprehensive educational content for this location that aligns with California 8th grade standards.
@@ -4224,7 +5009,7 @@ List 3-4 specific tasks to complete before the trip.
 
 ## 2. On-Location Activities
 
-Create {min(location.get('duration_days', 7), 7)} days worth of learning activities.
+Create $activity_days days worth of learning activities.
 
 ### Experiential Activities (prioritize these - 70%)
 Provide specific, location-based activities with:
@@ -4259,67 +5044,67 @@ Longer-form assignments: essays, reports, creative projects.
 
 CRITICAL: Provide response as valid JSON matching this EXACT structure:
 
-{{
-  "location_id": "{location.get('id', 'location')}",
-  "location_name": "{location.get('name')}, {location.get('country')}",
-  "duration_days": {location.get('duration_days', 7)},
+{
+  "location_id": "$location_id",
+  "location_name": "$location_name, $location_country",
+  "duration_days": $planned_days,
 
-  "pre_trip": {{
+  "pre_trip": {
     "timeline": "2 weeks before arrival",
     "readings": [
-      {{
+      {
         "title": "Exact article title",
         "source": "Publication name or website",
         "reading_time_minutes": 20,
         "description": "What the student will learn",
         "relevance": "Why this matters for the trip",
         "url": "https://example.com/article" or null
-      }}
+      }
     ],
     "videos": [
-      {{
+      {
         "title": "Exact video title",
         "source": "YouTube channel or platform name",
         "duration_minutes": 15,
         "description": "What the video covers",
         "key_concepts": ["concept1", "concept2"],
         "url": "https://youtube.com/..." or null
-      }}
+      }
     ],
     "preparation_tasks": [
-      {{
+      {
         "title": "Task name",
         "description": "Detailed instructions",
         "estimated_duration_minutes": 30
-      }}
+      }
     ]
-  }},
+  },
 
-  "on_location": {{
+  "on_location": {
     "experiential_activities": [
-      {{
+      {
         "title": "Activity name",
         "type": "experiential",
         "subject": "science" or "social_studies" or "language_arts",
         "estimated_duration_minutes": 120,
         "learning_objectives": ["objective1", "objective2"],
         "description": "Detailed activity description",
-        "instructions": {{
+        "instructions": {
           "before": "What to prepare",
           "during": "Step-by-step what to do",
           "after": "Follow-up tasks"
-        }},
-        "site_details": {{
+        },
+        "site_details": {
           "name": "Exact museum/site name",
           "address": "Full street address",
           "best_time": "Morning on weekdays",
           "cost_usd": 15,
           "what_to_bring": ["camera", "notebook", "water"]
-        }}
-      }}
+        }
+      }
     ],
     "structured_lessons": [
-      {{
+      {
         "title": "Lesson name",
         "type": "structured",
         "subject": "science",
@@ -4327,55 +5112,96 @@ CRITICAL: Provide response as valid JSON matching this EXACT structure:
         "learning_objectives": ["objective1"],
         "description": "What the lesson covers",
         "activities": ["Read chapter 3", "Watch video", "Answer questions"]
-      }}
+      }
     ]
-  }},
+  },
 
-  "post_trip": {{
+  "post_trip": {
     "reflection_prompts": [
-      {{
+      {
         "text": "The actual prompt question or writing prompt",
         "type": "journal" or "essay" or "discussion",
         "word_count_target": 300
-      }}
+      }
     ],
     "synthesis_activities": [
-      {{
+      {
         "title": "Activity name",
         "type": "essay" or "presentation" or "project",
         "subject": "social_studies",
         "description": "Detailed assignment description",
         "estimated_duration_minutes": 120,
         "learning_objectives": ["objective1", "objective2"]
-      }}
+      }
     ]
-  }},
+  },
 
-  "subject_coverage": {{
-    "science": {{
+  "subject_coverage": {
+    "science": {
       "topics": ["Marine ecosystems", "Geology"],
       "standards": ["CA-NGSS-MS-LS2-1"],
       "estimated_hours": 8.0
-    }},
-    "social_studies": {{
+    },
+    "social_studies": {
       "topics": ["Cultural studies", "Economics"],
       "standards": ["CA-HSS-8.1"],
       "estimated_hours": 5.0
-    }},
-    "language_arts": {{
+    },
+    "language_arts": {
       "topics": ["Descriptive writing", "Research"],
       "standards": ["CA-CCSS-ELA-W.8.1"],
       "estimated_hours": 3.0
-    }}
-  }}
-}}
+    }
+  }
+}
 
 IMPORTANT:
 1. Every field shown above is REQUIRED. Use exact field names.
 2. Return ONLY valid JSON - no markdown, no explanation text before or after.
 3. Ensure all JSON is properly formatted with correct commas, brackets, and quotes.
 4. Make it specific, engaging, and educationally sound!
-"""
+""")
+
+
+@app.route('/api/education/test/generate-curriculum', methods=['POST'])
+def test_generate_curriculum():
+    """
+    Test endpoint for curriculum generation using Vertex AI.
+    Uses existing Google Cloud credentials (ADC).
+    """
+    try:
+        from google import genai
+
+        data = request.json
+        location = data.get('location', {})
+        student = data.get('student', {})
+        subjects = data.get('subjects', [])
+
+        if not location or not student or not subjects:
+            return jsonify({'error': 'Missing required fields: location, student, subjects'}), 400
+
+        # Build the curriculum generation prompt
+        prompt = CURRICULUM_PROMPT_TEMPLATE.substitute(
+            student_name=student.get('name', 'Student'),
+            student_age=student.get('age', 14),
+            student_grade=student.get('grade', 8),
+            learning_style=student.get('learning_style', 'experiential'),
+            time_budget_minutes=student.get('time_budget_minutes_per_day', 60),
+            reading_level=student.get('reading_level', 10),
+            interests=', '.join(student.get('interests', [])),
+            state=student.get('state', 'California'),
+            location_id=location.get('id', 'location'),
+            location_name=location.get('name'),
+            location_country=location.get('country'),
+            duration_days=location.get('duration_days'),
+            planned_days=location.get('duration_days', 7),
+            activity_days=min(location.get('duration_days', 7), 7),
+            arrival_date=location.get('arrival_date', 'TBD'),
+            departure_date=location.get('departure_date', 'TBD'),
+            activity_type=location.get('activity_type', 'exploration'),
+            highlights=', '.join(location.get('highlights', [])),
+            subjects=', '.join(subjects),
+        )
 
         # Initialize Gemini client with credentials
         credentials_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
@@ -4404,6 +5230,8 @@ IMPORTANT:
             config={
                 'temperature': 0.7,
                 'max_output_tokens': 8000,
+                # JSON mode: the reply is a bare JSON document, no fences or prose
+                'response_mime_type': 'application/json',
             }
         )
 
@@ -4412,41 +5240,7 @@ IMPORTANT:
 
         # Try to parse as JSON
         try:
-            # Remove markdown code blocks if present
-            cleaned_text = result_text.strip()
-            if cleaned_text.startswith('```'):
-                parts = cleaned_text.split('```')
-                if len(parts) >= 2:
-                    cleaned_text = parts[1]
-                    # Remove language identifier if present
-                    if cleaned_text.strip().startswith('json'):
-                        cleaned_text = cleaned_text.strip()[4:]
-
-            # Clean up common JSON formatting issues
-            cleaned_text = cleaned_text.strip()
-
-            # Try to find JSON object boundaries if there's extra text
-            if not cleaned_text.startswith('{'):
-                start_idx = cleaned_text.find('{')
-                if start_idx >= 0:
-                    cleaned_text = cleaned_text[start_idx:]
-
-            if not cleaned_text.endswith('}'):
-                end_idx = cleaned_text.rfind('}')
-                if end_idx >= 0:
-                    cleaned_text = cleaned_text[:end_idx + 1]
-
-            # Fix common JSON errors from AI output
-            # Fix numbers followed by unquoted text in parentheses (e.g., "10 (village entrance fee)" -> "10")
-            import re
-            cleaned_text = re.sub(r'(\d+)\s*\([^)]*\)', r'\1', cleaned_text)
-
-            # Fix missing commas before closing braces/brackets in some edge cases
-            # This is a more conservative fix that only targets obvious issues
-            cleaned_text = re.sub(r'"\s*\n\s*}', '"\n}', cleaned_text)
-            cleaned_text = re.sub(r'"\s*\n\s*]', '"\n]', cleaned_text)
-
-            result_json = json.loads(cleaned_text)
+            result_json = json.loads(result_text)
 
             print(f"✓ Successfully generated curriculum for {location.get('name')}")
 
@@ -4467,7 +5261,6 @@ IMPORTANT:
                     print(f"✓ Saved to Firestore: {saved_ids}")
                 except Exception as e:
                     print(f"⚠ Failed to save to Firestore: {e}")
-                    import traceback
                     traceback.print_exc()
 
             return jsonify({
@@ -4483,7 +5276,7 @@ IMPORTANT:
 
         except json.JSONDecodeError as e:
             print(f"⚠ JSON parsing error: {e}")
-            # Return raw text if JSON parsing fails
+            # JSON mode can still be cut off at max_output_tokens; return the raw text
             return jsonify({
                 'status': 'partial_success',
                 'raw_text': result_text,
@@ -4501,7 +5294,6 @@ IMPORTANT:
         }), 500
     except Exception as e:
         print(f"Error generating curriculum: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({
             'error': str(e),
@@ -4509,6 +5301,33 @@ IMPORTANT:
         }), 500
 
 
+_TIMESTAMP_FIELDS = ('created_at', 'updated_at', 'generated_at')
+
+
+def _serialize_timestamps(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Stringify the education documents' timestamp fields in place for JSON responses."""
+    for field in _TIMESTAMP_FIELDS:
+        if field in data:
+            value = data[field]
+            isoformat = getattr(value, 'isoformat', None)
+            data[field] = isoformat() if isoformat is not None else str(value)
+    return data
+
+
+# Top-level fields of a curriculum_plans document, as written by _save_curriculum_to_firestore
+CURRICULUM_PLAN_FIELDS = frozenset({
+    'id', 'student_profile_id', 'trip_scenario_id', 'trip_version_id', 'status',
+    'created_at', 'updated_at', 'generated_at', 'ai_model_used', 'generation_metadata',
+    'location_id', 'location_ids', 'location_name', 'country', 'region',
+    'semester', 'location_lessons', 'thematic_threads', 'standards_coverage',
+})
+
+
+def _created_at_epoch(data: Dict[str, Any]) -> float:
+    created_at = data.get('created_at')
+    return created_at.timestamp() if hasattr(created_at, 'timestamp') else 0.0
+
+
 @app.route('/api/education/curricula', methods=['GET'])
 def list_curricula():
     """
@@ -4520,6 +5339,8 @@ def list_curricula():
     - country: Filter by country
     - status: Filter by status (draft, active, completed, archived)
     - limit: Max results (default 50)
+    - fields: Comma-separated top-level plan fields to return (default: whole
+      documents); ``id`` and ``created_at`` are always included
     """
     db = get_firestore_client()
     if not db:
@@ -4534,8 +5355,13 @@ def list_curricula():
         country = request.args.get('country')
         status = request.args.get('status')
         limit = int(request.args.get('limit', 50))
-
-        has_filters = bool(student_id or status or country)
+        fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+        unknown_fields = sorted(set(fields) - CURRICULUM_PLAN_FIELDS)
+        if unknown_fields:
+            return jsonify({'error': f"Unknown curriculum fields: {', '.join(unknown_fields)}"}), 400
+        if fields:
+            # id identifies each plan; created_at orders merged location results
+            fields = list(dict.fromkeys(['id', 'created_at', *fields]))
 
         if student_id:
             query = query.where('student_profile_id', '==', student_id)
@@ -4544,35 +5370,43 @@ def list_curricula():
         if country:
             query = query.where('country', '==', country)
 
-        # Only use ORDER BY if no filters (to avoid needing composite indexes)
-        # Otherwise, sort in Python after fetching
-        if not has_filters:
-            query = query.order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
-
-        docs = query.stream()
-        curricula = []
-
-        for doc in docs:
-            data = doc.to_dict()
-
-            # Filter by location_id if specified (need to check location_lessons keys)
-            if location_id and str(location_id) not in data.get('location_lessons', {}):
-                continue
-
+        if location_id:
+            # location_ids lists every location a plan covers; the location_id query keeps
+            # the primary location of plans saved before that field existed. Their other
+            # locations need scripts/migrate_backfill_curriculum_location_ids.py.
+            queries = [
+                query.where('location_ids', 'array_contains', str(location_id)),
+                query.where('location_id', '==', str(location_id)),
+            ]
+        else:
+            queries = [query]
+
+        curricula_by_id = {}
+        sort_in_python = len(queries) > 1
+        for query in queries:
+            if fields:
+                # Field mask: list views skip downloading location_lessons and the other large maps
+                query = query.select(fields)
+            try:
+                # Filtered orderings are served by the composite indexes in firestore.indexes.json
+                docs = list(query.order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit).stream())
+            except FailedPrecondition as e:
+                # Index not deployed or still building: fetch every match and sort below instead
+                logger.warning("Curriculum listing is missing a composite index, sorting in Python: %s", e)
+                docs = list(query.stream())
+                sort_in_python = True
+            for doc in docs:
+                curricula_by_id.setdefault(doc.id, doc.to_dict())
+
+        curricula = list(curricula_by_id.values())
+        if sort_in_python:
+            # Merge the newest-first result sets (or order the unindexed ones)
+            curricula.sort(key=_created_at_epoch, reverse=True)
+            curricula = curricula[:limit]
+
+        for data in curricula:
             # Convert timestamps to ISO strings
-            if 'created_at' in data:
-                data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-            if 'updated_at' in data:
-                data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
-            if 'generated_at' in data:
-                data['generated_at'] = data['generated_at'].isoformat() if hasattr(data['generated_at'], 'isoformat') else str(data['generated_at'])
-
-            curricula.append(data)
-
-        # Sort by created_at in Python if we had filters
-        if has_filters:
-            curricula.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-            curricula = curricula[:limit]  # Apply limit after sorting
+            _serialize_timestamps(data)
 
         return jsonify({
             'status': 'success',
@@ -4582,7 +5416,6 @@ def list_curricula():
 
     except Exception as e:
         print(f"Error listing curricula: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4603,12 +5436,7 @@ def get_curriculum(plan_id):
         data = doc.to_dict()
 
         # Convert timestamps
-        if 'created_at' in data:
-            data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-        if 'updated_at' in data:
-            data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
-        if 'generated_at' in data:
-            data['generated_at'] = data['generated_at'].isoformat() if hasattr(data['generated_at'], 'isoformat') else str(data['generated_at'])
+        _serialize_timestamps(data)
 
         return jsonify({
             'status': 'success',
@@ -4617,7 +5445,6 @@ def get_curriculum(plan_id):
 
     except Exception as e:
         print(f"Error getting curriculum: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4630,25 +5457,27 @@ def get_curricula_by_location(location_id):
         return jsonify({'status': 'success', 'curricula': [], 'count': 0}), 200
 
     try:
+        # Query server-side instead of scanning the collection. location_ids lists
+        # every location a plan covers; plans saved before that field existed are
+        # only found by their primary location_id until
+        # scripts/migrate_backfill_curriculum_location_ids.py has run.
+        plans = db.collection('curriculum_plans')
+        docs_by_id = {}
+        for query in (
+            plans.where('location_ids', 'array_contains', str(location_id)),
+            plans.where('location_id', '==', str(location_id)),
+        ):
+            for doc in query.stream():
+                docs_by_id.setdefault(doc.id, doc)
 
-        # Get all curricula and filter by location_id in location_lessons
-        docs = db.collection('curriculum_plans').stream()
         curricula = []
-
-        for doc in docs:
+        for doc in docs_by_id.values():
             data = doc.to_dict()
 
-            # Check if this curriculum includes the requested location
-            if str(location_id) in data.get('location_lessons', {}):
-                # Convert timestamps
-                if 'created_at' in data:
-                    data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-                if 'updated_at' in data:
-                    data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
-                if 'generated_at' in data:
-                    data['generated_at'] = data['generated_at'].isoformat() if hasattr(data['generated_at'], 'isoformat') else str(data['generated_at'])
+            # Convert timestamps
+            _serialize_timestamps(data)
 
-                curricula.append(data)
+            curricula.append(data)
 
         return jsonify({
             'status': 'success',
@@ -4659,7 +5488,6 @@ def get_curricula_by_location(location_id):
 
     except Exception as e:
         print(f"Error getting curricula by location: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4733,7 +5561,6 @@ def get_destinations():
 
     except Exception as e:
         print(f"Error getting destinations: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4755,10 +5582,7 @@ def list_students():
             data['id'] = doc.id
 
             # Convert timestamps
-            if 'created_at' in data:
-                data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-            if 'updated_at' in data:
-                data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
+            _serialize_timestamps(data)
 
             students.append(data)
 
@@ -4766,7 +5590,6 @@ def list_students():
 
     except Exception as e:
         print(f"Error listing students: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4818,7 +5641,6 @@ def create_student():
 
     except Exception as e:
         print(f"Error creating student: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4862,10 +5684,7 @@ def update_student(student_id):
         updated_data['id'] = student_id
 
         # Convert timestamps
-        if 'created_at' in updated_data:
-            updated_data['created_at'] = updated_data['created_at'].isoformat() if hasattr(updated_data['created_at'], 'isoformat') else str(updated_data['created_at'])
-        if 'updated_at' in updated_data:
-            updated_data['updated_at'] = updated_data['updated_at'].isoformat() if hasattr(updated_data['updated_at'], 'isoformat') else str(updated_data['updated_at'])
+        _serialize_timestamps(updated_data)
 
         return jsonify({
             'status': 'success',
@@ -4874,7 +5693,6 @@ def update_student(student_id):
 
     except Exception as e:
         print(f"Error updating student: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4914,7 +5732,6 @@ def delete_student(student_id):
 
     except Exception as e:
         print(f"Error deleting student: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4938,12 +5755,7 @@ def get_student_curricula(student_id):
             data = doc.to_dict()
 
             # Convert timestamps
-            if 'created_at' in data:
-                data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-            if 'updated_at' in data:
-                data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
-            if 'generated_at' in data:
-                data['generated_at'] = data['generated_at'].isoformat() if hasattr(data['generated_at'], 'isoformat') else str(data['generated_at'])
+            _serialize_timestamps(data)
 
             curricula.append(data)
 
@@ -4958,7 +5770,6 @@ def get_student_curricula(student_id):
 
     except Exception as e:
         print(f"Error getting student curricula: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -4966,9 +5777,9 @@ def get_student_curricula(student_id):
 @app.route('/api/education/students/<student_id>/dashboard', methods=['GET'])
 def get_student_dashboard(student_id):
     """Get comprehensive dashboard stats for a student."""
-    """Get comprehensive dashboard stats for a student."""
+    db = get_firestore_client()
     # Fallback for when Firestore is not available
-    if not firestore or not get_firestore_client():
+    if not db:
         print("⚠️ Firestore not available, returning mock dashboard data")
         return jsonify({
             'status': 'success',
@@ -4993,8 +5804,6 @@ def get_student_dashboard(student_id):
         })
 
     try:
-        db = get_firestore_client()
-
         # 1. Get Student Profile
         student_ref = db.collection('student_profiles').document(student_id)
         student_doc = student_ref.get()
@@ -5020,12 +5829,7 @@ def get_student_dashboard(student_id):
             data['id'] = doc.id
             
             # Convert timestamps
-            if 'created_at' in data:
-                data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
-            if 'updated_at' in data:
-                data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'], 'isoformat') else str(data['updated_at'])
-            if 'generated_at' in data:
-                data['generated_at'] = data['generated_at'].isoformat() if hasattr(data['generated_at'], 'isoformat') else str(data['generated_at'])
+            _serialize_timestamps(data)
 
             curricula.append(data)
             
@@ -5079,7 +5883,6 @@ def get_student_dashboard(student_id):
 
     except Exception as e:
         print(f"Error getting student dashboard: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -5106,6 +5909,8 @@ def update_curriculum(plan_id):
         for field in allowed_fields:
             if field in data:
                 update_data[field] = data[field]
+        if isinstance(update_data.get('location_lessons'), dict):
+            update_data['location_ids'] = list(update_data['location_lessons'])
                 
         update_data['updated_at'] = datetime.now()
         
@@ -5117,10 +5922,7 @@ def update_curriculum(plan_id):
         updated_data['id'] = plan_id
         
         # Convert timestamps
-        if 'created_at' in updated_data:
-            updated_data['created_at'] = updated_data['created_at'].isoformat() if hasattr(updated_data['created_at'], 'isoformat') else str(updated_data['created_at'])
-        if 'updated_at' in updated_data:
-            updated_data['updated_at'] = updated_data['updated_at'].isoformat() if hasattr(updated_data['updated_at'], 'isoformat') else str(updated_data['updated_at'])
+        _serialize_timestamps(updated_data)
             
         return jsonify({
             'status': 'success',
@@ -5204,7 +6006,6 @@ def add_custom_activity(plan_id):
 
     except Exception as e:
         print(f"Error adding custom activity: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -5353,7 +6154,6 @@ Output JSON format:
 
     except Exception as e:
         print(f"Error in bulk generation: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -5426,7 +6226,6 @@ def get_destinations():
 
     except Exception as e:
         print(f"Error getting destinations: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,1063 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for helpers and Firestore write plumbing in api_server."""
+
+import random
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+
+import api_server
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError("condition not reached in time")
+        time.sleep(0.005)
+
+
+class _Ref:
+    """Minimal stand-in for a Firestore document reference."""
+
+    def __init__(self, path):
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+
+def _random_costs(count, seed=7):
+    rng = random.Random(seed)
+    categories = ['flight', 'accommodation', 'food', 'activity', None, '']
+    return [
+        {
+            'id': f'cost_{i}',
+            'category': rng.choice(categories),
+            'amount_usd': rng.choice([
+                round(rng.uniform(0, 2000), 2),
+                str(round(rng.uniform(0, 500), 2)),
+                rng.randint(0, 300),
+            ]),
+        }
+        for i in range(count)
+    ]
+
+
+class TestIsAlreadySanitized:
+    """Test the cost sanitizing fast-path check"""
+
+    @pytest.fixture
+    def clean_cost(self):
+        return {
+            'id': 'tokyo_food_1',
+            'category': 'food',
+            'description': 'Ramen',
+            'amount': 12.0,
+            'amount_usd': 12.0,
+            'currency': 'USD',
+            'date': '2025-03-01',
+            'destination_id': 'tokyo_japan',
+            'booking_status': 'estimated',
+            'source': 'manual',
+            'notes': None,
+        }
+
+    def test_clean_cost_takes_fast_path(self, clean_cost):
+        assert api_server._is_already_sanitized(clean_cost) is True
+
+    @pytest.mark.parametrize('field, value', [
+        ('amount', 12),
+        ('amount_usd', '12.0'),
+        ('currency', 'usd'),
+        ('description', ' Ramen'),
+        ('id', ''),
+        ('confidence', 'high'),
+    ])
+    def test_anything_needing_work_takes_slow_path(self, clean_cost, field, value):
+        clean_cost[field] = value
+        assert api_server._is_already_sanitized(clean_cost) is False
+
+
+class TestTotalsByCategory:
+    """Test the vectorized category totals agree with the plain loop"""
+
+    @pytest.fixture
+    def costs(self):
+        return _random_costs(api_server._VECTORIZED_TOTALS_MIN_ITEMS + 250)
+
+    @staticmethod
+    def _loop_totals(costs):
+        with mock.patch.object(api_server, '_VECTORIZED_TOTALS_MIN_ITEMS', len(costs) + 1):
+            return api_server._totals_by_category(costs)
+
+    def test_small_lists_use_the_loop(self):
+        """Test missing categories fall into 'other' and amounts are coerced"""
+        costs = [
+            {'category': 'food', 'amount_usd': '10.5'},
+            {'category': 'food', 'amount_usd': 4},
+            {'category': None, 'amount_usd': 1.0},
+            {'amount_usd': 2.0},
+        ]
+        assert api_server._totals_by_category(costs) == {'food': 14.5, 'other': 3.0}
+
+    def test_pandas_path_matches_loop(self, costs):
+        """Test the pandas groupby path returns the same totals"""
+        pytest.importorskip('pandas')
+        expected = self._loop_totals(costs)
+        totals = api_server._totals_by_category(costs)
+
+        assert set(totals) == set(expected)
+        for category, amount in expected.items():
+            assert totals[category] == pytest.approx(amount)
+
+    def test_numpy_path_matches_loop(self, costs):
+        """Test the numpy bincount path returns the same totals"""
+        pytest.importorskip('numpy')
+        expected = self._loop_totals(costs)
+        with mock.patch.object(api_server, 'pd', None):
+            totals = api_server._totals_by_category(costs)
+
+        assert set(totals) == set(expected)
+        for category, amount in expected.items():
+            assert totals[category] == pytest.approx(amount)
+
+    def test_without_numeric_libraries_falls_back_to_loop(self, costs):
+        """Test large lists still total correctly with neither pandas nor numpy"""
+        expected = self._loop_totals(costs)
+        with mock.patch.object(api_server, 'pd', None), mock.patch.object(api_server, 'np', None):
+            assert api_server._totals_by_category(costs) == expected
+
+
+class TestCostsFingerprint:
+    """Test cost list digests"""
+
+    def test_key_order_does_not_matter(self):
+        assert api_server._costs_fingerprint([{'id': 'a', 'amount_usd': 1.0}]) == \
+            api_server._costs_fingerprint([{'amount_usd': 1.0, 'id': 'a'}])
+
+    def test_value_and_order_changes_are_detected(self):
+        a = {'id': 'a', 'amount_usd': 1.0}
+        b = {'id': 'b', 'amount_usd': 2.0}
+        base = api_server._costs_fingerprint([a, b])
+
+        assert api_server._costs_fingerprint([b, a]) != base
+        assert api_server._costs_fingerprint([a, {**b, 'amount_usd': 2.5}]) != base
+
+    def test_item_boundaries_are_kept(self):
+        """Test the per-item separator keeps different splits distinct"""
+        assert api_server._costs_fingerprint([{'a': 'x'}, {'b': 'y'}]) != \
+            api_server._costs_fingerprint([{'a': 'x', 'b': 'y'}])
+
+
+class TestBulkUpdateMerge:
+    """Test how /api/costs/bulk-update merges edits into the stored costs"""
+
+    @pytest.fixture
+    def stored_costs(self):
+        return [
+            {'id': 'c1', 'category': 'food', 'destination_id': 'tokyo', 'amount_usd': 10.0},
+            {'id': 'c2', 'category': 'stay', 'destination_id': 'tokyo', 'amount_usd': '20'},
+            {'id': 'c3', 'category': 'stay', 'destination_id': 'kyoto', 'amount_usd': 30.0},
+        ]
+
+    @pytest.fixture
+    def post(self, stored_costs):
+        """Call bulk-update against stubbed Firestore reads; capture the committed version."""
+        committed = {}
+        scenario_doc = mock.Mock(exists=True)
+        scenario_doc.to_dict.return_value = {'currentVersion': 1}
+        version = mock.Mock()
+        version.to_dict.return_value = {'versionNumber': 1, 'itineraryData': {'costs': stored_costs}}
+
+        def fake_commit(db, scenario_ref, scenario_data, latest_version_data, mutate_itinerary, scenario_fields=None):
+            committed['itinerary'] = mutate_itinerary(dict(latest_version_data['itineraryData']))
+            committed['scenario_fields'] = scenario_fields
+            return 2
+
+        client = api_server.app.test_client()
+        with mock.patch.object(api_server, 'get_firestore_client', return_value=mock.MagicMock()), \
+                mock.patch.object(api_server, '_read_scenario_and_latest_version', return_value=(scenario_doc, [version])), \
+                mock.patch.object(api_server, '_commit_new_version', side_effect=fake_commit):
+            yield lambda costs: (client.put('/api/costs/bulk-update', json={'session_id': 's1', 'costs': costs}), committed)
+
+    def test_updates_by_id_and_recomputes_totals(self, post):
+        response, committed = post([{'id': 'c1', 'amount_usd': 15.0}, {'id': 'missing', 'amount_usd': 1.0}])
+
+        assert response.get_json()['updated_count'] == 1
+        costs = committed['itinerary']['costs']
+        assert [(c['id'], c['amount_usd']) for c in costs] == [('c1', 15.0), ('c2', 20.0), ('c3', 30.0)]
+        assert all(type(c['amount_usd']) is float for c in costs)
+        assert committed['scenario_fields'] == {
+            'costsCount': 3,
+            'totalsByCategory': {'food': 15.0, 'stay': 50.0},
+        }
+
+    def test_updates_without_id_match_destination_and_category(self, post):
+        response, committed = post([
+            {'id': 'c1', 'amount_usd': 11.0},
+            {'destination_id': 'kyoto', 'category': 'stay', 'amount_usd': '1,000'},
+        ])
+
+        assert response.get_json()['updated_count'] == 2
+        amounts = {c['id']: c['amount_usd'] for c in committed['itinerary']['costs']}
+        assert amounts == {'c1': 11.0, 'c2': 20.0, 'c3': 1000.0}
+
+    def test_cost_matched_by_id_is_not_also_matched_by_fallback(self, post):
+        response, committed = post([
+            {'id': 'c2', 'amount_usd': 21.0},
+            {'destination_id': 'tokyo', 'category': 'stay', 'amount_usd': 99.0},
+        ])
+
+        assert response.get_json()['updated_count'] == 1
+        amounts = {c['id']: c['amount_usd'] for c in committed['itinerary']['costs']}
+        assert amounts['c2'] == 21.0
+
+    def test_nothing_matched_skips_the_new_version(self, post):
+        response, committed = post([{'id': 'missing', 'amount_usd': 1.0}])
+
+        assert response.get_json()['updated_count'] == 0
+        assert committed == {}
+
+
+class TestLatestVersionCache:
+    """Test validation of cached latest versions"""
+
+    def test_unacknowledged_entry_is_not_served(self):
+        """Test a version whose write has not landed is never a cache candidate"""
+        cache = api_server.LatestVersionCache(30)
+        cache.remember('s1', _Ref('scenarios/s1/versions/v2'), {'versionNumber': 2})
+
+        assert cache.candidate('s1') is None
+        assert cache.lookup('s1', 2, None) is None
+
+    def test_entry_served_only_while_update_time_matches(self):
+        """Test in-place edits (a new update_time) invalidate the cached copy"""
+        cache = api_server.LatestVersionCache(30)
+        version_ref = _Ref('scenarios/s1/versions/v2')
+        cache.remember('s1', version_ref, {'versionNumber': 2, 'itineraryData': {'costs': [{'id': 'c1'}]}})
+        cache.confirm('s1', version_ref, 'T1')
+
+        assert cache.candidate('s1') is version_ref
+        snapshot = cache.lookup('s1', 2, 'T1')
+        assert snapshot.to_dict()['itineraryData']['costs'] == [{'id': 'c1'}]
+        assert cache.lookup('s1', 2, 'T2') is None
+        assert cache.lookup('s1', 3, 'T1') is None
+
+    def test_confirm_ignores_other_versions(self):
+        """Test an acknowledgement for a different document does not validate the entry"""
+        cache = api_server.LatestVersionCache(30)
+        cache.remember('s1', _Ref('scenarios/s1/versions/v2'), {'versionNumber': 2})
+        cache.confirm('s1', _Ref('scenarios/s1/versions/v1'), 'T1')
+
+        assert cache.candidate('s1') is None
+
+    def test_expired_entry_is_dropped(self):
+        """Test entries past their TTL are not candidates"""
+        cache = api_server.LatestVersionCache(0.01)
+        version_ref = _Ref('scenarios/s1/versions/v2')
+        cache.remember('s1', version_ref, {'versionNumber': 2})
+        cache.confirm('s1', version_ref, 'T1')
+        time.sleep(0.02)
+
+        assert cache.candidate('s1') is None
+
+
+class TestExtractJsonObject:
+    """Test locating a JSON object in free-form model output"""
+
+    def test_finds_object_with_required_key(self):
+        text = 'Sure! {"other": 1} and then {"research": {"cost_mid": 5}} done'
+        assert api_server._extract_json_object(text, 'research') == {'research': {'cost_mid': 5}}
+
+    def test_braces_inside_strings_are_ignored(self):
+        text = 'prefix {"note": "use } and { freely", "research": []} suffix'
+        assert api_server._extract_json_object(text, 'research') == {'note': 'use } and { freely', 'research': []}
+
+    def test_skips_unbalanced_and_invalid_candidates(self):
+        text = '{"research": oops} {broken {"research": [1]}'
+        assert api_server._extract_json_object(text, 'research') == {'research': [1]}
+
+    def test_returns_none_without_match(self):
+        assert api_server._extract_json_object('no json here', 'research') is None
+        assert api_server._extract_json_object('{"other": 1}', 'research') is None
+
+
+class TestLegDistances:
+    """Test the vectorized haversine agrees with the scalar version"""
+
+    @pytest.fixture
+    def locations(self):
+        rng = random.Random(11)
+        locations = [
+            {'coordinates': {'lat': rng.uniform(-80, 80), 'lng': rng.uniform(-179, 179)}}
+            for _ in range(api_server._VECTORIZED_DISTANCE_MIN_LEGS + 10)
+        ]
+        locations[5] = {'coordinates': {}}
+        locations[9] = {'coordinates': {'lat': 'n/a', 'lng': 10}}
+        locations[20] = {}
+        return locations
+
+    def test_numpy_path_matches_scalar(self, locations):
+        """Test legs match the scalar haversine and missing coordinates give None"""
+        pytest.importorskip('numpy')
+        with mock.patch.object(api_server, 'np', None):
+            expected = api_server._leg_distances_km(locations)
+        distances = api_server._leg_distances_km(locations)
+
+        assert len(distances) == len(locations) - 1
+        for got, want in zip(distances, expected):
+            if want is None:
+                assert got is None
+            else:
+                assert got == pytest.approx(want, rel=1e-9)
+
+    def test_scalar_path_marks_incomplete_legs(self):
+        """Test legs touching a location without usable coordinates are None"""
+        locations = [
+            {'coordinates': {'lat': 35.68, 'lng': 139.69}},
+            {'coordinates': {'lat': 34.69, 'lng': 135.50}},
+            {'coordinates': {'lat': None, 'lng': 135.50}},
+        ]
+        distances = api_server._leg_distances_km(locations)
+
+        assert distances[0] == pytest.approx(api_server.calculate_distance_km(35.68, 139.69, 34.69, 135.50))
+        assert distances[1] is None
+
+
+class TestLatestVersionEditBatcher:
+    """Test grouping of concurrent latest-version edits"""
+
+    @pytest.fixture
+    def itinerary(self):
+        return {'transport_segments': []}
+
+    @pytest.fixture
+    def mutate_calls(self, itinerary):
+        """Replace _mutate_latest_version with an in-memory version; record each call."""
+        calls = []
+        gate = threading.Event()
+        gate.set()
+
+        def fake_mutate(db, scenario_ref, fields, mutate, read_fields=(), now_iso=None):
+            calls.append({'fields': fields, 'read_fields': read_fields, 'now_iso': now_iso})
+            gate.wait(5)
+            result = mutate(itinerary)
+            return True, result
+
+        with mock.patch.object(api_server, '_mutate_latest_version', fake_mutate):
+            yield calls, gate
+
+    @staticmethod
+    def _append(segment_id):
+        def _mutate(itinerary_data):
+            itinerary_data['transport_segments'].append(segment_id)
+            return segment_id
+        return _mutate
+
+    def test_idle_scenario_commits_immediately(self, mutate_calls, itinerary):
+        """Test a lone edit runs in its own transaction and gets its own result"""
+        calls, _gate = mutate_calls
+        batcher = api_server.LatestVersionEditBatcher()
+
+        outcome = batcher.submit(None, _Ref('scenarios/s1'), ('transport_segments',), self._append('a'))
+
+        assert outcome == (True, 'a')
+        assert len(calls) == 1
+        assert itinerary['transport_segments'] == ['a']
+
+    def test_edits_queued_behind_a_commit_share_one_transaction(self, mutate_calls, itinerary):
+        """Test edits arriving during an in-flight commit are committed together"""
+        calls, gate = mutate_calls
+        batcher = api_server.LatestVersionEditBatcher()
+        scenario_ref = _Ref('scenarios/s1')
+        results = {}
+
+        def submit(segment_id, now_iso=None):
+            results[segment_id] = batcher.submit(
+                None, scenario_ref, ('transport_segments',), self._append(segment_id), now_iso=now_iso
+            )
+
+        gate.clear()
+        first = threading.Thread(target=submit, args=('a',))
+        first.start()
+        _wait_until(lambda: len(calls) == 1)
+
+        followers = [
+            threading.Thread(target=submit, args=(segment_id, f'2025-01-0{n}T00:00:00'))
+            for n, segment_id in enumerate(('b', 'c', 'd'), start=1)
+        ]
+        for thread in followers:
+            thread.start()
+        _wait_until(lambda: len(batcher._queued.get('s1', [])) == 3)
+        gate.set()
+        for thread in [first, *followers]:
+            thread.join(5)
+
+        assert len(calls) == 2
+        assert calls[1]['now_iso'] == '2025-01-03T00:00:00'
+        assert sorted(itinerary['transport_segments']) == ['a', 'b', 'c', 'd']
+        assert results == {segment_id: (True, segment_id) for segment_id in 'abcd'}
+
+    def test_different_scenarios_do_not_wait_on_each_other(self, mutate_calls):
+        """Test a busy scenario does not hold back edits for another scenario"""
+        calls, gate = mutate_calls
+        batcher = api_server.LatestVersionEditBatcher()
+
+        gate.clear()
+        blocked = threading.Thread(
+            target=batcher.submit, args=(None, _Ref('scenarios/s1'), ('transport_segments',), self._append('a'))
+        )
+        blocked.start()
+        _wait_until(lambda: len(calls) == 1)
+        other = threading.Thread(
+            target=batcher.submit, args=(None, _Ref('scenarios/s2'), ('transport_segments',), self._append('b'))
+        )
+        other.start()
+        _wait_until(lambda: len(calls) == 2)
+        gate.set()
+        blocked.join(5)
+        other.join(5)
+
+    def test_failing_edit_does_not_sink_the_batch(self, mutate_calls, itinerary):
+        """Test an edit that raises is reported to its caller while the rest commit"""
+        def broken(_itinerary_data):
+            raise ValueError('bad research payload')
+
+        batch = [
+            api_server._PendingVersionEdit(('transport_segments',), self._append('a'), (), None),
+            api_server._PendingVersionEdit(('transport_segments',), broken, (), None),
+            api_server._PendingVersionEdit(('transport_segments',), self._append('c'), (), None),
+        ]
+
+        api_server.LatestVersionEditBatcher._commit(None, _Ref('scenarios/s1'), batch)
+
+        assert itinerary['transport_segments'] == ['a', 'c']
+        assert api_server.LatestVersionEditBatcher._result(batch[0]) == (True, 'a')
+        assert api_server.LatestVersionEditBatcher._result(batch[2]) == (True, 'c')
+        with pytest.raises(ValueError, match='bad research payload'):
+            api_server.LatestVersionEditBatcher._result(batch[1])
+
+    def test_transaction_failure_reaches_every_caller(self):
+        """Test a failed commit raises for each edit in the batch"""
+        batcher = api_server.LatestVersionEditBatcher()
+
+        def failing_mutate(*_args, **_kwargs):
+            raise RuntimeError('transaction aborted')
+
+        with mock.patch.object(api_server, '_mutate_latest_version', failing_mutate):
+            with pytest.raises(RuntimeError, match='transaction aborted'):
+                batcher.submit(None, _Ref('scenarios/s1'), ('transport_segments',), self._append('a'))
+        assert 's1' not in batcher._busy
+
+
+class TestCompactResearchList:
+    """Test clean-up of AI research lists"""
+
+    def test_drops_blanks_and_repeats_in_order(self):
+        items = [' JAL ', 'ANA', '', None, 'JAL', {'name': 'x'}, {'name': 'x'}, '  ']
+        assert api_server._compact_research_list(items) == ['JAL', 'ANA', {'name': 'x'}]
+
+    def test_non_list_input_gives_empty_list(self):
+        assert api_server._compact_research_list(None) == []
+        assert api_server._compact_research_list('JAL') == []
+
+
+class _FakeBulkWriter:
+    """BulkWriter stand-in that fails writes to chosen paths a set number of times."""
+
+    def __init__(self, failures_by_path):
+        self.failures_by_path = dict(failures_by_path)
+        self.attempts = {}
+        self.ops = []
+        self._on_result = None
+        self._on_error = None
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def create(self, reference, data):
+        self.ops.append(('create', reference, data))
+
+    def set(self, reference, data):
+        self.ops.append(('set', reference, data))
+
+    def update(self, reference, data):
+        self.ops.append(('update', reference, data))
+
+    def close(self):
+        for _kind, reference, _data in self.ops:
+            attempt = 1
+            while attempt <= self.failures_by_path.get(reference.path, 0):
+                self.attempts[reference.path] = attempt
+                failure = SimpleNamespace(
+                    attempts=attempt, code=4, message='deadline exceeded', operation=SimpleNamespace(reference=reference)
+                )
+                if not self._on_error(failure, self):
+                    break
+                attempt += 1
+            else:
+                if self._on_result is not None:
+                    self._on_result(reference, SimpleNamespace(update_time=f'T{attempt}'), self)
+
+
+class TestBackgroundVersionWriter:
+    """Test retry and failure reporting for queued version writes"""
+
+    @pytest.fixture
+    def collaborators(self):
+        cache = mock.Mock()
+        store = mock.Mock()
+        with mock.patch.object(api_server, 'latest_version_cache', cache), \
+                mock.patch.object(api_server, 'session_store', store):
+            yield cache, store
+
+    @staticmethod
+    def _write(failures_by_path):
+        bulk_writer = _FakeBulkWriter(failures_by_path)
+        db = mock.Mock()
+        db.bulk_writer.return_value = bulk_writer
+        writer = api_server.BackgroundVersionWriter()
+        version_ref = _Ref('scenarios/s1/versions/v2')
+        payload = {'versionNumber': 2}
+        writer.submit_version(db, 's1', _Ref('scenarios/s1'), version_ref, payload, {'currentVersion': 2})
+        assert writer.pending_version('s1') is payload
+        assert writer.flush(5)
+        return writer, bulk_writer, version_ref
+
+    def test_landed_write_confirms_the_cache_entry(self, collaborators):
+        cache, store = collaborators
+        writer, bulk_writer, version_ref = self._write({})
+
+        assert [kind for kind, _ref, _data in bulk_writer.ops] == ['set', 'update']
+        cache.confirm.assert_called_once_with('s1', version_ref, 'T1')
+        assert writer.pending_version('s1') is None
+        assert writer.take_failures() == []
+        store.append_pending_change.assert_not_called()
+
+    def test_transient_errors_are_retried(self, collaborators):
+        cache, _store = collaborators
+        writer, bulk_writer, version_ref = self._write({'scenarios/s1/versions/v2': 2})
+
+        assert bulk_writer.attempts[version_ref.path] == 2
+        cache.confirm.assert_called_once_with('s1', version_ref, 'T3')
+        assert writer.take_failures() == []
+
+    def test_write_out_of_retries_is_reported(self, collaborators):
+        cache, store = collaborators
+        writer, bulk_writer, version_ref = self._write({'scenarios/s1/versions/v2': 99})
+
+        assert bulk_writer.attempts[version_ref.path] == api_server.BackgroundVersionWriter.max_attempts
+        cache.confirm.assert_not_called()
+        cache.invalidate.assert_called_once_with('s1')
+        failures = writer.take_failures()
+        assert [(f['type'], f['scenario_id'], f['version_number'], f['error']) for f in failures] == [
+            ('version_write_failed', 's1', 2, 'deadline exceeded')
+        ]
+        store.append_pending_change.assert_called_once_with('s1', failures[0], api_server.MAX_PENDING_SEGMENT_CHANGES)
+        assert writer.take_failures() == []
+        assert writer.pending_version('s1') is None
+
+    def test_failed_scenario_update_is_reported(self, collaborators):
+        _cache, _store = collaborators
+        writer, _bulk_writer, _version_ref = self._write({'scenarios/s1': 99})
+
+        assert [f['version_number'] for f in writer.take_failures()] == [2]
+
+
+class TestFlushCosts:
+    """Test /api/costs/flush status codes"""
+
+    @pytest.fixture
+    def client(self):
+        return api_server.app.test_client()
+
+    def test_success_when_everything_landed(self, client):
+        writer = mock.Mock(**{'flush.return_value': True, 'take_failures.return_value': []})
+        with mock.patch.object(api_server, 'version_writer', writer):
+            response = client.post('/api/costs/flush', json={'timeout': 2})
+
+        assert response.status_code == 200
+        writer.flush.assert_called_once_with(timeout=2.0)
+
+    def test_failed_writes_return_500(self, client):
+        failure = {'type': 'version_write_failed', 'scenario_id': 's1', 'version_number': 2}
+        writer = mock.Mock(**{'flush.return_value': True, 'take_failures.return_value': [failure]})
+        with mock.patch.object(api_server, 'version_writer', writer):
+            response = client.post('/api/costs/flush')
+
+        assert response.status_code == 500
+        assert response.get_json()['failures'] == [failure]
+
+    def test_timeout_returns_504(self, client):
+        writer = mock.Mock(**{'flush.return_value': False})
+        with mock.patch.object(api_server, 'version_writer', writer):
+            response = client.post('/api/costs/flush', json={'timeout': 0})
+
+        assert response.status_code == 504
+        writer.take_failures.assert_not_called()
+
+    @pytest.mark.parametrize('timeout', ['soon', -1, 'nan', None])
+    def test_invalid_timeout_returns_400(self, client, timeout):
+        writer = mock.Mock()
+        with mock.patch.object(api_server, 'version_writer', writer):
+            response = client.post('/api/costs/flush', json={'timeout': timeout})
+
+        assert response.status_code == 400
+        writer.flush.assert_not_called()
+
+
+class TestMutateLatestVersion:
+    """Test in-place edits of the latest version inside a transaction"""
+
+    @pytest.fixture
+    def firestore_env(self):
+        """Run the transaction body directly against a mocked db; stub the writer and cache."""
+        pytest.importorskip('google.cloud.firestore')
+        writer = mock.Mock(**{'pending_version.return_value': None, 'flush.return_value': True})
+        cache = mock.Mock()
+        db = mock.MagicMock()
+        transaction = db.transaction.return_value
+        with mock.patch.object(api_server.firestore, 'transactional', lambda func: func), \
+                mock.patch.object(api_server, 'version_writer', writer), \
+                mock.patch.object(api_server, 'latest_version_cache', cache):
+            yield db, transaction, writer, cache
+
+    @staticmethod
+    def _version(itinerary_data):
+        version = mock.Mock()
+        version.to_dict.return_value = {'versionNumber': 3, 'itineraryData': itinerary_data}
+        return version
+
+    @staticmethod
+    def _scenario_ref(db):
+        scenario_ref = db.collection('scenarios').document('s1')
+        scenario_ref.id = 's1'
+        return scenario_ref
+
+    @staticmethod
+    def _add_segment(itinerary_data):
+        itinerary_data.setdefault('transport_segments', []).append({'id': 'seg_1'})
+        return 'added'
+
+    def test_edit_writes_back_only_the_named_fields(self, firestore_env):
+        db, transaction, _writer, cache = firestore_env
+        version = self._version({'transport_segments': [], 'locations': [{'id': 'tokyo'}]})
+        transaction.get.return_value = [version]
+        scenario_ref = self._scenario_ref(db)
+
+        outcome = api_server._mutate_latest_version(
+            db, scenario_ref, ('transport_segments',), self._add_segment,
+            read_fields=('locations',), now_iso='2025-01-01T00:00:00',
+        )
+
+        assert outcome == (True, 'added')
+        query = scenario_ref.collection.return_value.order_by.return_value.limit.return_value
+        query.select.assert_called_once_with(
+            ['versionNumber', 'itineraryData.transport_segments', 'itineraryData.locations']
+        )
+        transaction.update.assert_called_once_with(version.reference, {
+            'itineraryData.transport_segments': [{'id': 'seg_1'}],
+            'lastModified': '2025-01-01T00:00:00',
+        })
+        cache.invalidate.assert_called_once_with('s1')
+
+    def test_mutate_returning_none_leaves_the_version_alone(self, firestore_env):
+        db, transaction, _writer, cache = firestore_env
+        transaction.get.return_value = [self._version({'transport_segments': []})]
+
+        outcome = api_server._mutate_latest_version(
+            db, self._scenario_ref(db), ('transport_segments',), lambda _itinerary: None
+        )
+
+        assert outcome == (True, None)
+        transaction.update.assert_not_called()
+        cache.invalidate.assert_not_called()
+
+    def test_scenario_without_versions(self, firestore_env):
+        db, transaction, _writer, _cache = firestore_env
+        transaction.get.return_value = []
+
+        outcome = api_server._mutate_latest_version(db, self._scenario_ref(db), ('transport_segments',), self._add_segment)
+
+        assert outcome == (False, None)
+
+    def test_queued_version_is_flushed_before_the_edit(self, firestore_env):
+        db, transaction, writer, _cache = firestore_env
+        writer.pending_version.side_effect = [{'versionNumber': 4}, None]
+        transaction.get.return_value = [self._version({})]
+
+        outcome = api_server._mutate_latest_version(db, self._scenario_ref(db), ('transport_segments',), self._add_segment)
+
+        assert outcome == (True, 'added')
+        writer.flush.assert_called_once_with(30)
+
+    @pytest.mark.parametrize('flushed, still_pending', [(False, None), (True, {'versionNumber': 5})])
+    def test_unflushed_version_blocks_the_edit(self, firestore_env, flushed, still_pending):
+        """Test the older version is not edited while a snapshot without the edit is queued"""
+        db, transaction, writer, _cache = firestore_env
+        writer.pending_version.side_effect = [{'versionNumber': 4}, still_pending]
+        writer.flush.return_value = flushed
+
+        with pytest.raises(RuntimeError, match='still being saved'):
+            api_server._mutate_latest_version(db, self._scenario_ref(db), ('transport_segments',), self._add_segment)
+        transaction.get.assert_not_called()
+        transaction.update.assert_not_called()
+
+
+class TestGetTransportSegments:
+    """Test GET /api/transport-segments reads"""
+
+    @pytest.fixture
+    def env(self):
+        db = mock.MagicMock()
+        writer = mock.Mock(**{'pending_version.return_value': None})
+        with mock.patch.object(api_server, 'get_firestore_client', return_value=db), \
+                mock.patch.object(api_server, 'version_writer', writer):
+            yield db, writer
+
+    @staticmethod
+    def _query(db):
+        scenario_ref = db.collection.return_value.document.return_value
+        return scenario_ref, scenario_ref.collection.return_value.order_by.return_value.limit.return_value
+
+    def test_one_projected_query_and_no_scenario_read(self, env):
+        db, _writer = env
+        scenario_ref, query = self._query(db)
+        version = mock.Mock()
+        version.to_dict.return_value = {'versionNumber': 3, 'itineraryData': {'transport_segments': [{'id': 'seg_1'}]}}
+        query.select.return_value.stream.return_value = [version]
+
+        response = api_server.app.test_client().get('/api/transport-segments?scenario_id=s1')
+
+        assert response.get_json() == {'transport_segments': [{'id': 'seg_1'}]}
+        query.select.assert_called_once_with(['versionNumber', 'itineraryData.transport_segments'])
+        scenario_ref.get.assert_not_called()
+
+    def test_queued_newer_version_wins(self, env):
+        db, writer = env
+        _scenario_ref, query = self._query(db)
+        version = mock.Mock()
+        version.to_dict.return_value = {'versionNumber': 3, 'itineraryData': {'transport_segments': []}}
+        query.select.return_value.stream.return_value = [version]
+        writer.pending_version.return_value = {
+            'versionNumber': 4, 'itineraryData': {'transport_segments': [{'id': 'seg_2'}]},
+        }
+
+        response = api_server.app.test_client().get('/api/transport-segments?scenario_id=s1')
+
+        assert response.get_json() == {'transport_segments': [{'id': 'seg_2'}]}
+
+
+class TestUpdateTransportResearch:
+    """Test POST /api/transport/update-research responses and change notifications"""
+
+    RESEARCH = {'transport_mode': 'plane', 'cost_low': 400, 'cost_mid': 550.5, 'airlines': ['JAL', 'JAL', 'ANA']}
+
+    @pytest.fixture
+    def env(self):
+        """Stub Firestore and the session store; edits run against an in-memory itinerary."""
+        itinerary = {'transport_segments': [{'id': 'seg_1', 'from_name': 'Tokyo', 'to_name': 'Kyoto'}]}
+        state = {'future': None, 'calls': 0}
+
+        def fake_submit(db, scenario_ref, fields, mutate, read_fields=(), now_iso=None):
+            state['calls'] += 1
+            if state['future'] is not None:
+                state['mutate'] = mutate
+                return state['future']
+            future = Future()
+            future.set_result((True, mutate(itinerary)))
+            return future
+
+        store = mock.Mock(**{
+            'get_cached_session.return_value': {'scenario_id': 's1'},
+            'append_pending_change.return_value': True,
+        })
+        db = mock.MagicMock()
+        with mock.patch.object(api_server, 'get_firestore_client', return_value=db) as get_client, \
+                mock.patch.object(api_server, 'submit_latest_version_edit', fake_submit), \
+                mock.patch.object(api_server, 'session_store', store), \
+                mock.patch.object(api_server, 'TRANSPORT_RESEARCH_WRITE_WAIT_SECONDS', 0.05):
+            yield SimpleNamespace(itinerary=itinerary, state=state, store=store, get_client=get_client)
+
+    @staticmethod
+    def _post(body):
+        return api_server.app.test_client().post('/api/transport/update-research', json=body)
+
+    @staticmethod
+    def _changes(store):
+        return [call.args[1] for call in store.append_pending_change.call_args_list]
+
+    def test_research_is_stored_and_announced(self, env):
+        response = self._post({'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH})
+
+        assert response.status_code == 200
+        assert response.get_json()['status'] == 'success'
+        segment = env.itinerary['transport_segments'][0]
+        assert segment['researched_cost_mid'] == 550.5
+        assert segment['researched_airlines'] == ['JAL', 'ANA']
+        assert segment['booking_status'] == 'researched'
+        assert [change['type'] for change in self._changes(env.store)] == ['transport_segment_updated']
+        env.store.get_cached_session.assert_called_once_with('sess')
+
+    def test_unknown_segment_is_404(self, env):
+        response = self._post({'scenario_id': 's1', 'segment_id': 'seg_x', 'research_data': self.RESEARCH})
+
+        assert response.status_code == 404
+
+    def test_slow_write_returns_202_and_reports_success_later(self, env):
+        env.state['future'] = Future()
+
+        response = self._post({'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH})
+
+        assert response.status_code == 202
+        assert response.get_json()['status'] == 'accepted'
+        env.store.append_pending_change.assert_not_called()
+        env.state['future'].set_result((True, env.state['mutate'](env.itinerary)))
+        assert [change['type'] for change in self._changes(env.store)] == ['transport_segment_updated']
+
+    def test_slow_write_that_fails_is_reported_on_pending_changes(self, env):
+        env.state['future'] = Future()
+
+        response = self._post({'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH})
+
+        assert response.status_code == 202
+        env.state['future'].set_exception(RuntimeError('transaction aborted'))
+        changes = self._changes(env.store)
+        assert [(c['type'], c['segment_id'], c['error']) for c in changes] == [
+            ('transport_segment_update_failed', 'seg_1', 'transaction aborted')
+        ]
+
+    @pytest.mark.parametrize('outcome, error', [
+        ((False, None), 'No versions found'),
+        ((True, None), 'Segment seg_1 not found'),
+    ])
+    def test_slow_write_that_finds_nothing_is_reported(self, env, outcome, error):
+        env.state['future'] = Future()
+
+        self._post({'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH})
+        env.state['future'].set_result(outcome)
+
+        assert [(c['type'], c['error']) for c in self._changes(env.store)] == [('transport_segment_update_failed', error)]
+
+    def test_repeated_research_is_unchanged(self, env):
+        """Test a retried save of the same research leaves the version and pollers alone"""
+        body = {'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH}
+        self._post(body)
+        stored = dict(env.itinerary['transport_segments'][0])
+        env.store.append_pending_change.reset_mock()
+
+        response = self._post(body)
+
+        assert response.status_code == 200
+        assert response.get_json()['status'] == 'unchanged'
+        assert env.itinerary['transport_segments'][0] == stored
+        env.store.append_pending_change.assert_not_called()
+
+    def test_slow_unchanged_write_is_not_reported_as_failed(self, env):
+        body = {'session_id': 'sess', 'segment_id': 'seg_1', 'research_data': self.RESEARCH}
+        self._post(body)
+        env.store.append_pending_change.reset_mock()
+        env.state['future'] = Future()
+
+        assert self._post(body).status_code == 202
+        env.state['future'].set_result((True, env.state['mutate'](env.itinerary)))
+
+        env.store.append_pending_change.assert_not_called()
+
+    @pytest.mark.parametrize('body', [
+        {'scenario_id': 's1', 'research_data': {'cost_mid': 10}},
+        {'scenario_id': 's1', 'segment_id': 'seg_1', 'research_data': {}},
+        {'scenario_id': 's1', 'segment_id': 'seg_1', 'research_data': ['cost_mid', 10]},
+        {'scenario_id': 's1', 'segment_id': 'seg_1', 'research_data': {'cost_mid': 'cheap'}},
+        {'scenario_id': 's1', 'segment_id': 'seg_1', 'research_data': {'airlines': 'JAL'}},
+    ])
+    def test_malformed_payload_is_400_before_firestore(self, env, body):
+        response = self._post(body)
+
+        assert response.status_code == 400
+        env.get_client.assert_not_called()
+        assert env.state['calls'] == 0
+
+    def test_validation_errors_name_the_field(self, env):
+        response = self._post({'scenario_id': 's1', 'segment_id': 'seg_1', 'research_data': {'cost_mid': 'cheap'}})
+
+        payload = response.get_json()
+        assert payload['error'] == 'Invalid research_data'
+        assert {tuple(detail['loc'])[0] for detail in payload['details']} == {'cost_mid'}
+
+    def test_without_session_or_scenario_is_400(self, env):
+        env.store.get_cached_session.return_value = None
+
+        response = self._post({'session_id': 'gone', 'segment_id': 'seg_1', 'research_data': self.RESEARCH})
+
+        assert response.status_code == 400
+        assert env.state['calls'] == 0
+
+
+class TestCommitWriteOps:
+    """Test curriculum writes through the BulkWriter"""
+
+    @staticmethod
+    def _commit(failures_by_path):
+        bulk_writer = _FakeBulkWriter(failures_by_path)
+        db = mock.Mock(**{'bulk_writer.return_value': bulk_writer})
+        write_ops = [
+            ('create', _Ref('curriculum_plans/p1'), {'status': 'draft'}),
+            ('set', _Ref('locations/tokyo'), {'plan_ids': ['p1']}),
+            ('update', _Ref('students/st1'), {'plan_count': 1}),
+        ]
+        return bulk_writer, lambda: api_server._commit_write_ops(db, write_ops)
+
+    def test_all_ops_are_sent_and_closed(self):
+        bulk_writer, commit = self._commit({})
+
+        commit()
+
+        assert [(kind, ref.path) for kind, ref, _data in bulk_writer.ops] == [
+            ('create', 'curriculum_plans/p1'), ('set', 'locations/tokyo'), ('update', 'students/st1'),
+        ]
+
+    def test_transient_errors_are_retried(self):
+        bulk_writer, commit = self._commit({'locations/tokyo': api_server.CURRICULUM_WRITE_MAX_ATTEMPTS - 1})
+
+        commit()
+
+        assert bulk_writer.attempts['locations/tokyo'] == api_server.CURRICULUM_WRITE_MAX_ATTEMPTS - 1
+
+    def test_writes_out_of_retries_raise(self):
+        bulk_writer, commit = self._commit({'curriculum_plans/p1': 99, 'students/st1': 99})
+
+        with pytest.raises(RuntimeError, match='2 of 3 curriculum writes failed') as excinfo:
+            commit()
+        assert 'curriculum_plans/p1: deadline exceeded' in str(excinfo.value)
+        assert bulk_writer.attempts['students/st1'] == api_server.CURRICULUM_WRITE_MAX_ATTEMPTS
+
+
+class _FakePlanQuery:
+    """Chainable curriculum_plans query over in-memory documents."""
+
+    def __init__(self, plans, indexed=True, filters=(), ordered=False, limit_count=None, fields=None, log=None):
+        self.plans = plans
+        self.indexed = indexed
+        self.filters = filters
+        self.ordered = ordered
+        self.limit_count = limit_count
+        self.fields = fields
+        self.log = log if log is not None else []
+
+    def _with(self, **changes):
+        state = dict(plans=self.plans, indexed=self.indexed, filters=self.filters, ordered=self.ordered,
+                     limit_count=self.limit_count, fields=self.fields, log=self.log)
+        state.update(changes)
+        return _FakePlanQuery(**state)
+
+    def where(self, field, op, value):
+        return self._with(filters=(*self.filters, (field, op, value)))
+
+    def order_by(self, field, direction=None):
+        return self._with(ordered=True)
+
+    def limit(self, count):
+        return self._with(limit_count=count)
+
+    def select(self, fields):
+        return self._with(fields=list(fields))
+
+    def _matches(self, plan):
+        for field, op, value in self.filters:
+            if op == 'array_contains' and value not in (plan.get(field) or []):
+                return False
+            if op == '==' and plan.get(field) != value:
+                return False
+        return True
+
+    def stream(self):
+        self.log.append(self)
+        if self.ordered and self.filters and not self.indexed:
+            raise FailedPrecondition('The query requires an index')
+        plans = [plan for plan in self.plans if self._matches(plan)]
+        if self.ordered:
+            plans.sort(key=lambda plan: plan['created_at'], reverse=True)
+        if self.limit_count is not None:
+            plans = plans[:self.limit_count]
+        for plan in plans:
+            data = {field: plan[field] for field in self.fields if field in plan} if self.fields else dict(plan)
+            yield SimpleNamespace(id=plan['id'], to_dict=lambda data=data: data)
+
+
+class TestListCurricula:
+    """Test GET /api/education/curricula"""
+
+    @pytest.fixture
+    def plans(self):
+        base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        return [
+            {'id': f'p{n}', 'student_profile_id': 'st1' if n % 2 else 'st2', 'status': 'draft',
+             'location_id': 'tokyo' if n < 3 else 'kyoto', 'location_ids': ['tokyo', 'kyoto'] if n == 4 else None,
+             'created_at': base + timedelta(days=n), 'location_lessons': {'tokyo': {}}}
+            for n in range(6)
+        ]
+
+    @staticmethod
+    def _get(plans, query_string, indexed=True):
+        root = _FakePlanQuery(plans, indexed=indexed)
+        db = mock.Mock(**{'collection.return_value': root})
+        with mock.patch.object(api_server, 'get_firestore_client', return_value=db):
+            response = api_server.app.test_client().get(f'/api/education/curricula?{query_string}')
+        return response, root.log
+
+    def test_filtered_listing_is_ordered_and_limited_in_firestore(self, plans):
+        response, log = self._get(plans, 'student_id=st1&limit=2')
+
+        assert [plan['id'] for plan in response.get_json()['curricula']] == ['p5', 'p3']
+        assert [(query.ordered, query.limit_count) for query in log] == [(True, 2)]
+
+    def test_missing_index_falls_back_to_sorting_in_python(self, plans):
+        response, log = self._get(plans, 'student_id=st1&limit=2', indexed=False)
+
+        assert response.status_code == 200
+        assert [plan['id'] for plan in response.get_json()['curricula']] == ['p5', 'p3']
+        assert [(query.ordered, query.limit_count) for query in log] == [(True, 2), (False, None)]
+
+    def test_missing_index_for_location_listing(self, plans):
+        response, _log = self._get(plans, 'location_id=kyoto&fields=status', indexed=False)
+
+        curricula = response.get_json()['curricula']
+        assert [plan['id'] for plan in curricula] == ['p5', 'p4', 'p3']
+        assert set(curricula[0]) == {'id', 'created_at', 'status'}
+
+    def test_unknown_field_is_400_before_querying(self, plans):
+        response, log = self._get(plans, 'fields=status,lessons,secret')
+
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Unknown curriculum fields: lessons, secret'
+        assert log == []
+
+    def test_field_mask_always_includes_id_and_created_at(self, plans):
+        response, log = self._get(plans, 'student_id=st2&fields=status,status')
+
+        assert log[0].fields == ['id', 'created_at', 'status']
+        curricula = response.get_json()['curricula']
+        assert [plan['id'] for plan in curricula] == ['p4', 'p2', 'p0']
+        assert all(set(plan) == {'id', 'created_at', 'status'} for plan in curricula)
@@ -17,7 +17,7 @@
 from typing import Any, Dict, Optional, Union
 
 from google.genai import types
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 # Convenient declaration for controlled generation.
@@ -704,6 +704,27 @@ class TransportResearchRequest(BaseModel):
     )
 
 
+class TransportResearchUpdate(BaseModel):
+    """Research payload accepted by the update-research endpoint.
+
+    Looser than TransportResearchResult: every field is optional and unknown
+    keys are kept, but the fields the endpoint stores must have usable types.
+    """
+    model_config = ConfigDict(extra="allow")
+
+    transport_mode: Optional[str] = None
+    cost_low: Optional[Union[int, float]] = None
+    cost_mid: Optional[Union[int, float]] = None
+    cost_high: Optional[Union[int, float]] = None
+    typical_duration_hours: Optional[Union[int, float]] = None
+    typical_stops: Optional[Union[int, float]] = None
+    airlines: Optional[list[Any]] = None
+    alternatives: Optional[list[Any]] = None
+    sources: Optional[list[Any]] = None
+    booking_tips: Optional[str] = None
+    confidence: Optional[str] = None
+
+
 class TransportResearchResult(BaseModel):
     """Research results for transport between destinations."""
     segment_id: str = Field(description="ID of the transport segment")
@@ -18,6 +18,7 @@ import os
 import re
 import requests
 import logging
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from google.genai.types import Tool, FunctionDeclaration
 from google.adk.tools import ToolContext
@@ -28,6 +29,12 @@ from travel_concierge.tools.cost_tracker import CurrencyConverter
 logger = logging.getLogger(__name__)
 FLASK_API_URL = os.getenv("FLASK_API_URL", "http://127.0.0.1:5001")
 
+# Keep-alive pool for the save calls back into the Flask API
+_api_session = requests.Session()
+_api_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+_api_session.mount("http://", _api_adapter)
+_api_session.mount("https://", _api_adapter)
+
 # Currency converter for accurate exchange rates
 _currency_converter = CurrencyConverter()
 
@@ -201,7 +208,7 @@ def save_researched_costs(
 
     # Call Flask API to save costs to Firestore
     try:
-        response = requests.post(
+        response = _api_session.post(
             f"{FLASK_API_URL}/api/costs/bulk-save",
             json={
                 "session_id": session_id,
@@ -286,7 +293,7 @@ def save_transport_research(
 
     # Call Flask API to update transport segment with research data
     try:
-        response = requests.post(
+        response = _api_session.post(
             f"{FLASK_API_URL}/api/transport/update-research",
             json={
                 "session_id": session_id,
@@ -296,7 +303,8 @@ def save_transport_research(
             timeout=30
         )
 
-        if response.status_code == 200:
+        # 202: the server accepted the update and is finishing the write in the background
+        if response.status_code in (200, 202):
             result = response.json()
             cost_mid = research_data.get('cost_mid', 0)
             num_alternatives = len(research_data.get('alternatives', []))
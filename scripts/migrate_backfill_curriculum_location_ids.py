@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Migration script to backfill location_ids on curriculum plans.
+
+Location lookups (GET /api/education/curricula?location_id=... and
+/api/education/curricula/by-location/<id>) match a plan through its location_ids
+array or its primary location_id. Plans saved before location_ids existed only
+have the primary location_id, so locations that were added to their
+location_lessons later (e.g. through PUT /api/education/curricula/<id>) are not
+found. This script writes location_ids from the location_lessons keys, the same
+way the API does when it saves or updates a plan.
+
+Usage:
+    # From project root directory:
+    cd python/agents/travel-concierge
+    poetry run python ../../../scripts/migrate_backfill_curriculum_location_ids.py [--dry-run] [--plan-id PLAN_ID]
+
+Options:
+    --dry-run       Preview changes without modifying the database
+    --plan-id ID    Only process a specific curriculum plan (defaults to all plans)
+"""
+
+import argparse
+from typing import Dict, Any, List
+
+try:
+    from google.cloud import firestore
+except ImportError as e:
+    print(f"❌ Error importing google.cloud.firestore: {e}")
+    print("\nThis script must be run with Poetry from the travel-concierge directory:")
+    print("  cd python/agents/travel-concierge")
+    print("  poetry run python ../../../scripts/migrate_backfill_curriculum_location_ids.py --dry-run")
+    exit(1)
+
+# Only the fields needed to derive location_ids
+PLAN_FIELDS = ['location_id', 'location_ids', 'location_lessons']
+
+
+def expected_location_ids(plan_data: Dict[str, Any]) -> List[str]:
+    """
+    Return the location_ids the API would store for a plan.
+
+    Args:
+        plan_data: The curriculum plan document
+
+    Returns:
+        Every location key of location_lessons, or the primary location_id for
+        plans without lessons
+    """
+    location_lessons = plan_data.get('location_lessons') or {}
+    if location_lessons:
+        return list(location_lessons)
+    location_id = plan_data.get('location_id')
+    return [str(location_id)] if location_id else []
+
+
+def migrate_plan(plan_doc, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Backfill location_ids on a single curriculum plan.
+
+    Args:
+        plan_doc: Snapshot of the plan (at least PLAN_FIELDS)
+        dry_run: If True, only preview changes without modifying
+
+    Returns:
+        Dictionary with migration statistics
+    """
+    plan_data = plan_doc.to_dict() or {}
+    current = plan_data.get('location_ids')
+    expected = expected_location_ids(plan_data)
+
+    if current is not None and set(current) == set(expected):
+        return {'plan_id': plan_doc.id, 'modified': False}
+
+    # The primary location_id was already matched without location_ids
+    added = sorted(set(expected) - set(current or []) - {plan_data.get('location_id')})
+    print(f"  {'[DRY RUN] ' if dry_run else ''}Plan {plan_doc.id}: location_ids {current} -> {expected}" +
+          (f" (newly findable under: {', '.join(added)})" if added else ""))
+
+    if not dry_run:
+        plan_doc.reference.update({'location_ids': expected})
+
+    return {'plan_id': plan_doc.id, 'modified': True, 'locations_added': len(added)}
+
+
+def migrate_plans(db: firestore.Client, plan_id: str = None, dry_run: bool = False) -> List[Dict[str, Any]]:
+    """
+    Backfill location_ids on one plan or on every plan.
+
+    Args:
+        db: Firestore client instance
+        plan_id: Only process this plan when given
+        dry_run: If True, only preview changes without modifying
+
+    Returns:
+        List of migration statistics for each plan
+    """
+    print(f"\n{'='*80}")
+    print(f"{'DRY RUN - ' if dry_run else ''}Migration: Backfill curriculum location_ids")
+    print(f"{'='*80}")
+
+    plans_ref = db.collection('curriculum_plans')
+    if plan_id:
+        plan_doc = plans_ref.document(plan_id).get(field_paths=PLAN_FIELDS)
+        if not plan_doc.exists:
+            print(f"  ⚠️  Plan not found: {plan_id}")
+            return [{'error': 'not_found', 'plan_id': plan_id}]
+        plan_docs = [plan_doc]
+    else:
+        plan_docs = plans_ref.select(PLAN_FIELDS).stream()
+
+    return [migrate_plan(plan_doc, dry_run) for plan_doc in plan_docs]
+
+
+def print_summary(results: List[Dict[str, Any]], dry_run: bool = False):
+    """Print migration summary statistics."""
+    print(f"\n{'='*80}")
+    print(f"{'DRY RUN - ' if dry_run else ''}Migration Summary")
+    print(f"{'='*80}")
+
+    print(f"Plans processed: {len(results)}")
+    print(f"Plans modified: {sum(1 for r in results if r.get('modified'))}")
+    print(f"Locations made findable: {sum(r.get('locations_added', 0) for r in results)}")
+
+    if dry_run:
+        print(f"\n⚠️  This was a DRY RUN. No changes were made to the database.")
+        print(f"Run without --dry-run to apply these changes.")
+    else:
+        print(f"\n✅ Migration completed successfully!")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backfill location_ids on curriculum plans from their location_lessons'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Preview changes without modifying the database'
+    )
+    parser.add_argument(
+        '--plan-id',
+        type=str,
+        help='Only process a specific curriculum plan ID'
+    )
+
+    args = parser.parse_args()
+
+    # Initialize Firestore client
+    try:
+        db = firestore.Client()
+        print("✅ Connected to Firestore")
+    except Exception as e:
+        print(f"❌ Failed to connect to Firestore: {e}")
+        print("\nMake sure:")
+        print("  1. You have valid GCP credentials configured")
+        print("  2. GOOGLE_APPLICATION_CREDENTIALS is set, or")
+        print("  3. You're running in a GCP environment with default credentials")
+        exit(1)
+
+    results = migrate_plans(db, args.plan_id, args.dry_run)
+    print_summary(results, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -57,9 +57,15 @@ echo "✅ ADK server started successfully (PID: $ADK_PID)"
 # Start Flask API server
 echo "🌐 Starting Flask API server on port ${PORT}..."
 cd /app/python/agents/travel-concierge
+# API log level (api_server.py reads LOG_LEVEL); per-request debug traces stay off unless asked for
+export LOG_LEVEL="${LOG_LEVEL:-WARNING}"
+# Threaded workers: research routes block for minutes on ADK/Firestore I/O,
+# so each worker keeps serving other requests while those calls are in flight.
 exec $PYTHON_BIN -m gunicorn \
     --bind 0.0.0.0:${PORT} \
     --workers 2 \
+    --worker-class gthread \
+    --threads ${GUNICORN_THREADS:-8} \
     --timeout 300 \
     --access-logfile - \
     --error-logfile - \
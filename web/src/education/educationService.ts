@@ -174,6 +174,7 @@ export class EducationService {
     country?: string;
     status?: string;
     limit?: number;
+    fields?: string;
   }): Promise<ListCurriculaResponse> {
     const params = new URLSearchParams();
     if (filters) {